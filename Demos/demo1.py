@@ -4,10 +4,8 @@ from pandana.core import *
 from nova.utils.index import index, KL
 
 # Better var
-def kPngE(tables):
-    df = tables["rec.vtx.elastic.fuzzyk.png"]["calE"]
-    return df.groupby(level=KL).sum()
-kPngE = Var(kPngE)
+# Summing the prongs of each event is a single pass over the rows of each event
+kPngE = Var(lambda tables: tables["rec.vtx.elastic.fuzzyk.png"]["calE"]).sum(KL)
 # NOTE: No check that there are actually prongs in the event
 # The rec.vtx.elastic.fuzzyk.png dataset already only has events with prongs
 
@@ -21,11 +19,11 @@ def kFiducial(tables):
         & (df["vtx.y"] > -180)
         & (df["vtx.z"] < 1000)
         & (df["vtx.z"] > 50)
-    ).groupby(level=KL).first()
-kFiducial = Cut(kFiducial)
+    )
+kFiducial = Cut(kFiducial).first(KL)
 
 # Dumb oscillation weights
-kDumbOsc = Var(lambda tables: tables['rec.mc.nu']['woscdumb'].groupby(level=KL).first())
+kDumbOsc = Var(lambda tables: tables['rec.mc.nu']['woscdumb']).first(KL)
 
 # Initialize the loader
 fname = sys.argv[1]
@@ -30,10 +30,8 @@ import matplotlib.pyplot as plt
 
 # npng etc now in brackets instead of an attribute so the Loader knows what to load
 kTwoProng = Cut(
-    lambda tables: (tables["rec.vtx.elastic.fuzzyk"]["npng"] == 2)
-    .groupby(level=KL)
-    .first()
-)
+    lambda tables: tables["rec.vtx.elastic.fuzzyk"]["npng"] == 2
+).first(KL)
 
 ###########################################
 # Look for events where all prongs are photon like
@@ -42,8 +40,8 @@ kTwoProng = Cut(
 ###########################################
 def kGammaCut(tables):
     df = tables["rec.vtx.elastic.fuzzyk.png.cvnpart"]["photonid"]
-    return (df > 0.75).groupby(level=KL).agg(np.all)
-kGammaCut = Cut(kGammaCut)
+    return df > 0.75
+kGammaCut = Cut(kGammaCut).all(KL)
 
 # Loose containment cut
 def kContain(tables):
@@ -55,20 +53,16 @@ def kContain(tables):
         & (df["vtx.y"] > -180)
         & (df["vtx.z"] < 1000)
         & (df["vtx.z"] > 50)
-    ).groupby(level=KL).first()
-kContain = Cut(kContain)
+    )
+kContain = Cut(kContain).first(KL)
 
 kPlaneGap = Cut(
-    lambda tables: (tables["rec.vtx.elastic.fuzzyk.png"]["maxplanegap"] > 1)
-    .groupby(level=KL)
-    .agg(np.all)
-)
+    lambda tables: tables["rec.vtx.elastic.fuzzyk.png"]["maxplanegap"] > 1
+).all(KL)
 
 kPlaneContig = Cut(
-    lambda tables: (tables["rec.vtx.elastic.fuzzyk.png"]["maxplanecont"] > 4)
-    .groupby(level=KL)
-    .agg(np.all)
-)
+    lambda tables: tables["rec.vtx.elastic.fuzzyk.png"]["maxplanecont"] > 4
+).all(KL)
 
 # Does the event actually have a pi0?
 kTruePi0 = Cut(lambda tables: tables["rec.sand.nue"]["npi0"] > 0)
@@ -90,13 +84,13 @@ def kMass(tables):
 
     # compute the dot product
     dot = (
-        x.groupby(level=KL).prod()
-        + y.groupby(level=KL).prod()
-        + z.groupby(level=KL).prod()
+        segment_reduce(x, KL, "prod", tables)
+        + segment_reduce(y, KL, "prod", tables)
+        + segment_reduce(z, KL, "prod", tables)
     )
 
     # multiply the energy of all prongs in each event together
-    EProd = df["calE"].groupby(level=KL).prod()
+    EProd = segment_reduce(df["calE"], KL, "prod", tables)
 
     # return a dataframe with a single column of the invariant mass
     deadscale = 0.8747
@@ -0,0 +1,168 @@
+"""Measure the throughput of Loader.Go on synthetic NOvA-like files.
+
+    python benchmarks/run.py [--events N] [--files N] [--repeat N] [--json FILE] [CASE ...]
+
+Each case of selections.py runs in a fresh process, so that its peak RSS
+is its own. It reports the events processed per second (best of the
+repeats), the bytes decompressed and used, the peak RSS and how the time
+of one more run, profiled with Loader(profile=True), splits between
+reading, Var/Cut evaluation, alignment and filling. Loader options can be given to compare them.
+"""
+import argparse
+import json
+import multiprocessing
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from context import pandana
+from pandana.core.loader import Loader
+from pandana.core.tables import Tables
+from pandana.utils.profiling import peak_rss
+from pandana.utils.synthetic import indices, write_synthetic_files
+
+import selections
+
+
+def stages(report):
+    """
+    The seconds of a profiled Loader.Go in the stages reported by the benchmark,
+    everything else being "other".
+
+    :param report: A report of Loader.profileReport
+    :return: A dict of seconds by stage
+    """
+    seconds = {stage: spread["mean"] for stage, spread in report["stages"].items()}
+    split = {k: seconds.pop(k, 0.0) for k in ("read", "evaluate", "align", "fill")}
+    split["other"] = sum(seconds.values())
+    split["total"] = report["wall"]["mean"]
+    return split
+
+
+def measure(case, files, loader_options, repeat):
+    """
+    Run one case in this process.
+
+    :return: A dict of results
+    """
+
+    def go(profile=False):
+        loader = Loader(files, "evt.seq", "spill", indices, profile=profile, **loader_options)
+        selections.CASES[case](loader)
+        start = time.perf_counter()
+        loader.Go()
+        return time.perf_counter() - start, loader
+
+    times = []
+    for _ in range(repeat):
+        elapsed, loader = go()
+        times.append(elapsed)
+    read = loader.readAmplification()
+
+    _, profiled = go(profile=True)
+    split = stages(profiled.profileReport())
+
+    nevents = sum(Tables.countEvents(f, "evt.seq", "spill") for f in files)
+    return {
+        "case": case,
+        "events": nevents,
+        "seconds": times,
+        "events_per_second": nevents / min(times),
+        "bytes_decompressed": read["decompressed"],
+        "bytes_used": read["used"],
+        "read_amplification": read["amplification"],
+        "peak_rss": peak_rss(),
+        "stages": split,
+    }
+
+
+def report(results, out=sys.stdout):
+    header = "%-12s %12s %10s %8s %10s  %s" % (
+        "case",
+        "events/s",
+        "MB read",
+        "ampl.",
+        "peak MB",
+        "read / evaluate / align / fill / other",
+    )
+    print(header, file=out)
+    for r in results:
+        split = r["stages"]
+        fractions = " / ".join(
+            "%3.0f%%" % (100 * split[k] / split["total"] if split["total"] else 0)
+            for k in ("read", "evaluate", "align", "fill", "other")
+        )
+        print(
+            "%-12s %12.0f %10.1f %8.2f %10.1f  %s"
+            % (
+                r["case"],
+                r["events_per_second"],
+                r["bytes_decompressed"] / 1e6,
+                r["read_amplification"],
+                r["peak_rss"] / 1e6,
+                fractions,
+            ),
+            file=out,
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cases", nargs="*", help="of %s, all by default" % list(selections.CASES))
+    parser.add_argument("--events", type=int, default=100000, help="spills per file")
+    parser.add_argument("--files", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--data", help="where the synthetic files are kept, a temporary directory if not given"
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--chunk-events", type=int)
+    parser.add_argument("--prefetch", choices=["thread", "process"])
+    parser.add_argument("--align-chunks", action="store_true")
+    parser.add_argument("--reuse-buffers", action="store_true")
+    parser.add_argument("--cache", help="a ColumnCache directory")
+    parser.add_argument("--backend", choices=["serial", "processes"])
+    args = parser.parse_args(argv)
+
+    loader_options = {
+        "chunk_events": args.chunk_events,
+        "prefetch": args.prefetch,
+        "align_chunks": args.align_chunks,
+        "reuse_buffers": args.reuse_buffers,
+        "cache": args.cache,
+        "backend": args.backend,
+    }
+    cases = args.cases or list(selections.CASES)
+    unknown = set(cases) - set(selections.CASES)
+    if unknown:
+        parser.error("unknown cases %s" % sorted(unknown))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = write_synthetic_files(args.data or tmp, args.files, args.events)
+        results = []
+        context = multiprocessing.get_context("spawn")
+        for case in cases:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results.append(
+                    executor.submit(measure, case, files, loader_options, args.repeat).result()
+                )
+
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "files": args.files,
+                    "events_per_file": args.events,
+                    "loader_options": loader_options,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
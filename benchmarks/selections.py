@@ -0,0 +1,133 @@
+"""Representative selections for the benchmarks, modelled on the Demos.
+
+Each case takes a Loader and books its spectra on it.
+"""
+import boost_histogram as bh
+import numpy as np
+import pandas as pd
+
+from context import pandana
+from pandana.core import Cut, Var, Spectrum, MultiverseSpectrum, segment_reduce
+from pandana.utils.synthetic import KL
+
+kPOT = Var(lambda tables: tables["spill"]["spillpot"])
+
+# demo0: a slice energy window
+kSlcE = Var(lambda tables: tables["rec.slc"]["calE"])
+kEnergyCut = (kSlcE > 1) & (kSlcE < 4)
+
+
+def energy(loader):
+    return [Spectrum(loader, kEnergyCut, kSlcE)]
+
+
+# demo0 with the Vars built from columns, so the cut is evaluated as one fused kernel
+kSlcEColumn = Var.column("rec.slc", "calE")
+kFusedEnergyCut = (kSlcEColumn > 1) & (kSlcEColumn < 4)
+
+
+def energy_fused(loader):
+    return [Spectrum(loader, kFusedEnergyCut, kSlcEColumn)]
+
+
+# demo1: a vertex fiducial cut on the summed prong energy, with oscillation weights
+def kFiducial(tables):
+    df = tables["rec.vtx.elastic"]
+    return (
+        (df["vtx.x"] < 180)
+        & (df["vtx.x"] > -180)
+        & (df["vtx.y"] < 180)
+        & (df["vtx.y"] > -180)
+        & (df["vtx.z"] < 1000)
+        & (df["vtx.z"] > 50)
+    )
+
+
+kFiducial = Cut(kFiducial).first(KL)
+kPngE = Var(lambda tables: tables["rec.vtx.elastic.fuzzyk.png"]["calE"]).sum(KL)
+kDumbOsc = Var(lambda tables: tables["rec.mc.nu"]["woscdumb"]).first(KL)
+
+
+def fiducial(loader):
+    return [
+        Spectrum(
+            loader, kFiducial, kPngE, kDumbOsc, axes=bh.axis.Regular(50, 0, 5), exposure=kPOT
+        )
+    ]
+
+
+# pi0_spectra: the invariant mass of two photon-like prongs after a chain of cuts
+kTwoProng = Cut(lambda tables: tables["rec.vtx.elastic.fuzzyk"]["npng"] == 2).first(KL)
+kGammaCut = Cut(
+    lambda tables: tables["rec.vtx.elastic.fuzzyk.png.cvnpart"]["photonid"] > 0.5
+).all(KL)
+kPlaneGap = Cut(
+    lambda tables: tables["rec.vtx.elastic.fuzzyk.png"]["maxplanegap"] > 1
+).all(KL)
+kPlaneContig = Cut(
+    lambda tables: tables["rec.vtx.elastic.fuzzyk.png"]["maxplanecont"] > 4
+).all(KL)
+kTruePi0 = Cut(lambda tables: tables["rec.sand.nue"]["npi0"] > 0).first(KL)
+
+
+def kMass(tables):
+    df = tables["rec.vtx.elastic.fuzzyk.png"]
+    x = df["dir.x"]
+    y = df["dir.y"]
+    z = df["dir.z"]
+    l = np.sqrt(x * x + y * y + z * z)
+    dot = (
+        segment_reduce(x / l, KL, "prod", tables)
+        + segment_reduce(y / l, KL, "prod", tables)
+        + segment_reduce(z / l, KL, "prod", tables)
+    )
+    EProd = segment_reduce(df["calE"], KL, "prod", tables)
+    # Events without exactly two prongs can have |dot| > 1, they fail kTwoProng
+    return 1000 * 0.8747 * np.sqrt(np.maximum(2 * EProd * (1 - dot), 0))
+
+
+kMass = Var(kMass)
+
+
+def pi0(loader):
+    cutTot = kTwoProng & kGammaCut & kFiducial & kPlaneContig & kPlaneGap
+    cutBkg = cutTot & ~kTruePi0
+    return [
+        Spectrum(loader, cutTot, kMass),
+        Spectrum(loader, cutBkg, kMass),
+        Spectrum(loader, cutTot, kMass, axes=bh.axis.Regular(40, 0, 400)),
+    ]
+
+
+# Systematics: one hundred weight universes of the slice energy
+kShifts = np.linspace(0.8, 1.2, 100)
+
+
+def kUniverses(tables):
+    weight = tables["rec.mc.nu"]["woscdumb"]
+    return pd.DataFrame(np.outer(weight.to_numpy(), kShifts), index=weight.index)
+
+
+kUniverses = Var(kUniverses)
+
+
+def multiverse(loader):
+    return [
+        MultiverseSpectrum(
+            loader,
+            kEnergyCut,
+            kSlcE,
+            kUniverses,
+            axes=bh.axis.Regular(50, 0, 10),
+            nuniverses=len(kShifts),
+        )
+    ]
+
+
+CASES = {
+    "energy": energy,
+    "energy_fused": energy_fused,
+    "fiducial": fiducial,
+    "pi0": pi0,
+    "multiverse": multiverse,
+}
@@ -2,5 +2,6 @@ from pandana.core import *
 from pandana.core.loader import Loader
 from pandana.core.var import Var
 from pandana.core.cut import Cut
-from pandana.core.spectrum import Spectrum,FilledSpectrum
+from pandana.core.spectrum import Spectrum,FilledSpectrum,LoadedSpectrum,MultiverseSpectrum
 from pandana.core.datagroup import DataGroup
+from pandana.core.segments import segment_reduce
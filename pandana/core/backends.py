@@ -0,0 +1,167 @@
+"""Execution backends: how the work of a Loader is spread over processes.
+
+A backend gives the Loader a communicator, whose rank and size split the
+events, and which spectra and reports are summed and gathered over.
+The serial backend runs in one process without MPI. The MPI backend runs
+on any mpi4py communicator, so several analyses can run side by side on
+sub-communicators of MPI.COMM_WORLD. mpi4py is only imported, and MPI
+initialized, when an MPI backend is made. The process backend spreads
+the events over a pool of local worker processes, without MPI.
+"""
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from pandana.utils.mpiutils import SerialComm, world
+
+
+# Variables set by MPI launchers (Open MPI, MPICH and Intel MPI, PMIx, MVAPICH)
+LAUNCHER_VARIABLES = (
+    "OMPI_COMM_WORLD_SIZE",
+    "PMI_SIZE",
+    "PMIX_RANK",
+    "MV2_COMM_WORLD_SIZE",
+)
+
+
+class Backend:
+    """Runs a Loader on the ranks of comm."""
+
+    name = None
+
+    def __init__(self, comm):
+        self.comm = comm
+
+    @property
+    def rank(self):
+        return self.comm.rank
+
+    @property
+    def size(self):
+        return self.comm.size
+
+    def go(self, loader):
+        """
+        Fill the spectra of loader from the events of this rank and finish them.
+
+        :return: None
+        """
+        loader.run()
+
+    def __repr__(self):
+        return "<%s rank %d of %d>" % (type(self).__name__, self.rank, self.size)
+
+
+class SerialBackend(Backend):
+    """All the events in this process, without MPI."""
+
+    name = "serial"
+
+    def __init__(self):
+        super().__init__(SerialComm())
+
+
+class MPIBackend(Backend):
+    """The events split between the ranks of an MPI communicator,
+    MPI.COMM_WORLD by default."""
+
+    name = "mpi"
+
+    def __init__(self, comm=None):
+        super().__init__(world() if comm is None else comm)
+
+
+# The loader of a worker process of a ProcessBackend
+_worker_loader = None
+
+
+def _init_worker(loader):
+    global _worker_loader
+    _worker_loader = loader
+    # Drop what the parent process had filled and recorded before forking
+    loader.partial()
+
+
+def _fill_share(work):
+    # Fill the spectra of the worker's loader from work and take the result.
+    # A worker may get several shares, so its spectra are left empty.
+    _worker_loader.fill(work)
+    return _worker_loader.partial()
+
+
+class ProcessBackend(Backend):
+    """The events split between local worker processes, without MPI.
+
+    The events of all files are taken as one sequence and split into one
+    contiguous share per worker, as with event_space="global". Each worker
+    fills its own copy of the spectra and sends back their histograms,
+    counts and selected events, which are added together in share order,
+    so the events come out in the same order as in a serial run.
+    The loader is then finished in this process, as a single rank.
+
+    Workers are forked by default, so they inherit the Vars and Cuts of the
+    loader, which need not be picklable. Do not fork a process that has
+    initialized MPI; other start methods need picklable Vars and Cuts.
+    """
+
+    name = "processes"
+
+    def __init__(self, workers=None, start_method="fork"):
+        super().__init__(SerialComm())
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.start_method = start_method
+
+    def go(self, loader):
+        counts = loader.eventCounts()
+        nworkers = min(self.workers, int(counts.sum()))
+        if nworkers <= 1:
+            loader.run()
+            return
+
+        shares = [loader.eventRanges(counts, i, nworkers) for i in range(nworkers)]
+        with ProcessPoolExecutor(
+            nworkers,
+            mp_context=multiprocessing.get_context(self.start_method),
+            initializer=_init_worker,
+            initargs=(loader,),
+        ) as executor:
+            for partial in executor.map(_fill_share, shares):
+                loader.merge(partial)
+        loader.Finish()
+
+    def __repr__(self):
+        return "<%s of %d workers>" % (type(self).__name__, self.workers)
+
+
+def launched_by_mpi():
+    """Whether this process was started by an MPI launcher or has imported mpi4py.MPI."""
+    return "mpi4py.MPI" in sys.modules or any(
+        v in os.environ for v in LAUNCHER_VARIABLES
+    )
+
+
+def get_backend(backend=None):
+    """
+    The backend for the backend argument of Loader.
+
+    :param backend: A Backend, "serial", "mpi", "processes" for one worker
+                    process per core, an mpi4py communicator to run on,
+                    or None to use MPI only when launched by an MPI launcher
+    :return: A Backend
+    """
+    if isinstance(backend, Backend):
+        return backend
+    if hasattr(backend, "Get_size"):
+        return MPIBackend(backend)
+    if backend is None:
+        backend = "mpi" if launched_by_mpi() else "serial"
+    if backend == "serial":
+        return SerialBackend()
+    if backend == "mpi":
+        return MPIBackend()
+    if backend == "processes":
+        return ProcessBackend()
+    raise ValueError(
+        "backend must be a Backend, 'serial', 'mpi', 'processes' or a communicator"
+    )
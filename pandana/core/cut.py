@@ -1,49 +1,143 @@
 import pandas as pd
 
+from pandana.core import expression
+from pandana.core.indexing import align
+from pandana.core.segments import segment_reduce
+
+
+def _operand(other):
+    # other, or a Cut of it if it is a plain function of tables
+    return other if hasattr(other, "_key") else Cut(other)
+
 
 class Cut:
-    """Represents a selection criterion to be applied to a dataframe."""
+    """Represents a selection criterion to be applied to a dataframe.
+
+    Cuts combined with operators are identified by their structure,
+    so the same combination built twice is only evaluated once per Tables.
+    Cuts comparing Vars made with Var.column to constants, and combinations of
+    them on one group, are evaluated as a single kernel, see pandana.core.expression.
+    """
 
-    def __init__(self, cut):
+    def __init__(self, cut, name=None):
         self._cut = cut
+        # What this node is called in profiles, see name()
+        self._name = name
+
+        # Identifies this node among everything evaluated on a Tables
+        self._key = ("Cut", cut)
+        # The nodes this one is computed from, if built with operators
+        self._children = ()
+        # The expression this node computes, if built from columns
+        self._expr = None
+
+    @classmethod
+    def _derived(cls, cut, key, *children, expr=None):
+        node = cls(cut)
+        node._key = key
+        node._children = children
+        node._expr = expr
+        return node
+
+    def name(self):
+        """
+        What this cut is called in profiles: the name it was given, the name
+        of its function, or the operation and Cuts it was built from.
+        """
+        if self._name is not None:
+            return self._name
+        if self._children:
+            return "%s(%s)" % (self._key[0], ", ".join(c.name() for c in self._children))
+        return getattr(self._cut, "__name__", "Cut")
 
-        self._CurrDF = None
-        self._CurrTab = None
+    def terms(self):
+        """The Cuts this one is the & of, in the order they were combined."""
+        if self._key[0] == "and":
+            return [term for cut in self._children for term in cut.terms()]
+        return [self]
 
-    # Remember result for each instance of tables
+    def _compute(self, tables):
+        # The whole expression in one kernel, rather than one node after another
+        if self._children and self._expr is not None:
+            result = expression.compute(self._expr, tables)
+            if result is not None:
+                return result
+        return self._cut(tables)
+
+    # Results are kept by the evaluation context of tables, if it has one
     def __call__(self, tables):
-        if tables is not self._CurrTab:
-            self._CurrDF = self._cut(tables)
-            self._CurrTab = tables
-        return self._CurrDF
+        evaluate = getattr(tables, "evaluate", None)
+        if evaluate is None:
+            return self._compute(tables)
+        return evaluate(self)
 
     def __invert__(self):
-        return Cut(lambda tables: ~self(tables))
+        return Cut._derived(
+            lambda tables: ~self(tables),
+            ("invert", self._key),
+            self,
+            expr=expression.combine("invert", self._expr),
+        )
 
     def __and__(self, other):
+        other = _operand(other)
+
         def AndCut(tables):
             df1 = self(tables)
             df2 = other(tables)
 
             if not df1.index.equals(df2.index):
-                df2, df1 = df2.align(df1, axis=0, join="inner")
+                df2, df1 = align(df2, df1, join="inner")
             ret = df1.to_numpy() & df2.to_numpy()
             ret = pd.Series(ret, index=df1.index)
 
             return ret
 
-        return Cut(AndCut)
+        return Cut._derived(
+            AndCut,
+            ("and", self._key, other._key),
+            self,
+            other,
+            expr=expression.combine("and", self._expr, other._expr),
+        )
 
     def __or__(self, other):
+        other = _operand(other)
+
         def OrCut(tables):
             df1 = self(tables)
             df2 = other(tables)
 
             if not df1.index.equals(df2.index):
-                df2, df1 = df2.align(df1, axis=0, join="inner")
+                df2, df1 = align(df2, df1, join="inner")
             ret = df1.to_numpy() | df2.to_numpy()
             ret = pd.Series(ret, index=df1.index)
 
             return ret
 
-        return Cut(OrCut)
+        return Cut._derived(
+            OrCut,
+            ("or", self._key, other._key),
+            self,
+            other,
+            expr=expression.combine("or", self._expr, other._expr),
+        )
+
+    def _reduce(self, how, levels):
+        levels = tuple(levels)
+        return Cut._derived(
+            lambda tables: segment_reduce(self(tables), levels, how, tables),
+            (how, self._key, levels),
+            self,
+        )
+
+    # Reductions to one value per distinct value of the given leading index levels,
+    # e.g. from one row per prong to one row per event with levels=KL
+    def any(self, levels):
+        return self._reduce("any", levels)
+
+    def all(self, levels):
+        return self._reduce("all", levels)
+
+    def first(self, levels):
+        return self._reduce("first", levels)
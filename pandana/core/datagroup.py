@@ -1,11 +1,99 @@
+import copy
+
+import numpy as np
 import pandas as pd
 
+from pandana import utils
+from pandana.utils import profiling
+from pandana.core.segments import segment_offsets
+
+
+def read_dataset(ds, begin_row, end_row):
+    """
+    Read rows [begin_row, end_row) of an h5py.Dataset.
+    A single element per row becomes a 1-D array without copying.
+    If more than one element is in the dataset per row,
+    the (nrows, k) array is kept as is.
+    """
+    dataset = ds[begin_row:end_row]
+    if dataset.shape[1] == 1:
+        dataset = dataset.reshape(-1)
+    return dataset
+
+
+def read_rows(ds, begin_row, end_row, rows):
+    """
+    Read the given rows, counted from begin_row, of rows [begin_row, end_row)
+    of an h5py.Dataset, decompressing only the HDF5 chunks holding some of them.
+
+    :param rows: A sorted array of row offsets
+    :return: An array as from read_dataset, of the given rows only
+    """
+    begin_row = 0 if begin_row is None else begin_row
+    if rows.size == 0:
+        return read_dataset(ds, begin_row, begin_row)
+    absolute = rows + begin_row
+    parts = [
+        read_dataset(ds, lo, hi)[absolute[start:end] - lo]
+        for start, end, lo, hi in chunk_runs(ds, begin_row, end_row, rows)
+    ]
+    return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def chunk_runs(ds, begin_row, end_row, rows):
+    """
+    The runs of consecutive HDF5 chunks of ds holding the given rows,
+    counted from begin_row, of rows [begin_row, end_row).
+
+    :param rows: A sorted, non-empty array of row offsets
+    :return: A list of (first, last) positions in rows and the
+             [begin, end) rows of ds of each run
+    """
+    begin_row = 0 if begin_row is None else begin_row
+    end_row = ds.shape[0] if end_row is None else end_row
+    chunk_rows = ds.chunks[0] if ds.chunks is not None else end_row - begin_row
+
+    chunks = (rows + begin_row) // chunk_rows
+    starts = np.flatnonzero(np.r_[True, np.diff(chunks) > 1])
+    ends = np.r_[starts[1:], rows.size]
+    return [
+        (
+            int(start),
+            int(end),
+            max(int(chunks[start]) * chunk_rows, begin_row),
+            min((int(chunks[end - 1]) + 1) * chunk_rows, end_row),
+        )
+        for start, end in zip(starts, ends)
+    ]
+
 
 class DataGroup:
-    """Represents a group in an hdf5 file"""
+    """Represents a group in an hdf5 file
+
+    Columns are kept as numpy arrays, one per dataset, in the order they were read.
+    Datasets with one element per row are 1-D arrays,
+    datasets with k elements per row are 2-D (nrows, k) arrays.
+    pandas objects are only built when asked for through __getitem__.
+    """
 
-    def __init__(self, h5pyfile, group, begin_evt, end_evt, idcol, indices):
+    def __init__(
+        self,
+        h5pyfile,
+        group,
+        begin_evt,
+        end_evt,
+        idcol,
+        indices,
+        rows=None,
+        pool=None,
+        cache=None,
+    ):
         self._group = h5pyfile.get(group)
+        self._idcol = idcol
+        # When set, columns are read into buffers of this BufferPool
+        self._pool = pool
+        # When set, columns are memory-mapped from this ColumnCache
+        self._cache = cache
 
         # The dataframe indices are a subet of all available indices
         # Primary loop is over the available indices to keep a consistent order
@@ -14,69 +102,290 @@ class DataGroup:
         # the event range is None with only 1 mpi process
         self._begin_row, self._end_row = begin_evt, end_evt
 
+        # An explicit row range takes precedence over the event range
+        if rows is not None:
+            self._begin_row, self._end_row = rows
         # Otherwise compute the row range for this group
-        if begin_evt is not None and end_evt is not None:
-            event_seq_numbers = self._group[idcol][()].flatten()
-            self._begin_row, self._end_row = event_seq_numbers.searchsorted(
-                [begin_evt, end_evt + 1]
-            )
+        elif begin_evt is not None and end_evt is not None:
+            with profiling.section("search", group):
+                event_seq_numbers = self._group[idcol][()].flatten()
+                self._begin_row, self._end_row = event_seq_numbers.searchsorted(
+                    [begin_evt, end_evt + 1]
+                )
+
+        # name -> numpy array for every column read so far
+        self._columns = {}
+        # The pandas index, built from the index columns on first use
+        self._pdindex = None
+        # Segment offsets of the leading index levels, by number of levels
+        self._offsets = {}
 
-        self._df = None
+        # Every key asked for through __getitem__, in order of first access
+        self._accessed = []
+
+        # When set by select(), the rows of the row range this group holds,
+        # taken from the columns loaded by the parent group where it has them
+        self._selection = None
+        self._parent = None
+        # The columns such a group read from the file itself
+        self._selectionReads = []
 
     def readDatasetFromGroup(self, datasetname):
         # Determine range to be read here.
         # Regardless of the dataset, we want to read all the entries corresponding to the range of events
         # (not runs, subruns, or subevents, but events) we are to process.
         # dataset is a numpy.array, not a h5py.Dataset.
+        if self._selection is not None:
+            return self._readSelection(datasetname)
         ds = self._group.get(datasetname)  # ds is a h5py.Dataset
-        dataset = ds[self._begin_row : self._end_row]
+        if profiling.active() is None:
+            return self._read(ds)
+        with profiling.section("read", ds.name.lstrip("/"), nbytes=self._readBytes(ds)):
+            return self._read(ds)
+
+    def _read(self, ds):
+        if self._cache is not None:
+            # A view of the memory-mapped column, read from disk when used
+            return read_dataset(self._cache.column(ds), self._begin_row, self._end_row)
+        if self._pool is not None:
+            return utils.buffers.read_direct(ds, self._begin_row, self._end_row, self._pool)
+        return read_dataset(ds, self._begin_row, self._end_row)
+
+    def _readSelection(self, datasetname):
+        loaded = self._parent._columns.get(datasetname)
+        if loaded is None and self._parent._selection is None:
+            ds = self._group.get(datasetname)
+            with profiling.section("read", ds.name.lstrip("/")):
+                self._selectionReads.append(datasetname)
+                if self._cache is not None:
+                    # A memory-mapped column has no chunks, only the rows used are read
+                    column = read_dataset(self._cache.column(ds), self._begin_row, self._end_row)
+                    return column[self._selection]
+                return read_rows(ds, self._begin_row, self._end_row, self._selection)
+        if loaded is None:
+            loaded = self._parent.array(datasetname)
+        return loaded[self._selection]
+
+    def select(self, rows):
+        """
+        A group of only the given rows of this one, for late materialization:
+        its columns are taken from those this group has loaded, or else read
+        from the HDF5 chunks holding the given rows only.
+
+        :param rows: A sorted array of row offsets within this group's rows
+        :return: A DataGroup
+        """
+        group = copy.copy(self)
+        group._selection = rows
+        group._parent = self
+        # Selected rows are copies, never pooled buffers
+        group._pool = None
+        group._columns = {}
+        group._pdindex = None
+        group._offsets = {}
+        group._accessed = []
+        group._selectionReads = []
+        return group
+
+    def selectionReadBytes(self):
+        """
+        The bytes decompressed and the bytes used by the columns this group,
+        made by select(), read from the file itself rather than its parent.
+
+        :return: (bytes decompressed, bytes used)
+        """
+        decompressed, used = 0, 0
+        if self._selection is None or self._selection.size == 0:
+            return decompressed, used
+        for k in self._selectionReads:
+            ds = self._group[k]
+            rowbytes = ds.dtype.itemsize * int(np.prod(ds.shape[1:], dtype=np.int64))
+            runs = chunk_runs(ds, self._begin_row, self._end_row, self._selection)
+            decompressed += sum(hi - lo for _, _, lo, hi in runs) * rowbytes
+            used += self._selection.size * rowbytes
+        return decompressed, used
+
+    def _readBytes(self, ds):
+        # (bytes on disk, bytes decompressed) of reading the rows of this group from ds.
+        # Columns memory-mapped from a cache are read as stored.
+        if self._cache is not None:
+            used = utils.h5utils.chunk_read_bytes(ds, self._begin_row, self._end_row)[1]
+            return used, used
+        return (
+            utils.h5utils.chunk_storage_bytes(ds, self._begin_row, self._end_row),
+            utils.h5utils.chunk_read_bytes(ds, self._begin_row, self._end_row)[0],
+        )
+
+    def missing(self, keys):
+        """The index columns and keys of this group that are not loaded yet."""
+        available = self._group.keys()
+        return [
+            k
+            for k in dict.fromkeys(self._index + list(keys))
+            if not k in self._columns and k in available
+        ]
+
+    def rowRange(self):
+        """The (begin, end) rows of this group that are read, end being None for all."""
+        return self._begin_row, self._end_row
+
+    def seed(self, columns):
+        """
+        Take columns read elsewhere, e.g. by a background reader,
+        for the row range of this group.
+
+        :param columns: A dict of {name: numpy array}, as returned by read_dataset
+        :return: None
+        """
+        for k, values in columns.items():
+            if not k in self._columns:
+                self._columns[k] = values
 
-        if dataset.shape[1] == 1:
-            dataset = dataset.flatten()
-        # If more than one element is in the dataset per row,
-        # it is assumed we want a single column with the data as a list
-        else:
-            dataset = list(dataset)
+    def prefetch(self, keys):
+        """
+        Read all of keys, and the index columns, that are not loaded yet.
+        Keys that are not in this group are ignored.
+
+        :return: None
+        """
+        for k in self.missing(keys):
+            self._columns[k] = self.readDatasetFromGroup(k)
+
+    def release(self):
+        """
+        Drop every column read so far, giving pooled buffers back to the pool.
+        Nothing built from this group may be used afterwards.
+
+        :return: None
+        """
+        if self._pool is not None:
+            self._pool.recycle(self._columns.values())
+        self._columns = {}
+        self._pdindex = None
+        self._offsets = {}
+
+    def array(self, key):
+        """
+        Access a data member of this h5 group as a numpy array.
+        The array is the buffer held by this group, not a copy.
+
+        :return: A 1-D np.ndarray, or a 2-D (nrows, k) one for multi-element datasets
+        """
+        if not key in self._columns:
+            if not key in self._group.keys():
+                raise KeyError(key)
+            self.prefetch([key])
+        return self._columns[key]
+
+    def arrays(self, keys):
+        """
+        Access several data members at once as a dict of numpy arrays.
+        Like __getitem__, this records the keys as accessed.
+        """
+        self._access(keys)
+        self.prefetch(keys)
+        return {k: self.array(k) for k in keys}
+
+    def pandasIndex(self):
+        """The pandas index shared by every Series and DataFrame built from this group."""
+        if self._pdindex is None and self._selection is not None:
+            # Taking rows of the parent's index is cheaper than building one
+            if self._parent._pdindex is not None:
+                self._pdindex = self._parent._pdindex[self._selection]
+        if self._pdindex is None:
+            self.prefetch([])
+            levels = [self._columns[k] for k in self._index]
+            if len(levels) == 1:
+                self._pdindex = pd.Index(levels[0], name=self._index[0])
+            else:
+                self._pdindex = pd.MultiIndex.from_arrays(levels, names=self._index)
+        return self._pdindex
 
-        return dataset
+    def eventKeys(self):
+        """
+        The event key of each row: the uint64 id column,
+        which is unique per event within a file and sorted.
+        """
+        return self.array(self._idcol)
+
+    def subobjectOrdinals(self):
+        """The position of each row among the rows of its event."""
+        keys = self.eventKeys()
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        sizes = np.diff(np.r_[starts, keys.size])
+        return np.arange(keys.size) - np.repeat(starts, sizes)
+
+    def segmentOffsets(self, levels):
+        """
+        The offsets of the runs of rows sharing the values of the given index levels,
+        which must be the leading levels of this group's index.
+        Computed once per group from the index columns.
+
+        :return: An array [0, start_1, ..., nrows], or None if levels do not lead the index
+        """
+        nlevels = len(levels)
+        if list(levels) != self._index[:nlevels]:
+            return None
+        if not nlevels in self._offsets:
+            self.prefetch([])
+            self._offsets[nlevels] = segment_offsets(
+                [self._columns[k] for k in self._index[:nlevels]]
+            )
+        return self._offsets[nlevels]
+
+    def _columnNames(self, key):
+        # The DataFrame column names for a multi-element dataset
+        return ["%s[%d]" % (key, i) for i in range(self._columns[key].shape[1])]
+
+    def _toPandas(self, key):
+        values = self.array(key)
+        if values.ndim == 1:
+            return pd.Series(values, index=self.pandasIndex(), name=key, copy=False)
+        return pd.DataFrame(
+            values, index=self.pandasIndex(), columns=self._columnNames(key), copy=False
+        )
 
     def __getitem__(self, key):
         """
         Access a data member of this h5 group as a dataframe
         key can be a single key or a list of keys to access multiple columns at once
 
+        A multi-element dataset becomes one column per element, named key[i].
+
         :return: A pd.Series or pd.DataFrame
         """
+        keys = key if isinstance(key, list) else [key]
+        self._access(keys)
 
-        # If this is the first time this group is being accessed,
-        # gather the key values together with the index values
-        # and create the DataFrame
-        if self._df is None:
-            if isinstance(key, list):
-                values = {k: self.readDatasetFromGroup(k) for k in self._index + key}
-            else:
-                values = {k: self.readDatasetFromGroup(k) for k in self._index + [key]}
-            self._df = pd.DataFrame(values)
-            self._df.set_index(self._index, inplace=True, drop=False)
-        # Otherwise populate each new key
-        else:
-            if isinstance(key, list):
-                for k in key:
-                    if not k in self._df:
-                        values = self.readDatasetFromGroup(k)
-                        self._df[k] = values
-            else:
-                if not key in self._df:
-                    values = self.readDatasetFromGroup(key)
-                    self._df[key] = values
+        # Read every key that is not loaded yet together with the index values
+        self.prefetch(keys)
+
+        if not isinstance(key, list):
+            return self._toPandas(key)
+        if not key:
+            return pd.DataFrame(index=self.pandasIndex())
+        return pd.concat([self._toPandas(k) for k in key], axis=1)
 
-        return self._df[key]
+    def to_frame(self):
+        """All the columns read so far as a single DataFrame."""
+        if not self._columns:
+            return pd.DataFrame()
+        return pd.concat([self._toPandas(k) for k in self._columns], axis=1)
 
     def __str__(self):
-        return self._df.__str__()
+        return self.to_frame().__str__()
 
     def keys(self):
         return self._group.keys()
 
     def index(self):
         return self._index
+
+    def _access(self, keys):
+        for k in keys:
+            if not k in self._accessed:
+                self._accessed.append(k)
+
+    def accessed(self):
+        """The keys asked for from this group so far."""
+        return list(self._accessed)
@@ -0,0 +1,87 @@
+from pandana.utils import profiling
+
+
+def const_key(val):
+    """The part of a node key standing for a constant operand."""
+    try:
+        hash(val)
+    except TypeError:
+        # Unhashable constants (arrays, lists) are only shared by identity.
+        # The node holding val keeps it alive, so its id stays unique.
+        return ("id", id(val))
+    return ("const", type(val).__name__, val)
+
+
+def count_consumers(nodes):
+    """
+    Count how many times the result of each node is used.
+
+    Each entry of nodes counts as one use of it, and every distinct node
+    reachable from them counts as one use of each of its children.
+    Nodes with the same structural key are the same node.
+
+    :param nodes: the Vars and Cuts used directly, e.g. by spectra
+    :return: A dict of {node key: number of consumers}
+    """
+    consumers = {}
+    visited = set()
+    pending = []
+    for node in nodes:
+        key = getattr(node, "_key", None)
+        if key is None:
+            continue
+        consumers[key] = consumers.get(key, 0) + 1
+        pending.append(node)
+
+    while pending:
+        node = pending.pop()
+        if node._key in visited:
+            continue
+        visited.add(node._key)
+        for child in node._children:
+            consumers[child._key] = consumers.get(child._key, 0) + 1
+            pending.append(child)
+
+    return consumers
+
+
+class EvalContext:
+    """The results of the Vars and Cuts evaluated on one Tables.
+
+    Each node is evaluated at most once, however many structurally identical
+    copies of it are used. With consumer counts from count_consumers,
+    a result is dropped as soon as its last consumer has used it.
+    """
+
+    def __init__(self, consumers=None):
+        self._results = {}
+        self._consumers = dict(consumers) if consumers else {}
+
+    def evaluate(self, node, tables):
+        key = node._key
+        if key in self._results:
+            return self._results[key]
+
+        if profiling.active() is None:
+            result = node._compute(tables)
+        else:
+            with profiling.section("evaluate", node.name()):
+                result = node._compute(tables)
+        # Computing this node was the use its children were counted for
+        for child in node._children:
+            self.release(child)
+
+        self._results[key] = result
+        return result
+
+    def release(self, node):
+        """Record that one consumer of node is done with its result."""
+        key = node._key
+        if not key in self._consumers:
+            return
+        self._consumers[key] -= 1
+        if self._consumers[key] <= 0:
+            self._results.pop(key, None)
+
+    def clear(self):
+        self._results = {}
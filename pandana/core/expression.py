@@ -0,0 +1,283 @@
+"""Expression trees of Vars and Cuts built from columns, evaluated as one kernel.
+
+A Var made with Var.column(group, column) records the column it reads.
+Vars and Cuts built from such Vars and scalar constants with arithmetic,
+comparison and logical operators record the tree of operations they
+compute. When every column of a tree is in the same group, the whole tree
+is evaluated in one pass over the raw numpy columns of that group: by a
+kernel compiled with numexpr when it is installed, otherwise by numpy
+ufuncs writing into the temporaries they already made. Either way no
+intermediate pandas objects are built and nothing is aligned, since the
+columns of a group share its index.
+
+Trees mixing groups, or using Vars and Cuts made from arbitrary functions,
+are evaluated node by node, with alignment, as before.
+
+An expression is a nested tuple:
+    ("column", group, column)
+    ("const", value)
+    (operation, operand, ...) with an operation of OPERATIONS
+"""
+import numpy as np
+import pandas as pd
+
+from pandana.core.evaluation import const_key
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+# The ufunc of each operation, matching the pandas operators of Var and Cut
+OPERATIONS = {
+    "add": np.add,
+    "sub": np.subtract,
+    "mul": np.multiply,
+    "truediv": np.true_divide,
+    "eq": np.equal,
+    "ne": np.not_equal,
+    "lt": np.less,
+    "le": np.less_equal,
+    "gt": np.greater,
+    "ge": np.greater_equal,
+    "and": np.bitwise_and,
+    "or": np.bitwise_or,
+    "invert": np.invert,
+}
+
+# The numexpr operator of each operation
+_SYMBOLS = {
+    "add": "+",
+    "sub": "-",
+    "mul": "*",
+    "truediv": "/",
+    "eq": "==",
+    "ne": "!=",
+    "lt": "<",
+    "le": "<=",
+    "gt": ">",
+    "ge": ">=",
+    "and": "&",
+    "or": "|",
+    "invert": "~",
+}
+
+# The column types numexpr computes with as they are
+_NUMEXPR_TYPES = (np.bool_, np.int32, np.int64, np.float32, np.float64)
+
+# Below this many rows the fixed cost of a numexpr call outweighs its gain
+NUMEXPR_MIN_ROWS = 4096
+
+# "numexpr" or "numpy", see set_engine
+_engine = "numexpr" if numexpr is not None else "numpy"
+
+# The numexpr kernel of each expression and column types evaluated so far
+_kernels = {}
+
+
+def engine():
+    """The engine fused expressions are evaluated with, "numexpr" or "numpy"."""
+    return _engine
+
+
+def set_engine(name):
+    """
+    Evaluate fused expressions with numexpr, which must be installed, or numpy.
+
+    :return: None
+    """
+    global _engine
+    if not name in ("numexpr", "numpy"):
+        raise ValueError("engine must be 'numexpr' or 'numpy'")
+    if name == "numexpr" and numexpr is None:
+        raise ValueError("numexpr is not installed")
+    _engine = name
+
+
+def column(group, name):
+    return ("column", group, name)
+
+
+def constant(value):
+    """The expression of a constant operand, or None if it is not a scalar number."""
+    if isinstance(value, (bool, int, float, np.bool_, np.integer, np.floating)):
+        return ("const", value)
+    return None
+
+
+def combine(operation, *operands):
+    """
+    The expression of operation on operands, or None if it cannot be fused:
+    some operand has no expression, or the columns are in several groups.
+    """
+    if any(e is None for e in operands):
+        return None
+    expr = (operation,) + operands
+    if len(groups(expr)) != 1:
+        return None
+    return expr
+
+
+def groups(expr):
+    """The set of groups the columns of expr are in."""
+    if expr[0] == "column":
+        return {expr[1]}
+    if expr[0] == "const":
+        return set()
+    return set().union(*(groups(e) for e in expr[1:]))
+
+
+def columns(expr):
+    """The columns expr reads, in order of first use."""
+    if expr[0] == "column":
+        return [expr[2]]
+    if expr[0] == "const":
+        return []
+    return list(dict.fromkeys(c for e in expr[1:] for c in columns(e)))
+
+
+# The name a Series keeps through an operation with a constant
+_ANY = object()
+
+
+def result_name(expr):
+    """The name of the Series the operators of pandas would give for expr."""
+    if expr[0] == "column":
+        return expr[2]
+    if expr[0] == "const":
+        return _ANY
+    # Cut.__and__ and Cut.__or__ make an unnamed Series
+    if expr[0] in ("and", "or"):
+        return None
+    names = [n for n in (result_name(e) for e in expr[1:]) if n is not _ANY]
+    if not names:
+        return _ANY
+    return names[0] if all(n == names[0] for n in names) else None
+
+
+def _evaluate(expr, arrays):
+    # (values, whether they are a temporary made here that may be overwritten)
+    if expr[0] == "column":
+        return arrays[expr[2]], False
+    if expr[0] == "const":
+        return expr[1], False
+
+    operands = [_evaluate(e, arrays) for e in expr[1:]]
+    ufunc = OPERATIONS[expr[0]]
+    values = [v for v, _ in operands]
+    # The type of the result, from the same operation on no rows
+    dtype = ufunc(*[v[:0] if isinstance(v, np.ndarray) else v for v in values]).dtype
+    for v, temporary in operands:
+        if temporary and v.dtype == dtype:
+            return ufunc(*values, out=v), True
+    return ufunc(*values), True
+
+
+# Operations on booleans only
+_LOGICAL = ("and", "or", "invert")
+
+
+def _kernel(expr, dtypes):
+    # The numexpr source of expr, with columns as variables c0, c1, ... and
+    # constants as typed scalars k0, k1, ..., or None where an operation would
+    # promote its operands in numpy, as numexpr could then compute in other types
+    names = {c: "c%d" % i for i, c in enumerate(columns(expr))}
+    constants = {}
+
+    def visit(e):
+        # (source, dtype) of e, or None
+        if e[0] == "column":
+            dtype = np.dtype(dtypes[e[2]])
+            return (names[e[2]], dtype) if dtype.type in _NUMEXPR_TYPES else None
+
+        operands = [None if o[0] == "const" else visit(o) for o in e[1:]]
+        known = [o for o in operands if o is not None]
+        if len(known) != len([o for o in e[1:] if o[0] != "const"]):
+            return None
+        dtype = known[0][1]
+        if any(d != dtype for _, d in known):
+            return None
+        if (e[0] in _LOGICAL) != (dtype == np.bool_):
+            return None
+
+        sources = []
+        for o, visited in zip(e[1:], operands):
+            if visited is not None:
+                sources.append(visited[0])
+                continue
+            try:
+                if np.result_type(dtype, o[1]) != dtype:
+                    return None
+            except (OverflowError, TypeError):
+                return None
+            name = "k%d" % len(constants)
+            constants[name] = dtype.type(o[1])
+            sources.append(name)
+
+        result = OPERATIONS[e[0]](*[np.empty(0, dtype)] * len(sources)).dtype
+        if e[0] == "invert":
+            return "(~%s)" % sources[0], result
+        return "(%s %s %s)" % (sources[0], _SYMBOLS[e[0]], sources[1]), result
+
+    visited = visit(expr)
+    if visited is None:
+        return None
+    return visited[0], names, constants
+
+
+def _kernel_key(expr):
+    # expr with the type of each constant, as 1 == 1.0 == True would
+    # otherwise share a kernel that casts them to the type of the first
+    if expr[0] == "column":
+        return expr
+    if expr[0] == "const":
+        return const_key(expr[1])
+    return (expr[0],) + tuple(_kernel_key(e) for e in expr[1:])
+
+
+def evaluate(expr, arrays):
+    """
+    Evaluate expr in one pass over arrays, with the engine set by set_engine.
+    numexpr is only used where it computes in the same types as numpy,
+    so both engines give the same values.
+
+    :param arrays: A dict of {column name: 1-D numpy array} of the same length
+    :return: A numpy array, of the type the numpy operators would give
+    """
+    nrows = len(next(iter(arrays.values())))
+    if _engine == "numexpr" and nrows >= NUMEXPR_MIN_ROWS:
+        key = (_kernel_key(expr), tuple((c, a.dtype) for c, a in arrays.items()))
+        if not key in _kernels:
+            _kernels[key] = _kernel(expr, {c: a.dtype for c, a in arrays.items()})
+        kernel = _kernels[key]
+        if kernel is not None:
+            source, names, constants = kernel
+            variables = {names[c]: a for c, a in arrays.items()}
+            variables.update(constants)
+            return numexpr.evaluate(source, variables)
+    return _evaluate(expr, arrays)[0]
+
+
+def compute(expr, tables):
+    """
+    Evaluate expr on the columns of its group in tables.
+
+    :return: A pd.Series indexed like the group, or None if expr cannot be
+             evaluated as one kernel there, e.g. on multi-element columns
+    """
+    (group,) = groups(expr)
+    group = tables[group]
+    if not hasattr(group, "arrays"):
+        return None
+    arrays = group.arrays(columns(expr))
+    if any(a.ndim != 1 for a in arrays.values()):
+        return None
+
+    name = result_name(expr)
+    return pd.Series(
+        evaluate(expr, arrays),
+        index=group.pandasIndex(),
+        name=None if name is _ANY else name,
+        copy=False,
+    )
@@ -0,0 +1,201 @@
+"""Align Series and DataFrames by packed integer keys.
+
+The index levels two objects share are packed into one uint64 per row,
+and rows are matched with a sorted integer merge.
+This replaces pandas' MultiIndex join for the alignments done by the
+Var and Cut algebra: one object's levels must be a subset of the other's,
+as with a per-event cut applied to per-slice rows.
+Anything else falls back to pandas.
+"""
+import numpy as np
+
+from pandana.utils.profiling import profiled
+
+
+def level_values(index, name):
+    """The values of level name of index, one per row, as a numpy array."""
+    if index.nlevels == 1:
+        return index.to_numpy()
+    i = index.names.index(name)
+    return index.levels[i].to_numpy().take(index.codes[i])
+
+
+def _level_range(index, name):
+    # The smallest and largest value a level can take, without looking at every row
+    if index.nlevels == 1:
+        values = index
+    else:
+        values = index.levels[index.names.index(name)]
+    if values.dtype.kind not in "iub":
+        return None
+    if index.nlevels > 1 and np.any(index.codes[index.names.index(name)] < 0):
+        return None
+    return int(values.min()), int(values.max())
+
+
+def packing(indices, names):
+    """
+    Work out how to pack levels names of every index in indices into a uint64.
+
+    :return: A list of (name, offset, shift), or None if the levels are not
+             integers or do not fit in 64 bits.
+    """
+    layout = []
+    shift = 0
+    for name in reversed(names):
+        ranges = [_level_range(index, name) for index in indices]
+        if any(r is None for r in ranges):
+            return None
+        lo = min(r[0] for r in ranges)
+        hi = max(r[1] for r in ranges)
+        layout.append((name, lo, shift))
+        shift += (hi - lo).bit_length()
+    if shift > 64:
+        return None
+    return layout[::-1]
+
+
+def pack(index, layout):
+    """Pack the levels of index into one uint64 key per row, following layout."""
+    keys = np.zeros(len(index), dtype=np.uint64)
+    for name, offset, shift in layout:
+        values = level_values(index, name).astype(np.int64) - offset
+        keys |= values.astype(np.uint64) << np.uint64(shift)
+    return keys
+
+
+def match(keys, lookup):
+    """
+    Find each of keys in lookup, which must not have duplicates.
+
+    :return: (found, rows): rows of keys that are in lookup,
+             and the row of lookup each of them matches. None if lookup has duplicates.
+    """
+    if lookup.size > 1 and np.all(lookup[1:] > lookup[:-1]):
+        order = None
+        ordered = lookup
+    else:
+        order = np.argsort(lookup, kind="stable")
+        ordered = lookup[order]
+        if np.any(ordered[1:] == ordered[:-1]):
+            return None
+
+    pos = np.searchsorted(ordered, keys)
+    if ordered.size:
+        np.minimum(pos, ordered.size - 1, out=pos)
+        found = ordered[pos] == keys
+    else:
+        found = np.zeros(keys.size, dtype=bool)
+
+    rows = pos[found]
+    if order is not None:
+        rows = order[rows]
+    return np.flatnonzero(found), rows
+
+
+def _names(index):
+    names = list(index.names)
+    if None in names or len(set(names)) != len(names):
+        return None
+    return names
+
+
+def _take(df, rows, index):
+    # rows of df relabelled with index
+    return df.iloc[rows].set_axis(index, axis=0)
+
+
+@profiled("align")
+def align(left, right, join="inner", fill_value=None):
+    """
+    Align two Series or DataFrames on their rows, like left.align(right, axis=0, ...).
+
+    join="inner" keeps the rows whose keys are in both, labelled with the index
+    of the object having more levels (left's if they have the same levels).
+    join="right" labels left with right's index, filling missing rows with fill_value.
+
+    :return: (left, right) with identical indices
+    """
+    lnames, rnames = _names(left.index), _names(right.index)
+    if (
+        join in ("inner", "right")
+        and lnames is not None
+        and rnames is not None
+        and len(left) > 0
+        and len(right) > 0
+    ):
+        # The finer object has every level of the coarser one
+        common = None
+        if set(lnames) <= set(rnames) and (join == "right" or set(lnames) < set(rnames)):
+            left_is_fine, common = False, lnames
+        elif set(rnames) <= set(lnames) and join == "inner":
+            left_is_fine, common = True, rnames
+
+        if common is not None:
+            fine, coarse = (left, right) if left_is_fine else (right, left)
+            layout = packing([fine.index, coarse.index], common)
+            matched = None
+            if layout is not None:
+                matched = match(pack(fine.index, layout), pack(coarse.index, layout))
+            if matched is not None:
+                if join == "right":
+                    return _reindexed(left, right, matched, fill_value), right
+                fine, coarse = _inner(fine, coarse, matched)
+                return (fine, coarse) if left_is_fine else (coarse, fine)
+
+    if fill_value is None:
+        return left.align(right, axis=0, join=join)
+    return left.align(right, axis=0, join=join, fill_value=fill_value)
+
+
+def _inner(fine, coarse, matched):
+    # The matched rows of both, labelled with the index of fine
+    fine_rows, coarse_rows = matched
+    if fine_rows.size == len(fine):
+        index = fine.index
+    else:
+        index = fine.index[fine_rows]
+        fine = fine.iloc[fine_rows]
+    return fine, _take(coarse, coarse_rows, index)
+
+
+def _reindexed(left, right, matched, fill_value):
+    # left put on every row of right, with fill_value where it has no match
+    right_rows, left_rows = matched
+    if right_rows.size == len(right):
+        return _take(left, left_rows, right.index)
+
+    values = left.to_numpy()
+    if fill_value is None:
+        fill_value = np.nan
+    filled = np.full(
+        (len(right),) + values.shape[1:],
+        fill_value,
+        dtype=np.result_type(values.dtype, np.min_scalar_type(fill_value)),
+    )
+    filled[right_rows] = values[left_rows]
+    if left.ndim == 1:
+        return left._constructor(filled, index=right.index, name=left.name)
+    return left._constructor(filled, index=right.index, columns=left.columns)
+
+
+@profiled("align")
+def align_all(objs):
+    """
+    Align several Series or DataFrames on the rows whose keys are in all of them,
+    labelled with the index of the one having the most levels.
+    The levels of each must be a subset of that one's, as for align.
+
+    :return: A list of objs with identical indices
+    """
+    objs = list(objs)
+    ref = objs[0]
+    for i in range(1, len(objs)):
+        if not ref.index.equals(objs[i].index):
+            ref, objs[i] = align(ref, objs[i], join="inner")
+    objs[0] = ref
+    # Earlier objects may have more rows than later ones kept
+    for i in range(1, len(objs)):
+        if not objs[i].index.equals(ref.index):
+            objs[i], _ = align(objs[i], ref, join="right")
+    return objs
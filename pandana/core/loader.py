@@ -1,17 +1,124 @@
+import numpy as np
+
+from pandana import utils
+from pandana.utils import profiling
+from pandana.utils.buffers import BufferPool
+from pandana.utils.profiling import Profiler
+from pandana.core.backends import get_backend
+from pandana.core.prefetch import Prefetcher
 from pandana.core.tables import Tables
 
 
 class Loader:
     """A class for accessing data in h5py files."""
 
-    def __init__(self, files, idcol, main_table_name, indices):
+    def __init__(
+        self,
+        files,
+        idcol,
+        main_table_name,
+        indices,
+        chunk_events=None,
+        partition="events",
+        group_weights=None,
+        event_space="file",
+        prefetch=None,
+        align_chunks=False,
+        reuse_buffers=False,
+        cache=None,
+        distributed=False,
+        gather_events=False,
+        profile=False,
+        backend=None,
+        short_circuit=False,
+    ):
+        if isinstance(files, str):
+            files = [files]
         self._files = files
         self._idcol = idcol
         self._main_table_name = main_table_name
         self._indices = indices
 
+        # How the work is spread over processes: a Backend, "serial", "mpi",
+        # "processes", an mpi4py communicator, or None for MPI only under an
+        # MPI launcher.
+        # MPI is only initialized by an MPI backend.
+        self._backend = get_backend(backend)
+        self._comm = self._backend.comm
+
+        # When set, each file is streamed in blocks of at most this many events
+        self._chunk_events = chunk_events
+
+        # How the events of a file are split between MPI ranks:
+        #   "events": the same number of events per rank
+        #   "rows": about the same number of rows read per rank,
+        #           counted over the groups the spectra read
+        if not partition in ("events", "rows"):
+            raise ValueError("partition must be 'events' or 'rows'")
+        self._partition = partition
+        # The cost of one row of a group, by group name, for partition="rows".
+        # Defaults to the number of columns read from the group.
+        self._group_weights = group_weights if group_weights is not None else {}
+
+        # How work is spread over MPI ranks:
+        #   "file": every file is split between all ranks
+        #   "global": the events of all files are split as one sequence,
+        #             so each rank reads a contiguous range that may span files
+        if not event_space in ("file", "global"):
+            raise ValueError("event_space must be 'file' or 'global'")
+        if event_space == "global" and partition != "events":
+            raise ValueError("event_space='global' only supports partition='events'")
+        self._event_space = event_space
+
+        # When set, the columns of the next file or chunk are read in a
+        # background "thread" or "process" while the current one is processed
+        if prefetch is not None and not prefetch in Prefetcher.modes:
+            raise ValueError("prefetch must be None, 'thread' or 'process'")
+        self._prefetch = prefetch
+
+        # When set, rank and chunk boundaries are moved to HDF5 chunk boundaries
+        # of the group with the most data read, see Tables.alignChunks.
+        # With event_space="global" only chunk boundaries are moved.
+        self._align_chunks = align_chunks
+
+        # When set, columns are read into buffers reused from one file or chunk
+        # to the next. Results kept past a file must then go through Tables.keep.
+        self._pool = BufferPool() if reuse_buffers else None
+
+        # When set, a ColumnCache, or the directory of one, that columns are
+        # memory-mapped from after being decompressed once
+        if isinstance(cache, str):
+            # Imported here so that python -m pandana.utils.cache runs it fresh
+            from pandana.utils.cache import ColumnCache
+
+            cache = ColumnCache(cache)
+        self._cache = cache
+
+        # When set, spectra are summed over all ranks by Finish(),
+        # and with gather_events their events are collected on rank 0
+        self._distributed = distributed
+        self._gather_events = gather_events
+
+        # When set, the cut of each spectrum is applied one & term at a time,
+        # and later terms, the var and the weights only read and compute the
+        # events that passed the earlier terms, see Tables.passing. Columns are
+        # then read as they are needed rather than all at once.
+        self._short_circuit = short_circuit
+
+        # When set, a Profiler, or True for a new one, timing the stages of Go
+        # and the bytes read, see profileReport
+        if profile is True:
+            profile = Profiler()
+        self._profiler = profile or None
+
+        # Bytes decompressed and bytes used by this rank, see readAmplification
+        self._read_bytes = np.zeros(2, dtype=np.int64)
+
         self._specdefs = []
 
+        # The columns every spectrum reads, per group, found on the first file
+        self._columns = None
+
     def add_spectrum(self, spec):
         if not spec in self._specdefs:
             self._specdefs.append(spec)
@@ -21,21 +128,276 @@ class Loader:
         Iterate through the associated spectra and compute the cuts and vars for each
         :return: None
         """
-        for f in self._files:
-            # Construct the tables for this file
-            tables = Tables(
-                f, self._idcol, self._main_table_name, indices=self._indices
-            )
+        if self._profiler is None:
+            self._backend.go(self)
+        else:
+            with self._profiler.run():
+                self._backend.go(self)
 
-            # FILL ALL SPECTRA for this file
-            for spec in self._specdefs:
-                spec.fill(tables)
+    def backend(self):
+        """The execution Backend of this loader."""
+        return self._backend
 
-            tables.closeFile()
+    def run(self, work=None):
+        """
+        Fill the spectra from the files or chunks of this rank, then finish them.
+        This is what Go does on each rank of the backend.
 
+        :param work: see fill
+        :return: None
+        """
+        self.fill(work)
         self.Finish()
 
+    def fill(self, work=None):
+        """
+        Fill the spectra from the files or chunks of this rank, without finishing them.
+
+        :param work: A list of (file, (begin row, end row)) of the main table
+                     to fill from instead of the share of this rank
+        :return: None
+        """
+        prefetcher = None
+        if self._prefetch is not None:
+            prefetcher = Prefetcher(self._prefetch)
+
+        # While one file or chunk fills the spectra, the next one is read
+        pending = None
+        try:
+            for tables, done in self.units(work):
+                future = None
+                if prefetcher is not None:
+                    future = prefetcher.submit(tables, self._columns, self._cache)
+                if pending is not None:
+                    self.process(*pending)
+                pending = (tables, done, future)
+            if pending is not None:
+                self.process(*pending)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+
+    def units(self, work=None):
+        """
+        The files, or chunks of files, of this rank in order.
+
+        :param work: A list of (file, (begin row, end row)) of the main table
+                     to walk instead of the share of this rank
+        :return: A generator of (tables, [tables to close once it is processed])
+        """
+        if work is None and self._event_space == "global":
+            with profiling.section("search", "global"):
+                work = self.globalRowRanges()
+        elif work is None:
+            work = [(f, None) for f in self._files]
+
+        for f, rows in work:
+            with profiling.on_file(f):
+                tables = self.openTables(f, rows)
+                if self._chunk_events is not None:
+                    with profiling.section("search", "chunks"):
+                        chunks = list(tables.chunks(self._chunk_events))
+
+            if self._chunk_events is None:
+                yield tables, [tables]
+                continue
+
+            # The file is closed with its last chunk
+            for chunk in chunks[:-1]:
+                yield chunk, [chunk]
+            if chunks:
+                yield chunks[-1], [chunks[-1], tables]
+            else:
+                tables.closeFile()
+
+    def openTables(self, f, rows=None):
+        """
+        Open file f, or rows of its main table, and plan its reads.
+
+        :return: A Tables
+        """
+        tables = Tables(
+            f,
+            self._idcol,
+            self._main_table_name,
+            indices=self._indices,
+            rows=rows,
+            pool=self._pool,
+            cache=self._cache,
+            comm=self._comm,
+            short_circuit=self._short_circuit,
+            distribute=rows is None,
+        )
+
+        # Find every column the spectra need once
+        if self._columns is None:
+            self._columns = self.traceColumns(tables)
+        tables.plan([f for spec in self._specdefs for f in spec.inputs()])
+        with profiling.section("search", "distribute"):
+            if self._align_chunks:
+                tables.alignChunks(self._columns)
+            # One rank finds where every rank's rows are in each group
+            if rows is None:
+                tables.distributeRowRanges(
+                    list(self._columns),
+                    self.groupWeights() if self._partition == "rows" else None,
+                )
+        return tables
+
+    def process(self, tables, done, future=None):
+        """
+        Fill the spectra from tables, taking the columns read in the background
+        by future if there is one, then close everything in done.
+        :return: None
+        """
+        with profiling.on_file(tables.filename()):
+            if future is not None:
+                with profiling.section("read", "prefetched"):
+                    tables.seed(future.result())
+            self.fillSpectra(tables)
+            self._read_bytes += tables.readBytes()
+            for t in done:
+                t.closeFile()
+
+    def globalRowRanges(self, root=0):
+        """
+        Split the events of all files between MPI ranks as a single sequence.
+        The root rank counts the events in each file and broadcasts the counts.
+
+        :return: A list of (file, (begin row, end row)) of the main table for this rank
+        """
+        comm = self._comm
+        counts = np.empty(len(self._files), dtype=np.int64)
+        if comm.rank == root:
+            counts[:] = self.eventCounts()
+        utils.mpiutils.bcast_array(comm, counts, root=root)
+        return self.eventRanges(counts, comm.rank, comm.size)
+
+    def eventCounts(self):
+        """The number of events in each file, as an array."""
+        return np.array(
+            [Tables.countEvents(f, self._idcol, self._main_table_name) for f in self._files],
+            dtype=np.int64,
+        )
+
+    def eventRanges(self, counts, rank, size):
+        """
+        Share rank of size of the events of all files, taken as a single sequence.
+
+        :param counts: The number of events in each file, see eventCounts
+        :return: A list of (file, (begin row, end row)) of the main table
+        """
+        slices = utils.mpiutils.calculate_global_slices_for_rank(rank, size, counts)
+        return [(self._files[i], (begin, end)) for i, begin, end in slices]
+
+    def partial(self):
+        """
+        Take what was filled so far, leaving the spectra empty, to be merged
+        into the spectra of a copy of this loader in another process.
+
+        :return: A picklable dict, see merge
+        """
+        partial = {
+            "spectra": [spec._partial() for spec in self._specdefs],
+            "read_bytes": self._read_bytes.copy(),
+            "profile": None,
+        }
+        self._read_bytes[:] = 0
+        if self._profiler is not None:
+            partial["profile"] = self._profiler.records()
+            self._profiler.clear()
+        return partial
+
+    def merge(self, partial):
+        """
+        Add what another process filled, as taken by its partial(), to the spectra.
+
+        :return: None
+        """
+        for spec, filled in zip(self._specdefs, partial["spectra"]):
+            spec._merge(filled)
+        self._read_bytes += partial["read_bytes"]
+        if self._profiler is not None and partial["profile"] is not None:
+            self._profiler.merge(partial["profile"])
+
+    def readAmplification(self, mpigather=False, root=0):
+        """
+        How much more data than needed was decompressed by this rank,
+        over every file and chunk processed so far.
+        Reading part of an HDF5 chunk decompresses all of it.
+
+        :param mpigather: Collect the reports of all ranks on rank root
+        :return: A dict with the bytes "decompressed" and "used", and their ratio
+                 "amplification". With mpigather, a list of them by rank on root
+                 and None elsewhere.
+        """
+        decompressed, used = (int(n) for n in self._read_bytes)
+        report = {
+            "decompressed": decompressed,
+            "used": used,
+            "amplification": decompressed / used if used else 1.0,
+        }
+        if mpigather:
+            return self._comm.gather(report, root=root)
+        return report
+
+    def profiler(self):
+        """The Profiler of this loader, or None if it was not constructed with profile."""
+        return self._profiler
+
+    def profileReport(self, path=None, mpigather=False, root=0):
+        """
+        The time spent in each stage of Go, by file, stage and name,
+        with the bytes read and the peak RSS, see pandana.utils.profiling.
+
+        :param path: Also write the report there, as JSON if it ends with .json,
+                     otherwise the records as CSV
+        :param mpigather: Merge the reports of all ranks on rank root,
+                          with the load imbalance of each stage
+        :return: A dict, or None on ranks other than root with mpigather
+        """
+        if self._profiler is None:
+            raise ValueError("Construct the Loader with profile=True to profile Go.")
+        comm = self._comm if mpigather else None
+        if path is None:
+            return self._profiler.report(comm, root)
+        return self._profiler.write(path, comm, root)
+
+    def fillSpectra(self, tables):
+        """
+        Read each group in a single pass, then fill all the spectra from tables.
+        :return: None
+        """
+        if not self._short_circuit:
+            tables.prefetch(self._columns)
+
+        # FILL ALL SPECTRA for this file or chunk
+        for i, spec in enumerate(self._specdefs):
+            with profiling.section("fill", "%d %s" % (i, type(spec).__name__)):
+                spec.fill(tables)
+
+    def traceColumns(self, tables):
+        """
+        Collect the (group, column) pairs read by the cut, var and weight of every spectrum.
+
+        :return: A dict of {group name: [column names]}
+        """
+        funcs = [f for spec in self._specdefs for f in spec.inputs()]
+        return tables.traceColumns(funcs)
+
+    def groupWeights(self):
+        """The cost of one row of each group read by the spectra."""
+        return {
+            name: self._group_weights.get(name, len(columns))
+            for name, columns in self._columns.items()
+        }
+
     def Finish(self):
         # Combine together result for each file
-        for spec in self._specdefs:
-            spec.finish()
+        for i, spec in enumerate(self._specdefs):
+            with profiling.section("finish", "%d %s" % (i, type(spec).__name__)):
+                spec.finish(
+                    distributed=self._distributed,
+                    gather_events=self._gather_events,
+                    comm=self._comm,
+                )
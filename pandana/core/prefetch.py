@@ -0,0 +1,81 @@
+"""Read the columns of the next file or chunk while the current one is processed.
+
+The reads are planned on the main thread, where the row ranges of every
+group are known, and done by a single background worker that opens the
+file on its own. The worker only returns numpy arrays, so it can be a
+thread or a separate process.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import h5py
+
+from pandana.core.datagroup import read_dataset
+from pandana.utils import profiling
+from pandana.utils.h5utils import chunk_read_bytes, chunk_storage_bytes
+
+
+def read_columns(path, plan, cache=None):
+    """
+    Read the planned columns of file path.
+
+    :param plan: A dict of {group name: (begin row, end row, [column names])},
+                 as from Tables.readPlan
+    :param cache: A ColumnCache to read the columns through
+    :return: A dict of {group name: {column name: numpy array}}
+    """
+    arrays = {}
+    with h5py.File(path, "r") as f:
+        for name, (begin, end, keys) in plan.items():
+            group = f.get(name)
+            arrays[name] = {}
+            for k in keys:
+                ds = group.get(k)
+                nbytes = None
+                if profiling.active() is not None:
+                    nbytes = (
+                        chunk_storage_bytes(ds, begin, end),
+                        chunk_read_bytes(ds, begin, end)[0],
+                    )
+                with profiling.section("read", ds.name.lstrip("/"), path, nbytes):
+                    if cache is not None:
+                        ds = cache.column(ds)
+                    arrays[name][k] = read_dataset(ds, begin, end)
+    return arrays
+
+
+class Prefetcher:
+    """A background reader for the columns of Tables.
+
+    With mode="thread" the reads happen in a thread of this process.
+    h5py serializes its calls, so this mostly overlaps waiting on the
+    file system with the pandas and numpy work of filling spectra.
+    With mode="process" the reads and decompression happen in a separate
+    process and the arrays are copied back. As with any use of
+    multiprocessing, scripts need an ``if __name__ == "__main__":`` guard
+    on platforms that do not fork.
+    """
+
+    modes = ("thread", "process")
+
+    def __init__(self, mode="thread"):
+        if not mode in self.modes:
+            raise ValueError("prefetch must be one of %s" % (self.modes,))
+        if mode == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        else:
+            self._executor = ProcessPoolExecutor(max_workers=1)
+
+    def submit(self, tables, columns, cache=None):
+        """
+        Start reading the columns of tables in the background.
+
+        :param columns: A dict of {group name: [column names]}, as from traceColumns
+        :param cache: A ColumnCache to read the columns through
+        :return: A future of the arrays to give to tables.seed
+        """
+        return self._executor.submit(
+            read_columns, tables.filename(), tables.readPlan(columns), cache
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,157 @@
+"""Per-event reductions of subobject tables over contiguous row segments.
+
+Rows read from an h5 group are ordered by event, so the rows sharing the
+values of the leading index levels are contiguous. A reduction to those
+levels is then one pass over the segment offsets, with no hashing.
+"""
+import numpy as np
+import pandas as pd
+
+
+def segment_offsets(columns):
+    """
+    The offsets of the segments over which all of columns are constant.
+
+    :param columns: equally long 1-D arrays, e.g. the leading index columns
+    :return: An array [0, start_1, ..., start_k, nrows] of k+1 segments
+    """
+    nrows = columns[0].size if columns else 0
+    if nrows == 0:
+        return np.zeros(1, dtype=np.int64)
+    change = np.zeros(nrows - 1, dtype=bool)
+    for col in columns:
+        change |= col[1:] != col[:-1]
+    return np.concatenate(([0], np.flatnonzero(change) + 1, [nrows])).astype(np.int64)
+
+
+def index_offsets(index, nlevels):
+    """The segment offsets of the first nlevels levels of a pandas index."""
+    if index.nlevels == 1:
+        return segment_offsets([index.to_numpy()])
+    return segment_offsets([np.asarray(c) for c in index.codes[:nlevels]])
+
+
+def _nan(values):
+    # Where values are NaN, or None if none of them is
+    if values.dtype.kind != "f":
+        return None
+    nan = np.isnan(values)
+    return nan if nan.any() else None
+
+
+def _reduce_sum(values, offsets):
+    nan = _nan(values)
+    if nan is not None:
+        values = np.where(nan, 0, values)
+    return np.add.reduceat(values, offsets[:-1])
+
+
+def _reduce_prod(values, offsets):
+    nan = _nan(values)
+    if nan is not None:
+        values = np.where(nan, 1, values)
+    return np.multiply.reduceat(values, offsets[:-1])
+
+
+def _reduce_first(values, offsets):
+    nan = _nan(values)
+    if nan is None:
+        return values[offsets[:-1]]
+    # The first row that is not NaN, or NaN where there is none
+    nrows = values.shape[0]
+    rows = np.arange(nrows).reshape((-1,) + (1,) * (values.ndim - 1))
+    first = np.minimum.reduceat(np.where(nan, nrows, rows), offsets[:-1])
+    found = first < nrows
+    first = np.where(found, first, 0)
+    return np.where(found, np.take_along_axis(values, first, axis=0), np.nan)
+
+
+def _reduce_count(values, offsets):
+    nan = _nan(values)
+    if nan is None:
+        counts = np.diff(offsets)
+        if values.ndim == 1:
+            return counts
+        return np.repeat(counts[:, None], values.shape[1], axis=1)
+    return np.add.reduceat((~nan).astype(np.int64), offsets[:-1])
+
+
+def _reduce_any(values, offsets):
+    valid = values.astype(bool)
+    nan = _nan(values)
+    if nan is not None:
+        valid &= ~nan
+    return np.logical_or.reduceat(valid, offsets[:-1])
+
+
+def _reduce_all(values, offsets):
+    valid = values.astype(bool)
+    nan = _nan(values)
+    if nan is not None:
+        valid |= nan
+    return np.logical_and.reduceat(valid, offsets[:-1])
+
+
+# Like groupby, every reduction skips NaN
+REDUCTIONS = {
+    "sum": _reduce_sum,
+    "prod": _reduce_prod,
+    "min": lambda values, offsets: np.fmin.reduceat(values, offsets[:-1]),
+    "max": lambda values, offsets: np.fmax.reduceat(values, offsets[:-1]),
+    "first": _reduce_first,
+    "count": _reduce_count,
+    "any": _reduce_any,
+    "all": _reduce_all,
+}
+
+
+def _prefix_index(index, nlevels, starts):
+    # The index of the first row of each segment, keeping only the leading levels
+    if index.nlevels == 1:
+        return index[starts]
+    if nlevels == 1:
+        return pd.Index(index.levels[0].take(index.codes[0][starts]), name=index.names[0])
+    return pd.MultiIndex(
+        levels=index.levels[:nlevels],
+        codes=[c[starts] for c in index.codes[:nlevels]],
+        names=index.names[:nlevels],
+        verify_integrity=False,
+    )
+
+
+def segment_reduce(df, levels, how, tables=None):
+    """
+    Reduce df to one row per distinct value of its index levels,
+    like getattr(df.groupby(level=levels), how)().
+
+    levels must be the leading levels of the index of df. The segment offsets
+    come from the group df was read from when tables knows it, or else from
+    the index itself when it is sorted. Anything else falls back to groupby.
+    As with groupby, NaN values are skipped.
+
+    :param how: one of sum, prod, min, max, first, count, any, all
+    :return: A pd.Series or pd.DataFrame
+    """
+    levels = list(levels)
+    nlevels = len(levels)
+    index = df.index
+
+    offsets = None
+    if list(index.names[:nlevels]) == levels:
+        find = getattr(tables, "segmentOffsets", None)
+        if find is not None:
+            offsets = find(index, levels)
+        if offsets is None and index.is_monotonic_increasing:
+            offsets = index_offsets(index, nlevels)
+    if offsets is None:
+        return getattr(df.groupby(level=levels), how)()
+
+    starts = offsets[:-1]
+    newindex = _prefix_index(index, nlevels, starts)
+    if len(df) == 0:
+        return df.iloc[:0].set_axis(newindex, axis=0)
+
+    values = REDUCTIONS[how](df.to_numpy(), offsets)
+    if df.ndim == 1:
+        return pd.Series(values, index=newindex, name=df.name)
+    return pd.DataFrame(values, index=newindex, columns=df.columns)
@@ -1,24 +1,91 @@
 import pandas as pd
 import numpy as np
 import boost_histogram as bh
-from mpi4py import MPI
+import h5py
 
+from pandana.core import spectrumio
+from pandana.core.indexing import align, align_all, level_values
+from pandana.utils.mpiutils import (
+    SerialComm,
+    allreduce_sum,
+    gatherv_array,
+    reduce_sum,
+    world,
+)
 
-class Spectrum:
-    """Represents a histogram of some quantity."""
 
-    def __init__(self, loader, cut, var, weight=None):
+class Spectrum:
+    """Represents a histogram of some quantity.
+
+    Without axes, every selected event is kept and histograms are made
+    from the full list of events once it is complete.
+    Given boost-histogram axes up front, the spectrum is binned as it is filled
+    and the selected events are dropped, unless keep_events is set.
+    An exposure Var, such as the POT of each spill, is summed over all events
+    regardless of the cut.
+
+    var can also be a list of Vars, one per axis, for an N-D spectrum.
+    Their columns are aligned with each other and the cut, and fill the
+    histogram directly; the kept events are a DataFrame with one column per Var.
+    """
+
+    # The communicator of the ranks this spectrum was filled on, given to finish(),
+    # or None for MPI.COMM_WORLD
+    _comm = None
+    # The rank holding the events of all ranks, once gathered by finish
+    _events_root = None
+
+    def __init__(
+        self, loader, cut, var, weight=None, axes=None, keep_events=None, exposure=None
+    ):
         # Associate this spectrum with the loader
         loader.add_spectrum(self)
 
         self._cut = cut
         self._var = var
+        # The Vars of an N-D spectrum, or None
+        self._vars = list(var) if isinstance(var, (list, tuple)) else None
         self._wgt = weight
+        self._exposure_var = exposure
+
+        self._hist = None
+        if axes is not None:
+            if not isinstance(axes, list):
+                axes = [axes]
+            if self._vars is not None and len(axes) != len(self._vars):
+                raise ValueError("An N-D spectrum needs one axis per Var.")
+            self._hist = bh.Histogram(*axes, storage=bh.storage.Weight())
+        # Number of selected events, counted as they are filled
+        self._entries = 0
+        self._exposure = 0.0
+        # The entries, integral and exposure summed over all MPI ranks,
+        # once finish(distributed=True) has been called
+        self._totals = None
+
+        if keep_events is None:
+            keep_events = self._hist is None
+        self._keep_events = keep_events
 
         self._dfvars = []
         self._dfwgts = []
 
-    def fill(self, tables):
+    def inputs(self):
+        """The cut, var and weight this spectrum is filled from."""
+        variables = self._vars if self._vars is not None else [self._var]
+        return [
+            f
+            for f in [self._cut] + variables + [self._wgt, self._exposure_var]
+            if f is not None
+        ]
+
+    def _select(self, tables):
+        # The selected rows of the var, and the values to bin, one array per axis
+        if self._vars is not None:
+            dfvar, columns, names = self._selectColumns(tables)
+            if self._keep_events:
+                dfvar = pd.DataFrame(dict(zip(names, columns)), index=dfvar.index)
+            return dfvar, columns
+
         # Compute the var and complete cut
         dfvar = self._var(tables)
         dfcut = self._cut(tables)
@@ -26,110 +93,563 @@ class Spectrum:
         # We allow the cut to have any subset of the indices used in the var
         # The two dataframes need to be aligned in this case
         if not dfvar.index.equals(dfcut.index):
-            # When aligning, the cut and var have to be of the same type
-            if isinstance(dfvar, pd.DataFrame):
-                dfvar, dfcut = dfvar.align(dfcut.to_frame(), axis=0, join="inner")
-            else:
-                dfvar, dfcut = dfvar.align(dfcut, axis=0, join="inner")
+            dfvar, dfcut = align(dfvar, dfcut, join="inner")
         dfvar = dfvar.loc[dfcut.to_numpy()]
+        return dfvar, [dfvar.to_numpy()]
+
+    def fill(self, tables):
+        # The events the selected rows may be in, see Tables.passing
+        selected = tables.passing(self._cut)
+        dfvar, columns = self._select(selected)
 
         # Compute weights
         if self._wgt is not None:
-            dfwgt = self._wgt(tables)
+            dfwgt = self._wgt(selected)
             # align the weights to the var
             # TODO: Is 0 the right fill?
-            dfwgt, _ = dfwgt.align(dfvar, axis=0, join="right", fill_value=0)
+            dfwgt, _ = align(dfwgt, dfvar, join="right", fill_value=0)
         else:
             dfwgt = pd.Series(1, dfvar.index, name="weight")
 
-        self._dfvars.append(dfvar)
-        self._dfwgts.append(dfwgt)
-
-    def finish(self):
+        if self._exposure_var is not None:
+            self._exposure += float(np.sum(self._exposure_var(tables).to_numpy()))
+
+        # The results computed for this spectrum are no longer needed by it
+        self._release(tables, selected)
+
+        self._entries += dfvar.shape[0]
+        if self._hist is not None:
+            self._hist.fill(*columns, weight=dfwgt.to_numpy())
+
+        if self._keep_events:
+            # The events outlive the buffers the tables read into
+            self._dfvars.append(tables.keep(dfvar))
+            self._dfwgts.append(tables.keep(dfwgt))
+
+    def _release(self, tables, selected):
+        # The exposure is computed on all events, everything else on the selected ones
+        for f in self.inputs():
+            (tables if f is self._exposure_var else selected).release(f)
+
+    def _partial(self):
+        # What was filled so far, for another process to add with _merge,
+        # leaving this spectrum empty
+        partial = {
+            "entries": self._entries,
+            "exposure": self._exposure,
+            "hist": None if self._hist is None else self._hist.copy(),
+            "events": None,
+        }
+        if self._keep_events and self._dfvars:
+            partial["events"] = (pd.concat(self._dfvars), pd.concat(self._dfwgts))
+        self._entries = 0
+        self._exposure = 0.0
+        if self._hist is not None:
+            self._hist.reset()
+        self._dfvars = []
+        self._dfwgts = []
+        return partial
+
+    def _merge(self, partial):
+        # Add what another process filled, as taken by its _partial
+        self._entries += partial["entries"]
+        self._exposure += partial["exposure"]
+        if self._hist is not None:
+            self._hist += partial["hist"]
+        if partial["events"] is not None:
+            self._dfvars.append(partial["events"][0])
+            self._dfwgts.append(partial["events"][1])
+
+    def _selectColumns(self, tables):
+        # The selected values of each Var of an N-D spectrum as 1-D arrays,
+        # with names for them, and the first Var's selected rows, which carry their index
+        dfs = align_all([v(tables) for v in self._vars] + [self._cut(tables)])
+        mask = dfs[-1].to_numpy()
+        columns, names = [], []
+        for df in dfs[:-1]:
+            names.append(df.name if df.ndim == 1 else df.columns[0])
+            values = df.to_numpy()
+            if values.ndim == 2:
+                if values.shape[1] != 1:
+                    raise ValueError("Each Var of an N-D spectrum must have one column.")
+                values = values[:, 0]
+            columns.append(values[mask])
+        if None in names or len(set(names)) != len(names):
+            names = ["var%d" % i for i in range(len(names))]
+        return dfs[0].loc[mask], columns, names
+
+    def finish(self, distributed=False, gather_events=False, root=0, comm=None):
+        """
+        Combine what was filled from each file.
+
+        With distributed, the histogram, entries, integral and exposure are
+        summed over all ranks of comm with buffer-based Allreduce, so that every rank
+        holds the global results. This is collective.
+        With gather_events too, rank root also gets the events of all ranks,
+        in rank order, which is file order with event_space="global".
+        The other ranks keep their own.
+
+        :return: None
+        """
         assert len(self._dfvars) == len(self._dfwgts)
-        if len(self._dfvars) > 1:
-            self._df = pd.concat(self._dfvars, axis=0)
-            self._weight = pd.concat(self._dfwgts, axis=0)
+        if self._keep_events:
+            if len(self._dfvars) > 1:
+                self._df = pd.concat(self._dfvars, axis=0)
+                self._weight = pd.concat(self._dfwgts, axis=0)
+            else:
+                self._df = self._dfvars[0]
+                self._weight = self._dfwgts[0]
+
+        self._comm = comm
+        if distributed:
+            comm = self._communicator()
+            self._reduce(comm)
+            if gather_events and self._keep_events:
+                self._gatherEvents(comm, root)
+                self._events_root = root
+
+    def _communicator(self):
+        return self._comm if self._comm is not None else world()
+
+    def _reduce(self, comm):
+        # Sum the histogram and the summary numbers over all ranks
+        entries = allreduce_sum(comm, np.array([self.entries()], dtype=np.int64))
+        exposure = allreduce_sum(comm, np.array([self._exposure], dtype=np.float64))
+        # The integral of a MultiverseSpectrum is one number per universe
+        integral = np.asarray(self.integral(), dtype=np.float64)
+        integral = allreduce_sum(comm, integral.reshape(-1)).reshape(integral.shape)
+
+        if self._hist is not None:
+            view = self._hist.view(flow=True)
+            if view.dtype.names is None:
+                view[...] = allreduce_sum(comm, np.array(view))
+            else:
+                for field in view.dtype.names:
+                    view[field] = allreduce_sum(comm, np.array(view[field]))
+
+        self._totals = {
+            "entries": int(entries[0]),
+            "integral": integral if integral.ndim else float(integral),
+            "exposure": float(exposure[0]),
+        }
+
+    def _gatherEvents(self, comm, root):
+        # The events and weights of every rank, concatenated on root
+        index = self._df.index
+        levels = [gatherv_array(comm, level_values(index, n), root) for n in index.names]
+        if self._df.ndim == 1:
+            columns = {self._df.name: self._df.to_numpy()}
+        else:
+            columns = {c: self._df[c].to_numpy() for c in self._df.columns}
+        values = {c: gatherv_array(comm, v, root) for c, v in columns.items()}
+        weight = gatherv_array(comm, self._weight.to_numpy(), root)
+        if comm.rank != root:
+            return
+
+        if len(levels) == 1:
+            newindex = pd.Index(levels[0], name=index.names[0])
         else:
-            self._df = self._dfvars[0]
-            self._weight = self._dfwgts[0]
+            newindex = pd.MultiIndex.from_arrays(levels, names=index.names)
+        if self._df.ndim == 1:
+            self._df = pd.Series(values[self._df.name], index=newindex, name=self._df.name)
+        else:
+            self._df = pd.DataFrame(values, index=newindex)
+        self._weight = pd.Series(weight, index=newindex, name=self._weight.name)
+
+    def _checkEvents(self):
+        if not self._keep_events:
+            raise ValueError(
+                "This spectrum is binned only, construct it with keep_events=True "
+                "to keep the selected events."
+            )
 
     def df(self):
+        self._checkEvents()
         return self._df
 
     def weight(self):
+        self._checkEvents()
         return self._weight
 
+    def hist(self):
+        """The boost-histogram filled event by event, or None without axes."""
+        return self._hist
+
+    def _binAxes(self):
+        # The axes of the histogram the var is binned along
+        return self._hist.axes
+
     def entries(self):
+        if self._totals is not None:
+            return self._totals["entries"]
+        if not self._keep_events:
+            return self._entries
         return self._df.shape[0]
 
-    def histogram(self, bins, range=None, mpireduce=False, root=0):
-        n, bins = bh.numpy.histogram(
-            self._df, bins, range, weights=self._weight, storage=bh.storage.Double()
-        )
-
-        if mpireduce:
-            n = MPI.COMM_WORLD.reduce(n, MPI.SUM, root=root)
+    def histogram(self, bins=None, range=None, mpireduce=False, root=0):
+        # With mpireduce, the counts are summed over the ranks the spectrum was filled on
+        # Binned spectra already hold the histogram, unless new bins are asked for
+        # N-D spectra give a list of edges, one per axis
+        binned = bins is None and self._hist is not None
+        if binned:
+            n = self._hist.values()
+            bins = [axis.edges for axis in self._binAxes()]
+            if len(bins) == 1:
+                bins = bins[0]
+        else:
+            self._checkEvents()
+            if self._df.ndim == 2 and self._df.shape[1] > 1:
+                n, bins = bh.numpy.histogramdd(
+                    self._df.to_numpy(),
+                    bins,
+                    range,
+                    weights=self._weight,
+                    storage=bh.storage.Double(),
+                )
+            else:
+                n, bins = bh.numpy.histogram(
+                    self._df, bins, range, weights=self._weight, storage=bh.storage.Double()
+                )
+
+        if not mpireduce:
+            return n, bins
+        # The histogram of a distributed finish is already summed over ranks,
+        # and so are the events gathered on their root
+        if binned and self._totals is not None:
+            return n, bins
+        if not binned and self._events_root is not None:
+            if root != self._events_root:
+                raise ValueError(
+                    "The events were gathered on rank %d, not %d."
+                    % (self._events_root, root)
+                )
+            comm = self._communicator()
+            return (n if comm.rank == root else None), bins
+
+        n = reduce_sum(self._communicator(), np.asarray(n, dtype=np.float64), root)
 
         return n, bins
 
     def integral(self):
+        if self._totals is not None:
+            return self._totals["integral"]
+        if not self._keep_events:
+            return self._hist.sum(flow=True).value
         return self._weight.sum()
 
+    def exposure(self):
+        """The sum of the exposure Var over all events, e.g. the POT."""
+        if self._totals is not None:
+            return self._totals["exposure"]
+        return self._exposure
+
     def to_text(self, file_name, sep=" ", header=False):
+        self._checkEvents()
         self._df.to_csv(file_name, sep=sep, index=True, header=header)
 
     def __add__(self, other):
+        hist = None
+        if self._hist is not None and other._hist is not None:
+            hist = self._hist + other._hist
+        exposure = self.exposure() + other.exposure()
+        if not (self._keep_events and other._keep_events):
+            assert hist is not None, "Cannot add binned spectra without matching axes."
+            return FilledSpectrum(
+                None,
+                None,
+                hist=hist,
+                entries=self.entries() + other.entries(),
+                exposure=exposure,
+            )
         df = pd.concat([self._df, other._df])
         wgt = pd.concat([self._weight, other._weight])
-        return FilledSpectrum(df, wgt)
+        return FilledSpectrum(df, wgt, hist=hist, exposure=exposure)
+
+
+def _columns(df):
+    # The values of a Series or DataFrame as a 2-D array
+    values = df.to_numpy()
+    return values[:, None] if values.ndim == 1 else values
+
+
+class MultiverseSpectrum(Spectrum):
+    """A binned spectrum filled with many weights at once,
+    such as one per universe of a systematic variation.
+
+    weights is a list of weight Vars, or one Var giving a DataFrame with one
+    column of weights per universe, in which case nuniverses must be given.
+    The cut and var are computed and aligned once per file, and all universes
+    are filled by a single bincount over (universe, bin) pairs.
+    The histogram has a leading "universe" axis, so its values are
+    (nuniverses, bins...), and universe(i) is the histogram of one of them.
+    """
+
+    def __init__(
+        self, loader, cut, var, weights, axes, nuniverses=None, exposure=None
+    ):
+        super().__init__(loader, cut, var, axes=axes, keep_events=False, exposure=exposure)
+        if self._hist is None:
+            raise ValueError("A MultiverseSpectrum needs axes.")
+        if any(axis.traits.growth for axis in self._hist.axes):
+            raise ValueError("The axes of a MultiverseSpectrum cannot grow.")
+
+        if isinstance(weights, (list, tuple)):
+            self._wgts = list(weights)
+            nuniverses = len(self._wgts)
+        else:
+            if nuniverses is None:
+                raise ValueError("nuniverses is needed when weights is a single Var.")
+            self._wgts = None
+            self._wgt = weights
+        self._nuniverses = nuniverses
+
+        universe = bh.axis.Integer(
+            0, nuniverses, underflow=False, overflow=False, metadata="universe"
+        )
+        self._hist = bh.Histogram(universe, *self._hist.axes, storage=bh.storage.Weight())
+
+    def inputs(self):
+        return super().inputs() + (self._wgts or [])
+
+    def nuniverses(self):
+        return self._nuniverses
+
+    def universe(self, i):
+        """The histogram of universe i."""
+        return self._hist[(i,) + (slice(None),) * (self._hist.ndim - 1)]
+
+    def _binAxes(self):
+        return self._hist.axes[1:]
+
+    def fill(self, tables):
+        selected = tables.passing(self._cut)
+        dfvar, columns = self._select(selected)
+        weights = self._weightMatrix(selected, dfvar)
+
+        if self._exposure_var is not None:
+            self._exposure += float(np.sum(self._exposure_var(tables).to_numpy()))
+
+        self._release(tables, selected)
+
+        self._entries += dfvar.shape[0]
+        self._fillUniverses(columns, weights)
+
+    def _weightMatrix(self, tables, dfvar):
+        # The weights of every universe for the selected rows, as (rows, nuniverses)
+        if self._wgts is None:
+            dfwgt = self._wgt(tables)
+        else:
+            results = [w(tables) for w in self._wgts]
+            if all(r.index.equals(results[0].index) for r in results[1:]):
+                # Weights on the same rows are aligned together
+                dfwgt = pd.DataFrame(
+                    np.column_stack([_columns(r) for r in results]),
+                    index=results[0].index,
+                )
+            else:
+                dfwgt = None
+                weights = np.column_stack(
+                    [_columns(align(r, dfvar, join="right", fill_value=0)[0]) for r in results]
+                )
+
+        if dfwgt is not None:
+            dfwgt, _ = align(dfwgt, dfvar, join="right", fill_value=0)
+            weights = _columns(dfwgt)
+        if weights.shape[1] != self._nuniverses:
+            raise ValueError(
+                "Expected %d universes of weights, got %d."
+                % (self._nuniverses, weights.shape[1])
+            )
+        return weights.astype(np.float64, copy=False)
+
+    def _fillUniverses(self, columns, weights):
+        # The flow bin of each row, counting bins in the C order of the histogram view
+        bins = np.zeros(len(weights), dtype=np.intp)
+        inside = np.ones(len(weights), dtype=bool)
+        for axis, values in zip(self._binAxes(), columns):
+            index = np.asarray(axis.index(values), dtype=np.intp) + int(axis.traits.underflow)
+            inside &= (index >= 0) & (index < axis.extent)
+            bins = bins * axis.extent + index
+
+        view = self._hist.view(flow=True)
+        nbins = view[0].size
+        weights = weights[inside]
+        keys = (bins[inside, None] + np.arange(self._nuniverses) * nbins).ravel()
+        size = self._nuniverses * nbins
+        view["value"] += np.bincount(keys, weights.ravel(), size).reshape(view.shape)
+        view["variance"] += np.bincount(keys, (weights * weights).ravel(), size).reshape(
+            view.shape
+        )
+
+    def integral(self):
+        """The sum of the weights of each universe."""
+        if self._totals is not None:
+            return self._totals["integral"]
+        return self._hist.values(flow=True).reshape(self._nuniverses, -1).sum(axis=1)
 
 
 class FilledSpectrum(Spectrum):
-    """Construct a spectrum directly from a Series or DataFrame"""
+    """Construct a spectrum directly from a Series or DataFrame,
+    or from a filled boost-histogram with no events"""
 
-    def __init__(self, df, weight):
+    def __init__(self, df, weight, hist=None, entries=None, exposure=0.0):
         self._df = df
         self._weight = weight
+        self._hist = hist
+        self._keep_events = df is not None
+        self._entries = entries
+        self._exposure = exposure
+        self._totals = None
 
     def fill(self):
         print("This spectrum was constructed already filled.")
 
 
+class LoadedSpectrum(Spectrum):
+    """A spectrum read lazily from a file written by save_spectra.
+
+    Only its entries, integral and exposure are read up front. The histogram,
+    the events and the weights are each read the first time they are used,
+    and columns() reads only some of the value columns.
+    """
+
+    def __init__(self, filename, group, attrs, keep_events, ranks=None):
+        self._filename = filename
+        self._group = group
+        self._ranks = ranks
+        self._keep_events = keep_events
+        self._entries = attrs["entries"]
+        self._exposure = attrs["exposure"]
+        # The stored totals hold for all ranks only
+        self._totals = None
+        if ranks is None:
+            self._totals = {k: attrs[k] for k in ("entries", "integral", "exposure")}
+        self._read = {}
+
+    def _load(self, what, read):
+        if not what in self._read:
+            with h5py.File(self._filename, "r") as f:
+                self._read[what] = read(f)
+        return self._read[what]
+
+    @property
+    def _hist(self):
+        return self._load("hist", lambda f: spectrumio.read_hist(f, self._group))
+
+    @property
+    def _df(self):
+        return self._load(
+            "df",
+            lambda f: spectrumio.read_events(f, self._group, self._ranks, weights=False)[0],
+        )
+
+    @property
+    def _weight(self):
+        return self._load(
+            "weight",
+            lambda f: spectrumio.read_events(f, self._group, self._ranks, columns=[])[1],
+        )
+
+    def columns(self, names):
+        """Read only the given value columns of the events, as a DataFrame."""
+        self._checkEvents()
+        with h5py.File(self._filename, "r") as f:
+            return spectrumio.read_events(
+                f, self._group, self._ranks, columns=names, weights=False
+            )[0]
+
+    def fill(self):
+        print("This spectrum was loaded already filled.")
+
+
 # Save spectra to an hdf5 file. Takes a single or a list of spectra
-def save_spectra(filename, spectra, groups):
+def save_spectra(
+    filename,
+    spectra,
+    groups,
+    parallel=False,
+    events=True,
+    compression="gzip",
+    format="native",
+    comm=None,
+):
+    """
+    Save spectra to filename, one group per spectrum, in the pandana format of
+    spectrumio: histograms, entries, integral and exposure, and the events
+    of spectra that keep them when events is set, compressed column by column.
+
+    With parallel, every rank of comm, MPI.COMM_WORLD by default, writes what
+    it filled into the same file, see spectrumio.write_spectra. This is collective.
+    format="hdfstore" writes the events through pd.HDFStore instead.
+    """
     if not isinstance(spectra, list):
         spectra = [spectra]
     if not isinstance(groups, list):
         groups = [groups]
     assert len(spectra) == len(groups), "Each spectrum must have a group name."
 
+    if format == "native":
+        spectrumio.write_spectra(
+            filename,
+            spectra,
+            groups,
+            comm=(comm if comm is not None else world()) if parallel else SerialComm(),
+            events=events,
+            compression=compression,
+        )
+        return
+    assert format == "hdfstore", "format must be 'native' or 'hdfstore'"
+
+    # Only spectra that keep their events can be stored this way,
+    # checked before the file is truncated
+    for spectrum in spectra:
+        spectrum._checkEvents()
+
     # idk why we are giving things to the store
-    store = pd.HDFStore(filename, "w")
+    with pd.HDFStore(filename, "w") as store:
+        for spectrum, group in zip(spectra, groups):
+            store[group + "/dataframe"] = spectrum.df()
+            store[group + "/weights"] = spectrum.weight()
 
-    for spectrum, group in zip(spectra, groups):
-        store[group + "/dataframe"] = spectrum.df()
-        store[group + "/weights"] = spectrum.weight()
 
-    store.close()
+def load_spectra(filename, groups, ranks=None):
+    """
+    Load a spectrum from a file.
 
+    Spectra in the pandana format are LoadedSpectrum, which read their
+    histogram, events and weights only when used.
 
-def load_spectra(filename, groups):
-    """Load a spectrum from a file."""
+    :param ranks: For a file written with parallel=True, only read the events
+                  written by these MPI ranks
+    """
     if not isinstance(groups, list):
         groups = [groups]
 
-    # ah that's more like it
-    store = pd.HDFStore(filename, "r")
-
     ret = []
-    for group in groups:
-        df = store[group + "/dataframe"]
-        weight = store[group + "/weights"]
-
-        ret.append(FilledSpectrum(df, weight))
-
-    store.close()
+    if spectrumio.is_native(filename):
+        with h5py.File(filename, "r") as f:
+            for group in groups:
+                ret.append(
+                    LoadedSpectrum(
+                        filename,
+                        group,
+                        dict(f[group].attrs),
+                        spectrumio.has_events(f, group),
+                        ranks,
+                    )
+                )
+    else:
+        assert ranks is None, "Only files saved in the pandana format keep the ranks."
+        # ah that's more like it
+        store = pd.HDFStore(filename, "r")
+
+        for group in groups:
+            df = store[group + "/dataframe"]
+            weight = store[group + "/weights"]
+
+            ret.append(FilledSpectrum(df, weight))
+
+        store.close()
 
     if len(groups) == 1:
         return ret[0]
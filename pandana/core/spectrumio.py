@@ -0,0 +1,331 @@
+"""The pandana spectrum file format.
+
+Each spectrum is an h5 group with its entries, integral and exposure as
+attributes. A binned spectrum has a "hist" subgroup: one dataset per axis
+(its edges or categories, with the axis type and options as attributes)
+and one per field of the histogram storage, flow bins included.
+The selected events, when kept, are one compressed dataset per index level,
+one per value column and one for the weights, so any of them can be read
+without the others.
+
+Events can be written from all MPI ranks into one file. Every rank writes
+its own rows, at the offset given by an exclusive scan of the row counts,
+so nothing is gathered on one rank. The row range written by each rank is
+kept, so a subset of ranks can be read back.
+With an MPI build of h5py all ranks write the shared file at once
+through the mpio driver. Otherwise the root rank lays out the file
+and the ranks then write their rows in turn.
+"""
+import boost_histogram as bh
+import h5py
+import numpy as np
+import pandas as pd
+
+from pandana.core.indexing import level_values
+from pandana.utils.mpiutils import allreduce_sum, exscan_counts, world
+
+
+FORMAT = "pandana.spectrum"
+
+
+def is_native(filename):
+    """Whether filename was written by write_spectra."""
+    try:
+        with h5py.File(filename, "r") as f:
+            return f.attrs.get("format") == FORMAT
+    except OSError:
+        return False
+
+
+def _columns(spectrum):
+    # The index levels, value columns and weights of spectrum as (name, numpy array)
+    df = spectrum.df()
+    index = [(name, level_values(df.index, name)) for name in df.index.names]
+    if df.ndim == 1:
+        values = [(df.name, df.to_numpy())]
+    else:
+        values = [(c, df[c].to_numpy()) for c in df.columns]
+    weight = spectrum.weight()
+    return index, values, (weight.name, weight.to_numpy())
+
+
+def _fields(hist):
+    # {storage field: array} of the bins of hist, flow bins included
+    view = hist.view(flow=True)
+    if view.dtype.names is None:
+        return {"values": np.asarray(view)}
+    return {field: np.ascontiguousarray(view[field]) for field in view.dtype.names}
+
+
+def _summary(spectrum, comm):
+    # The entries, integral, exposure and histogram fields of spectrum over all ranks.
+    # A distributed finish already summed them.
+    hist = spectrum.hist()
+    fields = _fields(hist) if hist is not None else {}
+    sums = np.array([spectrum.entries(), spectrum.exposure()], dtype=np.float64)
+    # One integral per universe for a MultiverseSpectrum
+    integral = np.asarray(spectrum.integral(), dtype=np.float64)
+    if spectrum._totals is None and comm.size > 1:
+        sums = allreduce_sum(comm, sums)
+        integral = allreduce_sum(comm, integral.reshape(-1)).reshape(integral.shape)
+        fields = {k: allreduce_sum(comm, v) for k, v in fields.items()}
+    attrs = {
+        "entries": int(sums[0]),
+        "integral": integral if integral.ndim else float(integral),
+        "exposure": float(sums[1]),
+    }
+    return attrs, fields
+
+
+def _write_axis(g, path, axis):
+    # An axis as its edges or categories, with its type and options as attributes
+    kind = type(axis).__name__
+    if kind == "Regular" and axis.transform is not None:
+        kind = "Variable"
+    if kind in ("IntCategory", "StrCategory"):
+        data = list(axis)
+        if kind == "StrCategory":
+            data = np.array(data, dtype=h5py.string_dtype())
+    else:
+        data = axis.edges
+    ds = g.create_dataset(path, data=data)
+    ds.attrs["kind"] = kind
+    for trait in ("underflow", "overflow", "circular", "growth"):
+        ds.attrs[trait] = getattr(axis.traits, trait)
+    if isinstance(axis.metadata, str):
+        ds.attrs["metadata"] = axis.metadata
+
+
+def _read_axis(ds):
+    attrs = ds.attrs
+    kind = attrs["kind"]
+    metadata = attrs.get("metadata")
+    traits = {t: bool(attrs[t]) for t in ("underflow", "overflow", "circular", "growth")}
+    data = ds[()]
+    if kind == "Boolean":
+        return bh.axis.Boolean(metadata=metadata)
+    if kind in ("IntCategory", "StrCategory"):
+        if kind == "StrCategory":
+            data = [v.decode() if isinstance(v, bytes) else v for v in data]
+        return getattr(bh.axis, kind)(
+            list(data), metadata=metadata, growth=traits["growth"], overflow=traits["overflow"]
+        )
+    if kind == "Regular":
+        return bh.axis.Regular(len(data) - 1, data[0], data[-1], metadata=metadata, **traits)
+    if kind == "Integer":
+        return bh.axis.Integer(int(data[0]), int(data[-1]), metadata=metadata, **traits)
+    return bh.axis.Variable(data, metadata=metadata, **traits)
+
+
+def _write_hist(g, hist, fields, compression):
+    h = g.create_group("hist")
+    h.attrs["storage"] = hist.storage_type.__name__
+    for i, axis in enumerate(hist.axes):
+        _write_axis(h, "axes/%d" % i, axis)
+    for field, values in fields.items():
+        h.create_dataset("fields/" + field, data=values, compression=compression)
+
+
+def read_hist(f, group):
+    """
+    Read the histogram of a spectrum, without reading any of its events.
+
+    :return: A boost_histogram.Histogram, or None if the spectrum is not binned
+    """
+    if not "hist" in f[group]:
+        return None
+    h = f[group]["hist"]
+    axes = [_read_axis(h["axes"][k]) for k in sorted(h["axes"], key=int)]
+    hist = bh.Histogram(*axes, storage=getattr(bh.storage, h.attrs["storage"])())
+    view = hist.view(flow=True)
+    for field in h["fields"]:
+        if field == "values":
+            view[...] = h["fields"][field][()]
+        else:
+            view[field] = h["fields"][field][()]
+    return hist
+
+
+def _layout(f, groups, tables, compression):
+    # Create every group and dataset, identically on every rank that calls it
+    f.attrs["format"] = FORMAT
+    for group, (events, attrs, hist, fields) in zip(groups, tables):
+        g = f.create_group(group)
+        for key, value in attrs.items():
+            g.attrs[key] = value
+        if hist is not None:
+            _write_hist(g, hist, fields, compression)
+        if events is None:
+            continue
+
+        index, values, weight, rank_offsets, kind = events
+        g.attrs["kind"] = kind
+        g.create_dataset("rank_offsets", data=rank_offsets)
+        total = int(rank_offsets[-1])
+        for sub, arrays in (("index", index), ("values", values)):
+            for i, (name, array) in enumerate(arrays):
+                _create(g, "%s/%d" % (sub, i), name, array, total, compression)
+        _create(g, "weights", weight[0], weight[1], total, compression)
+
+
+def _create(g, path, name, array, total, compression):
+    # An empty dataset for total rows like those of array, remembering their name
+    ds = g.create_dataset(
+        path,
+        shape=(total,) + array.shape[1:],
+        dtype=array.dtype,
+        compression=compression if total else None,
+    )
+    ds.attrs["name"] = "" if name is None else str(name)
+
+
+def _write_rows(f, groups, tables, first_rows, collective=False):
+    # Write the events of this rank into the datasets made by _layout
+    for group, (events, _, _, _), first in zip(groups, tables, first_rows):
+        if events is None:
+            continue
+        index, values, weight, _, _ = events
+        g = f[group]
+        arrays = [("index/%d" % i, a) for i, (_, a) in enumerate(index)]
+        arrays += [("values/%d" % i, a) for i, (_, a) in enumerate(values)]
+        arrays.append(("weights", weight[1]))
+        for name, array in arrays:
+            ds = g[name]
+            if collective:
+                with ds.collective:
+                    ds[first : first + len(array)] = array
+            elif len(array):
+                ds[first : first + len(array)] = array
+
+
+def write_spectra(filename, spectra, groups, comm=None, events=True, compression="gzip"):
+    """
+    Write spectra, filled on every rank of comm, into one file.
+    This is collective: every rank must call it with the same groups.
+
+    Histograms, entries, integrals and exposures are summed over the ranks,
+    unless a distributed finish already did so. Each rank writes its own events.
+    Events gathered on one rank by a distributed finish would be written
+    twice; write those from that rank alone, with comm=SerialComm().
+
+    :param comm: An MPI communicator, MPI.COMM_WORLD by default
+    :param events: Also write the events of spectra that keep them
+    :param compression: The h5py compression of each column and histogram field.
+                        Not used when writing through the mpio driver.
+    :return: None
+    """
+    comm = world() if comm is None else comm
+    parallel = comm.size > 1 and h5py.get_config().mpi
+    if parallel:
+        compression = None
+
+    tables, first_rows = [], []
+    for spectrum in spectra:
+        attrs, fields = _summary(spectrum, comm)
+        stored = None
+        first = 0
+        if events and spectrum._keep_events:
+            index, values, weight = _columns(spectrum)
+            first, rank_offsets = exscan_counts(comm, len(weight[1]))
+            kind = "series" if spectrum.df().ndim == 1 else "frame"
+            stored = (index, values, weight, rank_offsets, kind)
+        tables.append((stored, attrs, spectrum.hist(), fields))
+        first_rows.append(first)
+
+    if comm.size == 1:
+        with h5py.File(filename, "w") as f:
+            _layout(f, groups, tables, compression)
+            _write_rows(f, groups, tables, first_rows)
+        return
+
+    if parallel:
+        with h5py.File(filename, "w", driver="mpio", comm=comm) as f:
+            _layout(f, groups, tables, compression)
+            # Collective writes need every rank to write something
+            collective = all(
+                np.diff(t[0][3]).min() > 0 for t in tables if t[0] is not None
+            )
+            _write_rows(f, groups, tables, first_rows, collective)
+        return
+
+    # Without parallel HDF5, each rank writes its rows once the one before it is done
+    token = np.zeros(1, dtype=np.int64)
+    if comm.rank == 0:
+        with h5py.File(filename, "w") as f:
+            _layout(f, groups, tables, compression)
+            _write_rows(f, groups, tables, first_rows)
+    else:
+        comm.Recv(token, source=comm.rank - 1)
+        with h5py.File(filename, "r+") as f:
+            _write_rows(f, groups, tables, first_rows)
+    if comm.rank + 1 < comm.size:
+        comm.Send(token, dest=comm.rank + 1)
+    comm.Barrier()
+
+
+def _read_rows(ds, ranges):
+    # The rows of ds in each of ranges, concatenated
+    parts = [ds[begin:end] for begin, end in ranges]
+    if not parts:
+        return ds[0:0]
+    return np.concatenate(parts)
+
+
+def has_events(f, group):
+    """Whether the events of a spectrum were written."""
+    return "weights" in f[group]
+
+
+def value_columns(f, group):
+    """The names of the value columns of the events of a spectrum."""
+    g = f[group]["values"]
+    return [g[k].attrs["name"] or None for k in sorted(g, key=int)]
+
+
+def read_events(f, group, ranks=None, columns=None, weights=True):
+    """
+    Read the events of a spectrum written by write_spectra.
+
+    :param f: An open h5py.File
+    :param ranks: the ranks whose events are read, all of them if None
+    :param columns: the value columns to read, all of them if None.
+                    A Series spectrum is then read as a DataFrame.
+    :param weights: also read the weights
+    :return: (df, weight), weight being None if not read
+    """
+    g = f[group]
+    rank_offsets = g["rank_offsets"][()]
+    if ranks is None:
+        ranks = range(len(rank_offsets) - 1)
+    ranges = [(rank_offsets[r], rank_offsets[r + 1]) for r in ranks]
+
+    def named(sub, wanted=None):
+        datasets = [g[sub][k] for k in sorted(g[sub], key=int)]
+        return [
+            (ds.attrs["name"] or None, _read_rows(ds, ranges))
+            for ds in datasets
+            if wanted is None or (ds.attrs["name"] or None) in wanted
+        ]
+
+    index = named("index")
+    names = [name for name, _ in index]
+    if len(index) == 1:
+        pdindex = pd.Index(index[0][1], name=names[0])
+    else:
+        pdindex = pd.MultiIndex.from_arrays([a for _, a in index], names=names)
+
+    values = named("values", columns)
+    if g.attrs["kind"] == "series" and columns is None:
+        name, array = values[0]
+        df = pd.Series(array, index=pdindex, name=name)
+    else:
+        df = pd.DataFrame({name: array for name, array in values}, index=pdindex)
+
+    weight = None
+    if weights:
+        weight = pd.Series(
+            _read_rows(g["weights"], ranges),
+            index=pdindex,
+            name=g["weights"].attrs["name"] or None,
+        )
+    return df, weight
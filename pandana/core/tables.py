@@ -1,27 +1,107 @@
+import copy
+import pickle
+
 import h5py
-from mpi4py import MPI
+import numpy as np
 
 from pandana import utils
+from pandana.utils import profiling
 from pandana.core.datagroup import DataGroup
+from pandana.core.backends import get_backend
+from pandana.core.evaluation import EvalContext, count_consumers
+from pandana.core.indexing import match, pack, packing
+
+
+def _sendable(error):
+    # error, or a RuntimeError describing it if it cannot be pickled
+    if error is None:
+        return None
+    try:
+        pickle.dumps(error)
+    except Exception:
+        return RuntimeError("%s: %s" % (type(error).__name__, error))
+    return error
 
 
 class Tables:
-    def __init__(self, f, idcol, main_table_name, indices):
-        self._file = h5py.File(f, "r")
+    # The fraction of its events a cut term must reject for passing() to
+    # evaluate the next terms on a view of the others
+    min_rejection = 0.25
+
+    def __init__(
+        self,
+        f,
+        idcol,
+        main_table_name,
+        indices,
+        rows=None,
+        pool=None,
+        cache=None,
+        comm=None,
+        short_circuit=False,
+        distribute=False,
+    ):
+        with profiling.section("open"):
+            self._file = h5py.File(f, "r")
+        # Views made by chunks() share the file but do not close it
+        self._owns_file = True
         self._idcol = idcol
         self._main_table_name = main_table_name
         self._indices = indices
 
-        # Compute the event range for this MPI rank
+        # When set, row ranges are found by bisecting each group's id column
+        # instead of reading it whole
+        self._bisect = False
+
+        # The communicator whose ranks split the events, that of the default
+        # backend if not given
+        self._comm = comm if comm is not None else get_backend().comm
+
+        # Compute the event range for this rank
         # Default to all the data
+        # With distribute, it is left to distributeRowRanges, which the caller
+        # must then call, so that only its root reads the id columns
         self._begin_evt, self._end_evt = None, None
-        comm = MPI.COMM_WORLD
-        if comm.size > 1:
+        comm = self._comm
+        if rows is not None:
+            # The events of the given rows of the main table, whichever the rank
+            ds = self._file.get(self._main_table_name)[self._idcol]
+            self._begin_evt, self._end_evt = ds[rows[0]].item(), ds[rows[1] - 1].item()
+            self._bisect = True
+        elif comm.size > 1 and not distribute:
             self._begin_evt, self._end_evt = self.calculateEventRange(
                 self._file.get(self._main_table_name), comm.rank, comm.size
             )
 
         self._keys = {}
+        # Row range of each group for this rank, when given by distributeRowRanges
+        self._rows = {}
+
+        # Number of consumers of each Var and Cut result, see plan()
+        self._consumers = None
+        self._context = EvalContext()
+
+        # When set, every group is accessed with an empty row range
+        self._empty = False
+
+        # (group name, rows per HDF5 chunk) whose chunks rank and
+        # chunk boundaries are moved to, see alignChunks()
+        self._align = None
+
+        # When set, groups read into buffers of this BufferPool,
+        # which are reused once closeFile() is called
+        self._pool = pool
+        # When set, groups memory-map their columns from this ColumnCache
+        self._cache = cache
+
+        # When set, cuts are applied one & term at a time by passing(), and
+        # later terms only see the events that passed the earlier ones
+        self._short_circuit = short_circuit
+        # The view of the events passing each term evaluated here, by term key
+        self._selections = {}
+        # For such a view, the tables it selects from and the event keys it keeps
+        self._parent = None
+        self._survivors = None
 
     def __getitem__(self, key):
         # An h5 file is assumed to be opened and
@@ -30,6 +110,9 @@ class Tables:
 
         # If this is the first time this group is being accessed,
         # initialize the group and store it with the table
+        if not key in self._keys and self._survivors is not None:
+            parent = self._parent[key]
+            self._keys[key] = parent.select(self._selectedRows(parent))
         if not key in self._keys:
             self._keys[key] = DataGroup(
                 self._file,
@@ -38,9 +121,314 @@ class Tables:
                 self._end_evt,
                 self._idcol,
                 self._indices,
+                rows=self.rowRange(key),
+                pool=self._pool,
+                cache=self._cache,
             )
         return self._keys[key]
 
+    def rowRange(self, key):
+        """
+        The explicit row range of group key for this view,
+        or None to let the group compute it from the event range.
+        """
+        if self._empty:
+            return (0, 0)
+        rows = self._rows.get(key)
+        if not self._bisect:
+            return rows
+
+        # Search within the rows of this rank when they are known
+        lo, hi = rows if rows is not None else (0, None)
+        ds = self._file.get(key)[self._idcol]
+        begin = utils.h5utils.searchsorted_dataset(ds, self._begin_evt, lo=lo, hi=hi)
+        end = utils.h5utils.searchsorted_dataset(ds, self._end_evt + 1, lo=begin, hi=hi)
+        return begin, end
+
+    def _view(self):
+        # A shallow copy sharing the open file, with no groups accessed
+        # and nothing evaluated yet
+        view = copy.copy(self)
+        view._keys = {}
+        view._context = EvalContext(self._consumers)
+        view._owns_file = False
+        view._selections = {}
+        return view
+
+    def passing(self, cut):
+        """
+        The events in which the rows passing cut may be, for late materialization.
+
+        Without short_circuit, these tables themselves. Otherwise the & terms of
+        cut are evaluated in order, each on a view of only the events in which
+        some row passed the terms before it, and the view after the last term
+        is returned. Evaluating cut, a var and weights on it then gives the
+        same selected rows as on these tables, while reading and computing
+        only the events still alive. This assumes, as the Var and Cut algebra
+        does, that the result for an event only depends on its own rows.
+        Views are shared by every cut starting with the same terms.
+
+        :return: A Tables
+        """
+        if not self._short_circuit:
+            return self
+        view = self
+        for term in cut.terms():
+            view = view._passingTerm(term)
+        return view
+
+    def _passingTerm(self, term):
+        # The view of the events of this one in which some row passes term
+        if not term._key in self._selections:
+            survivors = self._eventsWith(term(self))
+            view = self
+            # Every view builds the index of each group again, which only pays
+            # off when enough events are dropped
+            if survivors is not None and survivors.size <= (
+                1 - self.min_rejection
+            ) * len(self._eventKeys()):
+                view = self._view()
+                view._parent = self
+                view._survivors = survivors
+            self._selections[term._key] = view
+        return self._selections[term._key]
+
+    def _eventKeys(self):
+        # The key of each event, one per row of the main table
+        return self[self._main_table_name].eventKeys()
+
+    def _eventsWith(self, mask):
+        # The sorted keys of the events with some True row in mask,
+        # or None if mask cannot be matched to events
+        if mask.ndim != 1 or mask.dtype != bool:
+            return None
+        main = self[self._main_table_name]
+        levels = main.index()
+        if not set(levels) <= set(mask.index.names):
+            return None
+        passed = mask.index[mask.to_numpy()]
+        if len(passed) == 0:
+            return self._eventKeys()[:0]
+
+        events = main.pandasIndex()
+        layout = packing([events, passed], levels)
+        if layout is None:
+            return None
+        found, _ = match(pack(events, layout), np.unique(pack(passed, layout)))
+        return self._eventKeys()[found]
+
+    def _selectedRows(self, group):
+        # The rows of group, in the tables this view selects from, of the kept events
+        # The rows of each event are contiguous, as the keys are sorted
+        keys = group.eventKeys()
+        begin = np.searchsorted(keys, self._survivors, "left")
+        counts = np.searchsorted(keys, self._survivors, "right") - begin
+        return np.arange(counts.sum()) + np.repeat(begin - np.cumsum(counts) + counts, counts)
+
+    def plan(self, nodes):
+        """
+        Declare the Vars and Cuts that will be evaluated on these tables,
+        once for each time their result is used.
+        Intermediate results are then dropped as soon as they are no longer needed.
+
+        :return: None
+        """
+        self._consumers = count_consumers(nodes)
+        self._context = EvalContext(self._consumers)
+
+    def evaluate(self, node):
+        """Evaluate a Var or Cut, reusing its result if it was already computed here."""
+        return self._context.evaluate(node, self)
+
+    def release(self, node):
+        """Record that one planned use of the result of node is done."""
+        self._context.release(node)
+
+    def chunks(self, chunk_events):
+        """
+        Walk the event range of this rank in blocks of at most chunk_events events.
+        After alignChunks(), blocks end at a chunk boundary of the aligned group
+        where possible, so their sizes vary around chunk_events.
+
+        Each block is a fresh Tables view on the same file, whose groups only
+        read the rows of the events in the block. Row ranges are found without
+        reading whole id columns, so memory use depends on chunk_events only.
+
+        :return: A generator of Tables
+        """
+        ds = self._file.get(self._main_table_name)[self._idcol]
+        if self._begin_evt is None:
+            begin, end = 0, ds.shape[0]
+        else:
+            begin = utils.h5utils.searchsorted_dataset(ds, self._begin_evt)
+            end = utils.h5utils.searchsorted_dataset(ds, self._end_evt + 1, lo=begin)
+
+        first = begin
+        while first < end:
+            stop = min(first + chunk_events, end)
+            if stop < end:
+                stop = min(max(self.snapBoundary(stop, ds), first + 1), end)
+            chunk = self._view()
+            chunk._begin_evt, chunk._end_evt = ds[first].item(), ds[stop - 1].item()
+            chunk._bisect = True
+            yield chunk
+            first = stop
+
+    def traceColumns(self, funcs):
+        """
+        Find the columns each group needs to provide to evaluate funcs.
+
+        Each of funcs (Vars, Cuts or plain functions of a Tables) is evaluated
+        on an empty view of this file and the columns it asks for are recorded.
+        A function that fails on empty input contributes whatever it read
+        before failing; anything it misses is still read lazily later on.
+
+        :return: A dict of {group name: [column names]}
+        """
+        tracer = self._view()
+        tracer._empty = True
+        tracer._pool = None
+        tracer._cache = None
+
+        for func in funcs:
+            try:
+                func(tracer)
+            except Exception:
+                pass
+
+        columns = {}
+        for name, group in tracer._keys.items():
+            if group.accessed():
+                columns[name] = group.accessed()
+        return columns
+
+    def prefetch(self, columns):
+        """
+        Read the given columns of each group in one pass per group.
+
+        :param columns: A dict of {group name: [column names]}, as from traceColumns
+        :return: None
+        """
+        for name, keys in columns.items():
+            if name in self._file:
+                self[name].prefetch(keys)
+
+    def readPlan(self, columns):
+        """
+        Work out what prefetch(columns) would read, without reading it.
+
+        :return: A dict of {group name: (begin row, end row, [column names])}
+                 for read_columns
+        """
+        plan = {}
+        for name, keys in columns.items():
+            if name in self._file:
+                group = self[name]
+                missing = group.missing(keys)
+                if missing:
+                    plan[name] = group.rowRange() + (missing,)
+        return plan
+
+    def seed(self, arrays):
+        """
+        Hand columns read in the background to the groups of these tables.
+
+        :param arrays: A dict of {group name: {column name: array}}, as from read_columns
+        :return: None
+        """
+        for name, columns in arrays.items():
+            self[name].seed(columns)
+
+    def filename(self):
+        return self._file.filename
+
+    def segmentOffsets(self, index, levels):
+        """
+        The segment offsets of levels for a pandas index built by one of the
+        groups read here, or None if index did not come from one of them.
+        """
+        for group in self._keys.values():
+            if group._pdindex is index:
+                return group.segmentOffsets(levels)
+        return None
+
+    def alignChunks(self, columns):
+        """
+        Make rank and chunk boundaries fall on the HDF5 chunk boundaries of the group
+        with the most stored bytes among columns, so that neighbouring ranks and
+        chunks do not decompress the same chunks of it.
+        Nothing changes if that group is not chunked.
+
+        :param columns: A dict of {group name: [column names]}, as from traceColumns
+        :return: The name of the aligned group, or None
+        """
+        best, best_size, best_rows = None, -1, None
+        for name, keys in columns.items():
+            group = self._file.get(name)
+            if group is None:
+                continue
+            datasets = [group[k] for k in keys if k in group]
+            if not datasets:
+                continue
+            size = sum(ds.id.get_storage_size() for ds in datasets)
+            if size > best_size:
+                # The chunking of the largest dataset of the group
+                largest = max(datasets, key=lambda ds: ds.id.get_storage_size())
+                best, best_size = name, size
+                best_rows = utils.h5utils.chunk_rows(largest)
+
+        self._align = (best, best_rows) if best_rows else None
+        return self._align[0] if self._align else None
+
+    def snapBoundary(self, row, main, aligned=None):
+        """
+        Move a boundary between events, given as a row of the main table,
+        to the event whose first row in the aligned group is at or just before
+        the chunk boundary of that group closest to where the boundary was.
+
+        :param main: the id column of the main table, as a dataset or an array
+        :param aligned: the id column of the aligned group, read from the file if None
+        :return: The new row of the main table, or row if nothing is aligned
+        """
+        if self._align is None or row <= 0 or row >= main.shape[0]:
+            return row
+        name, rows = self._align
+        if aligned is None:
+            aligned = self._file.get(name)[self._idcol]
+
+        at = utils.h5utils.searchsorted_dataset(aligned, main[row].item())
+        snapped = int(round(at / rows)) * rows
+        if snapped >= aligned.shape[0]:
+            return row
+        return utils.h5utils.searchsorted_dataset(main, aligned[snapped].item())
+
+    def readBytes(self):
+        """
+        The bytes decompressed and the bytes used for all the columns read
+        through these tables so far, as counted by chunk_read_bytes.
+
+        :return: (bytes decompressed, bytes used)
+        """
+        decompressed, used = 0, 0
+        # The views of passing() read what their parent did not
+        for view in self._selections.values():
+            if view is not self:
+                d, u = view.readBytes()
+                decompressed += d
+                used += u
+        for group in self._keys.values():
+            if group._selection is not None:
+                d, u = group.selectionReadBytes()
+                decompressed += d
+                used += u
+                continue
+            begin, end = group.rowRange()
+            for k in group._columns:
+                d, u = utils.h5utils.chunk_read_bytes(group._group[k], begin, end)
+                decompressed += d
+                used += u
+        return decompressed, used
+
     def calculateEventRange(self, group, rank, nranks):
         assert group is not None
         begin, end = utils.mpiutils.calculate_slice_for_rank(
@@ -51,8 +439,147 @@ class Tables:
 
         return b, e
 
+    @staticmethod
+    def countEvents(f, idcol, main_table_name):
+        """The number of events in file f, without reading any data."""
+        with h5py.File(f, "r") as h5file:
+            return h5file.get(main_table_name)[idcol].shape[0]
+
+    def _idColumn(self, name, idcols):
+        # The whole id column of a group, read at most once per idcols dict
+        if not name in idcols:
+            idcols[name] = self._file.get(name)[self._idcol][()].reshape(-1)
+        return idcols[name]
+
+    def eventCosts(self, weights, idcols=None):
+        """
+        The cost of processing each event of the file: one for its row in the main table,
+        plus the weighted number of rows it has in each group.
+
+        :param weights: A dict of {group name: cost of one row}
+        :param idcols: A dict of id columns already read, by group name
+        :return: (event sequence numbers, costs), one entry per row of the main table
+        """
+        if idcols is None:
+            idcols = {}
+        seqs = self._idColumn(self._main_table_name, idcols)
+        costs = np.ones(seqs.size, dtype=np.float64)
+        for name, weight in weights.items():
+            if not name in self._file:
+                continue
+            rows = self._idColumn(name, idcols)
+            counts = np.searchsorted(rows, seqs, side="right") - np.searchsorted(
+                rows, seqs, side="left"
+            )
+            costs += weight * counts
+        return seqs, costs
+
+    def rowRangeTable(self, nranks, groups, weights=None):
+        """
+        Compute the event range of every rank and the row range of each of groups
+        within it, reading each id column once.
+
+        Without weights, every rank gets the same number of events.
+        With weights, every rank gets about the same cost, as given by eventCosts.
+        After alignChunks(), the boundaries between ranks are then moved
+        to chunk boundaries of the aligned group, keeping at least one event per rank.
+
+        :return: An int64 array with one row per rank: its first and last event,
+                 then the begin and end row of each group
+        """
+        idcols = {}
+        seqs = self._idColumn(self._main_table_name, idcols)
+        if weights is None:
+            bounds = [
+                utils.mpiutils.calculate_slice_for_rank(rank, nranks, seqs.size)
+                for rank in range(nranks)
+            ]
+        else:
+            _, costs = self.eventCosts(weights, idcols)
+            bounds = [
+                utils.mpiutils.calculate_weighted_slice_for_rank(rank, nranks, costs)
+                for rank in range(nranks)
+            ]
+        low, high = np.array(bounds).T
+        if self._align is not None:
+            aligned = self._idColumn(self._align[0], idcols)
+            for rank in range(1, nranks):
+                snapped = self.snapBoundary(low[rank], seqs, aligned)
+                low[rank] = min(max(snapped, low[rank - 1] + 1), seqs.size - (nranks - rank))
+            high[:-1] = low[1:]
+        begin_evt, end_evt = seqs[low], seqs[high - 1]
+
+        table = np.empty((nranks, 2 + 2 * len(groups)), dtype=np.int64)
+        table[:, 0] = begin_evt
+        table[:, 1] = end_evt
+        for i, name in enumerate(groups):
+            rows = self._idColumn(name, idcols)
+            table[:, 2 + 2 * i] = np.searchsorted(rows, begin_evt)
+            table[:, 3 + 2 * i] = np.searchsorted(rows, end_evt + 1)
+        return table
+
+    def distributeRowRanges(self, groups, weights=None, root=0):
+        """
+        Set the event range of this rank and the row range of each of groups,
+        as computed by rowRangeTable on the root rank only and scattered to all ranks.
+        Other ranks do not read any id column.
+        This is collective and must be called before any group is accessed.
+
+        :return: None
+        """
+        comm = self._comm
+        if comm.size == 1:
+            return
+        groups = [name for name in groups if name in self._file]
+
+        # Any failure of the root is raised on every rank, which would
+        # otherwise wait for the Scatter forever
+        table, error = None, None
+        if comm.rank == root:
+            try:
+                table = self.rowRangeTable(comm.size, groups, weights)
+            except Exception as e:
+                error = e
+        failed = comm.bcast(_sendable(error), root=root)
+        if error is not None:
+            raise error
+        if failed is not None:
+            raise failed
+
+        mine = np.empty(2 + 2 * len(groups), dtype=np.int64)
+        comm.Scatter(table, mine, root=root)
+
+        self._begin_evt, self._end_evt = int(mine[0]), int(mine[1])
+        self._rows = {
+            name: (int(mine[2 + 2 * i]), int(mine[3 + 2 * i]))
+            for i, name in enumerate(groups)
+        }
+
+    def keep(self, obj):
+        """
+        obj, copied if its values are in pooled buffers that closeFile() reuses.
+        Anything kept after the tables are closed must go through this.
+        """
+        if self._pool is None:
+            return obj
+        columns = [obj] if obj.ndim == 1 else [obj.iloc[:, i] for i in range(obj.shape[1])]
+        if any(self._pool.holds(c.to_numpy()) for c in columns):
+            return obj.copy(deep=True)
+        return obj
+
     def closeFile(self):
-        self._file.close()
+        # Release everything read and computed through this view,
+        # and the views of the events passing cuts made from it
+        for view in self._selections.values():
+            if view is not self:
+                view.closeFile()
+        self._selections = {}
+        self._context.clear()
+        for group in self._keys.values():
+            group.release()
+        self._keys = {}
+        if self._owns_file:
+            self._file.close()
 
     def keys(self):
         return self._file.keys()
@@ -1,6 +1,9 @@
 import pandas as pd
 
+from pandana.core import expression
 from pandana.core.cut import Cut
+from pandana.core.evaluation import const_key
+from pandana.core.segments import segment_reduce
 
 
 class Var:
@@ -9,47 +12,158 @@ class Var:
     A variable may be directly read from a dataframe,
     calulcated from one or more things that were read,
     or calculated from other Vars.
+
+    Vars combined with operators are identified by their structure,
+    so the same combination built twice is only evaluated once per Tables.
+    Vars made with Var.column, and everything built from them and constants
+    with operators, are evaluated as a single kernel on the columns of their
+    group, see pandana.core.expression.
     """
 
-    def __init__(self, var):
+    def __init__(self, var, name=None):
         self._var = var
-
-        self._CurrDF = None
-        self._CurrTab = None
-
-    # Remember result for each instance of tables
+        # What this node is called in profiles, see name()
+        self._name = name
+
+        # Identifies this node among everything evaluated on a Tables
+        self._key = ("Var", var)
+        # The nodes this one is computed from, if built with operators
+        self._children = ()
+        # The expression this node computes, if built from columns
+        self._expr = None
+
+    @classmethod
+    def column(cls, group, column, name=None):
+        """A Var reading one column of a group, as tables[group][column]."""
+        node = cls(lambda tables: tables[group][column], name)
+        node._key = ("column", group, column)
+        node._expr = expression.column(group, column)
+        return node
+
+    @classmethod
+    def _derived(cls, var, key, *children, expr=None):
+        node = cls(var)
+        node._key = key
+        node._children = children
+        node._expr = expr
+        return node
+
+    def name(self):
+        """
+        What this var is called in profiles: the name it was given, the name
+        of its function, or the operation and Vars it was built from.
+        """
+        if self._name is not None:
+            return self._name
+        if self._children:
+            return "%s(%s)" % (self._key[0], ", ".join(c.name() for c in self._children))
+        if self._key[0] == "column":
+            return self._key[2]
+        return getattr(self._var, "__name__", "Var")
+
+    def _compute(self, tables):
+        # The whole expression in one kernel, rather than one node after another
+        if self._children and self._expr is not None:
+            result = expression.compute(self._expr, tables)
+            if result is not None:
+                return result
+        return self._var(tables)
+
+    # Results are kept by the evaluation context of tables, if it has one
     def __call__(self, tables):
-        if tables is not self._CurrTab:
-            self._CurrDF = self._var(tables)
-            self._CurrTab = tables
-        return self._CurrDF
+        evaluate = getattr(tables, "evaluate", None)
+        if evaluate is None:
+            return self._compute(tables)
+        return evaluate(self)
+
+    def _compare(self, name, compare, val):
+        return Cut._derived(
+            lambda tables: compare(self(tables), val),
+            (name, self._key, const_key(val)),
+            self,
+            expr=expression.combine(name, self._expr, expression.constant(val)),
+        )
 
     def __eq__(self, val):
-        return Cut(lambda tables: self(tables) == val)
+        return self._compare("eq", lambda df, val: df == val, val)
 
     def __ne__(self, val):
-        return Cut(lambda tables: self(tables) != val)
+        return self._compare("ne", lambda df, val: df != val, val)
 
     def __lt__(self, val):
-        return Cut(lambda tables: self(tables) < val)
+        return self._compare("lt", lambda df, val: df < val, val)
 
     def __le__(self, val):
-        return Cut(lambda tables: self(tables) <= val)
+        return self._compare("le", lambda df, val: df <= val, val)
 
     def __gt__(self, val):
-        return Cut(lambda tables: self(tables) > val)
+        return self._compare("gt", lambda df, val: df > val, val)
 
     def __ge__(self, val):
-        return Cut(lambda tables: self(tables) >= val)
+        return self._compare("ge", lambda df, val: df >= val, val)
+
+    def _arith(self, name, op, other):
+        # other is a Var, a Cut, e.g. to weight by a mask, any other
+        # function of tables, or a constant
+        if callable(other) and not isinstance(other, (Var, Cut)):
+            other = Var(other)
+        if not isinstance(other, (Var, Cut)):
+            return Var._derived(
+                lambda tables: op(self(tables), other),
+                (name, self._key, const_key(other)),
+                self,
+                expr=expression.combine(name, self._expr, expression.constant(other)),
+            )
+        return Var._derived(
+            lambda tables: op(self(tables), other(tables)),
+            (name, self._key, other._key),
+            self,
+            other,
+            expr=expression.combine(name, self._expr, other._expr),
+        )
 
     def __add__(self, other):
-        return Var(lambda tables: self(tables) + other(tables))
+        return self._arith("add", lambda a, b: a + b, other)
 
     def __sub__(self, other):
-        return Var(lambda tables: self(tables) - other(tables))
+        return self._arith("sub", lambda a, b: a - b, other)
 
     def __mul__(self, other):
-        return Var(lambda tables: self(tables) * other(tables))
+        return self._arith("mul", lambda a, b: a * b, other)
 
     def __truediv__(self, other):
-        return Var(lambda tables: self(tables) / other(tables))
+        return self._arith("truediv", lambda a, b: a / b, other)
+
+    def _reduce(self, how, levels):
+        levels = tuple(levels)
+        return Var._derived(
+            lambda tables: segment_reduce(self(tables), levels, how, tables),
+            (how, self._key, levels),
+            self,
+        )
+
+    # Reductions to one value per distinct value of the given leading index levels,
+    # e.g. from one row per prong to one row per event with levels=KL
+    def sum(self, levels):
+        return self._reduce("sum", levels)
+
+    def prod(self, levels):
+        return self._reduce("prod", levels)
+
+    def min(self, levels):
+        return self._reduce("min", levels)
+
+    def max(self, levels):
+        return self._reduce("max", levels)
+
+    def first(self, levels):
+        return self._reduce("first", levels)
+
+    def count(self, levels):
+        return self._reduce("count", levels)
+
+    def any(self, levels):
+        return self._reduce("any", levels)
+
+    def all(self, levels):
+        return self._reduce("all", levels)
@@ -1,4 +1,6 @@
 """Make everything from submodules appear at the top level.
 """
+from pandana.utils.buffers import *
+from pandana.utils.h5utils import *
 from pandana.utils.mpiutils import *
 from pandana.utils.pandasutils import *
@@ -0,0 +1,87 @@
+"""This module provides reusable buffers for reading h5py datasets.
+"""
+import numpy as np
+
+
+class BufferPool:
+    """A pool of 1-D numpy buffers, reused from one file to the next.
+
+    take() hands out a view of a free buffer of the right dtype that is large
+    enough, or allocates one sized to the largest request seen for that dtype.
+    recycle() gives buffers back once nothing reads them any more.
+    Processing files of similar size then allocates nothing after the first one.
+    """
+
+    def __init__(self):
+        # dtype -> buffers not in use
+        self._free = {}
+        # id(buffer) -> buffer, for buffers handed out
+        self._taken = {}
+        # dtype -> largest number of elements asked for
+        self._largest = {}
+        # Number of buffers allocated so far
+        self.allocations = 0
+
+    def take(self, dtype, shape):
+        """
+        A C-contiguous array of the given dtype and shape, backed by a pooled buffer.
+
+        :return: An uninitialized np.ndarray
+        """
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape, dtype=np.int64))
+        largest = max(self._largest.get(dtype, 0), size)
+        self._largest[dtype] = largest
+
+        free = self._free.setdefault(dtype, [])
+        fits = [i for i, buf in enumerate(free) if buf.size >= size]
+        if fits:
+            # The smallest buffer that fits
+            buf = free.pop(min(fits, key=lambda i: free[i].size))
+        else:
+            # The smallest buffer that is too small is replaced
+            # by one of the largest size seen
+            if free:
+                free.pop(min(range(len(free)), key=lambda i: free[i].size))
+            buf = np.empty(largest, dtype=dtype)
+            self.allocations += 1
+
+        self._taken[id(buf)] = buf
+        return buf[:size].reshape(shape)
+
+    def holds(self, array):
+        """Whether array is a view of a buffer handed out by this pool."""
+        base = array.base if isinstance(array, np.ndarray) else None
+        return base is not None and id(base) in self._taken
+
+    def recycle(self, arrays):
+        """
+        Give back the buffers of arrays, which must not be used afterwards.
+        Arrays that did not come from this pool are ignored.
+
+        :return: None
+        """
+        for array in arrays:
+            if self.holds(array):
+                buf = self._taken.pop(id(array.base))
+                self._free.setdefault(buf.dtype, []).append(buf)
+
+
+def read_direct(ds, begin_row, end_row, pool):
+    """
+    Read rows [begin_row, end_row) of an h5py.Dataset into a buffer from pool,
+    without an intermediate copy. None stands for the start or end of ds.
+    Like DataGroup reads, single element rows give a 1-D array.
+
+    :return: A np.ndarray backed by a buffer of pool
+    """
+    begin_row = 0 if begin_row is None else begin_row
+    end_row = ds.shape[0] if end_row is None else end_row
+    shape = (max(end_row - begin_row, 0),) + ds.shape[1:]
+
+    out = pool.take(ds.dtype, shape)
+    if shape[0] > 0:
+        ds.read_direct(out, source_sel=np.s_[begin_row:end_row])
+    if len(shape) == 2 and shape[1] == 1:
+        out = out.reshape(-1)
+    return out
@@ -0,0 +1,212 @@
+"""This module provides an on-disk cache of uncompressed h5py datasets.
+
+The first time a column of a file is read through the cache, the whole
+dataset is decompressed once and written as a .npy file. Later reads,
+in this job or the next, memory-map that file instead of decompressing.
+
+Entries are kept per version of a source file, identified by its path,
+size and modification time, so an overwritten file is never served from
+stale entries. When the cache grows beyond its size limit, the least
+recently used columns are removed.
+
+Inspect or empty a cache with:
+
+    python -m pandana.utils.cache info DIRECTORY
+    python -m pandana.utils.cache purge DIRECTORY [SOURCE ...]
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+
+SOURCE_FILE = "source.txt"
+
+
+class ColumnCache:
+    """A directory of memory-mappable columns of h5 files.
+
+    :param directory: where the columns are kept, created if needed
+    :param max_bytes: the size limit, or None for no limit
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry(self, path):
+        # The directory holding the columns of this version of path
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = "%s\0%d\0%d" % (path, st.st_size, st.st_mtime_ns)
+        entry = os.path.join(
+            self.directory, hashlib.sha1(key.encode()).hexdigest()[:20]
+        )
+        if not os.path.isdir(entry):
+            os.makedirs(entry, exist_ok=True)
+            with open(os.path.join(entry, SOURCE_FILE), "w") as f:
+                f.write(path)
+        return entry
+
+    def column(self, ds):
+        """
+        The whole of h5py.Dataset ds as a read-only array memory-mapped from the cache,
+        written there first if it is not cached yet.
+
+        :return: A np.ndarray of the shape and dtype of ds
+        """
+        entry = self._entry(ds.file.filename)
+        fn = os.path.join(entry, quote(ds.name.strip("/"), safe="") + ".npy")
+
+        # Another process sharing the directory may evict the column at any
+        # time, until it is mapped, in which case it is written again
+        try:
+            # The modification time of a column is the last time it was used
+            os.utime(fn)
+            return np.load(fn, mmap_mode="r")
+        except FileNotFoundError:
+            pass
+
+        data = ds[()]
+        # Write under a unique name and rename, so that concurrent
+        # readers never see a partial file
+        tmp = "%s.%d.tmp" % (fn, os.getpid())
+        with open(tmp, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp, fn)
+        self.evict(keep=fn)
+        if data.size == 0:
+            return data
+        try:
+            return np.load(fn, mmap_mode="r")
+        except FileNotFoundError:
+            # Evicted again already, the data read is as good
+            data.flags.writeable = False
+            return data
+
+    def _columns(self):
+        # (path, size, last use) of every cached column
+        columns = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".npy"):
+                    fn = os.path.join(root, name)
+                    try:
+                        st = os.stat(fn)
+                    except FileNotFoundError:
+                        # Evicted by another process meanwhile
+                        continue
+                    columns.append((fn, st.st_size, st.st_mtime_ns))
+        return columns
+
+    def size(self):
+        """The number of bytes of all cached columns."""
+        return sum(size for _, size, _ in self._columns())
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used columns until the cache is within its size limit.
+        Column file keep is never removed.
+
+        :return: The number of bytes removed
+        """
+        if self.max_bytes is None:
+            return 0
+        columns = self._columns()
+        total = sum(size for _, size, _ in columns)
+        removed = 0
+        for fn, size, _ in sorted(columns, key=lambda c: c[2]):
+            if total - removed <= self.max_bytes:
+                break
+            if fn == keep:
+                continue
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+            removed += size
+        return removed
+
+    def info(self):
+        """
+        Describe the cached files.
+
+        :return: A list of dicts with the "source" file, the "columns" cached,
+                 their "bytes" and the time they were "last_used", in ns since the epoch
+        """
+        entries = []
+        for key in sorted(os.listdir(self.directory)):
+            entry = os.path.join(self.directory, key)
+            if not os.path.isdir(entry):
+                continue
+            source = None
+            if os.path.exists(os.path.join(entry, SOURCE_FILE)):
+                with open(os.path.join(entry, SOURCE_FILE)) as f:
+                    source = f.read()
+            columns = [
+                (name, os.stat(os.path.join(entry, name)))
+                for name in os.listdir(entry)
+                if name.endswith(".npy")
+            ]
+            entries.append(
+                {
+                    "source": source,
+                    "key": key,
+                    "columns": sorted(unquote(name[:-4]) for name, _ in columns),
+                    "bytes": sum(st.st_size for _, st in columns),
+                    "last_used": max((st.st_mtime_ns for _, st in columns), default=0),
+                }
+            )
+        return entries
+
+    def purge(self, sources=None):
+        """
+        Remove every cached file, or only those cached from the given source paths.
+
+        :return: The number of bytes removed
+        """
+        if sources is not None:
+            sources = {os.path.abspath(s) for s in sources}
+        removed = 0
+        for entry in self.info():
+            if sources is None or entry["source"] in sources:
+                shutil.rmtree(os.path.join(self.directory, entry["key"]), ignore_errors=True)
+                removed += entry["bytes"]
+        return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pandana.utils.cache", description="Inspect or purge a column cache."
+    )
+    parser.add_argument("command", choices=["info", "purge"])
+    parser.add_argument("directory")
+    parser.add_argument("sources", nargs="*", help="only purge the columns of these files")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.directory):
+        print("No cache in %s" % args.directory, file=sys.stderr)
+        return 1
+    cache = ColumnCache(args.directory)
+
+    if args.command == "info":
+        entries = cache.info()
+        for entry in entries:
+            print(
+                "%12d  %4d columns  %s"
+                % (entry["bytes"], len(entry["columns"]), entry["source"])
+            )
+        print("%12d  total" % sum(entry["bytes"] for entry in entries))
+    else:
+        removed = cache.purge(args.sources or None)
+        print("Removed %d bytes" % removed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
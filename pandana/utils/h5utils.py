@@ -0,0 +1,94 @@
+"""This module provides utility functions for h5py datasets.
+"""
+import numpy as np
+
+from pandana.utils.profiling import profiled
+
+
+@profiled("search")
+def searchsorted_dataset(ds, value, lo=0, hi=None, blocksize=4096):
+    """Find where value would be inserted in a sorted h5py dataset.
+
+    Like numpy.searchsorted with side='left', but without reading the whole
+    dataset: the range [lo, hi) is bisected with single element reads
+    until it is at most blocksize rows long, and only that block is read.
+    The dataset is expected to have shape (n, 1) or (n,).
+
+    :return: the row index, in [lo, hi]
+    """
+    if hi is None:
+        hi = ds.shape[0]
+
+    while hi - lo > blocksize:
+        mid = (lo + hi) // 2
+        if ds[mid].item() < value:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    block = ds[lo:hi].reshape(-1)
+    return lo + int(np.searchsorted(block, value))
+
+
+def chunk_rows(ds):
+    """The number of rows in each HDF5 chunk of dataset ds, or None if it is not chunked."""
+    if ds.chunks is None:
+        return None
+    return ds.chunks[0]
+
+
+def chunk_read_bytes(ds, begin, end):
+    """Count the bytes that reading rows [begin, end) of dataset ds decompresses and uses.
+
+    Every chunk overlapping the range is decompressed whole, so the first
+    number is at least the second. Both are in uncompressed bytes.
+    A dataset that is not chunked decompresses only what is used.
+
+    :return: (bytes decompressed, bytes used)
+    """
+    nrows = ds.shape[0]
+    if end is None:
+        end = nrows
+    if begin is None:
+        begin = 0
+    if end <= begin:
+        return 0, 0
+
+    rowbytes = ds.dtype.itemsize * int(np.prod(ds.shape[1:], dtype=np.int64))
+    used = (end - begin) * rowbytes
+    rows = chunk_rows(ds)
+    if rows is None:
+        return used, used
+
+    first = (begin // rows) * rows
+    last = min(-(-end // rows) * rows, nrows)
+    return (last - first) * rowbytes, used
+
+
+def chunk_storage_bytes(ds, begin, end):
+    """Count the bytes on disk of the HDF5 chunks that reading rows [begin, end)
+    of dataset ds decompresses, as stored, compressed if they are.
+    A dataset that is not chunked stores what is used as is.
+
+    :return: The number of bytes
+    """
+    nrows = ds.shape[0]
+    begin = 0 if begin is None else begin
+    end = nrows if end is None else min(end, nrows)
+    if end <= begin:
+        return 0
+    if ds.chunks is None:
+        return chunk_read_bytes(ds, begin, end)[1]
+
+    rows = ds.chunks[0]
+    # Chunks also split the other dimensions of wide datasets
+    offsets = [()]
+    for size, chunk in zip(ds.shape[1:], ds.chunks[1:]):
+        offsets = [o + (i,) for o in offsets for i in range(0, size, chunk)]
+    total = 0
+    for first in range((begin // rows) * rows, end, rows):
+        for rest in offsets:
+            info = ds.id.get_chunk_info_by_coord((first,) + rest)
+            if info.byte_offset is not None:
+                total += info.size
+    return total
@@ -1,5 +1,47 @@
 """This module provides MPI utility functions.
+
+mpi4py is only imported, and MPI initialized, by the functions that need
+it with more than one rank. A SerialComm stands for the communicator of a
+process running alone, so the collectives below work without MPI.
 """
+import numpy as np
+
+
+def world():
+    """MPI.COMM_WORLD, importing mpi4py and so initializing MPI if needed."""
+    from mpi4py import MPI
+
+    return MPI.COMM_WORLD
+
+
+class SerialComm:
+    """The communicator of a single process, without MPI.
+
+    It has the rank and size of an mpi4py communicator, and its pickle-based
+    collectives. Buffer-based collectives go through the functions of this
+    module, which do not call the communicator with a single rank.
+    """
+
+    rank = 0
+    size = 1
+
+    def Get_rank(self):
+        return 0
+
+    def Get_size(self):
+        return 1
+
+    def bcast(self, obj, root=0):
+        return obj
+
+    def gather(self, obj, root=0):
+        return [obj]
+
+    def allgather(self, obj):
+        return [obj]
+
+    def Barrier(self):
+        pass
 
 
 def calculate_slice_for_rank(myrank, nranks, arraysz):
@@ -33,3 +75,142 @@ def calculate_slice_for_rank(myrank, nranks, arraysz):
         low = leftovers + myrank * slice_size
         high = low + slice_size
     return low, high
+
+
+def calculate_weighted_slice_for_rank(myrank, nranks, costs):
+    """Calculate the slice indices for processing items of uneven cost in MPI programs.
+
+    Return (low, high), a tuple containing the range of indices
+    in the array costs to be processed by MPI rank myrank of a total nranks.
+    Each item goes to the rank whose share of the total cost contains the
+    middle of the item, so every rank gets about the same total cost.
+    Every rank gets at least one item.
+    """
+
+    if myrank >= nranks:
+        raise ValueError("myrank must be less than nranks")
+    if nranks > len(costs):
+        raise ValueError("nranks must not be larger than array size")
+
+    costs = np.asarray(costs, dtype=np.float64)
+    cumulative = np.cumsum(costs)
+    total = cumulative[-1]
+    if total <= 0:
+        return calculate_slice_for_rank(myrank, nranks, costs.size)
+
+    # The first item of each rank is the first whose middle is in that rank's share
+    middles = cumulative - costs / 2
+    bounds = np.searchsorted(middles, total * np.arange(nranks) / nranks)
+    bounds[0] = 0
+
+    # Keep at least one item per rank: with d = bound - rank,
+    # bounds strictly increase when d does not decrease
+    ranks = np.arange(nranks)
+    shifted = np.maximum.accumulate(np.maximum(bounds - ranks, 0))
+    shifted = np.minimum(shifted, costs.size - nranks)
+    bounds = np.append(shifted + ranks, costs.size)
+
+    return int(bounds[myrank]), int(bounds[myrank + 1])
+
+
+def calculate_global_slices_for_rank(myrank, nranks, sizes):
+    """Calculate the slices of several arrays processed by an MPI rank,
+    treating them as one long array.
+
+    The concatenation of arrays of the given sizes is split as by
+    calculate_slice_for_rank. Return a list of (i, low, high) tuples,
+    one for each array i overlapping the range of myrank, where
+    [low, high) is the overlapping range of indices within array i.
+    """
+
+    offsets = np.concatenate(([0], np.cumsum(sizes, dtype=np.int64)))
+    low, high = calculate_slice_for_rank(myrank, nranks, int(offsets[-1]))
+
+    slices = []
+    for i, size in enumerate(sizes):
+        begin = max(low - offsets[i], 0)
+        end = min(high - offsets[i], size)
+        if begin < end:
+            slices.append((i, int(begin), int(end)))
+    return slices
+
+
+def allreduce_sum(comm, array):
+    """Sum a numpy array over all ranks of comm, in place and without pickling.
+
+    Return the summed array, which is array itself when it is C-contiguous.
+    """
+    buf = np.ascontiguousarray(array)
+    if comm.size > 1:
+        from mpi4py import MPI
+
+        comm.Allreduce(MPI.IN_PLACE, buf, op=MPI.SUM)
+    return buf
+
+
+def reduce_sum(comm, array, root=0):
+    """Sum a numpy array over all ranks of comm on rank root, without pickling.
+
+    Return the sum as a new C-contiguous array on root and None on other ranks.
+    """
+    array = np.ascontiguousarray(array)
+    if comm.size == 1:
+        return array.copy()
+    from mpi4py import MPI
+
+    total = np.empty_like(array) if comm.rank == root else None
+    comm.Reduce(array, total, op=MPI.SUM, root=root)
+    return total
+
+
+def exscan_counts(comm, count):
+    """The offset of the rows of this rank and the row offsets of every rank,
+    when each rank of comm has count rows.
+
+    Return (first row of this rank, array [0, end of rank 0, ..., end of the last rank]).
+    """
+    if comm.size == 1:
+        return 0, np.array([0, count], dtype=np.int64)
+    from mpi4py import MPI
+
+    counts = np.empty(comm.size, dtype=np.int64)
+    comm.Allgather(np.array([count], dtype=np.int64), counts)
+    mine = np.zeros(1, dtype=np.int64)
+    comm.Exscan(np.array([count], dtype=np.int64), mine, op=MPI.SUM)
+    if comm.rank == 0:
+        mine[0] = 0
+    return int(mine[0]), np.concatenate(([0], np.cumsum(counts)))
+
+
+def bcast_array(comm, array, root=0):
+    """Broadcast the values of a numpy array from rank root into array on every rank of comm.
+
+    Return array.
+    """
+    if comm.size > 1:
+        comm.Bcast(array, root=root)
+    return array
+
+
+def gatherv_array(comm, array, root=0):
+    """Concatenate the rows of a numpy array from all ranks of comm on rank root,
+    in rank order and without pickling.
+
+    Every rank must pass an array of the same dtype and the same shape
+    apart from the first axis, which may be 0. Return the concatenated
+    array on root and None on other ranks.
+    """
+    array = np.ascontiguousarray(array)
+    if comm.size == 1:
+        return array
+    rowsize = int(np.prod(array.shape[1:], dtype=np.int64))
+
+    counts = np.empty(comm.size, dtype=np.int64)
+    comm.Allgather(np.array([array.shape[0]], dtype=np.int64), counts)
+
+    if comm.rank != root:
+        comm.Gatherv(array, None, root=root)
+        return None
+    out = np.empty((int(counts.sum()),) + array.shape[1:], dtype=array.dtype)
+    comm.Gatherv(array, (out, counts * rowsize), root=root)
+    return out
@@ -0,0 +1,282 @@
+"""This module provides opt-in timing and I/O accounting of Loader.Go.
+
+While a Profiler is active, the sections of pandana that open files,
+search for row boundaries, read columns, evaluate Vars and Cuts, align
+them and fill spectra record their wall time under a stage and a name,
+for the file being processed. A section only counts its own time, not
+that of the sections inside it, so the stages of a run add up to its
+wall time, except that the reads of a prefetch thread overlap the rest.
+Reads also count their bytes on disk and decompressed.
+With no active profiler every section is a no-op.
+
+The records of all MPI ranks are merged by Profiler.report, which also
+gives the load imbalance of each stage between ranks.
+"""
+import csv
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+
+# The profiler sections record to, if any
+_active = None
+
+_NULL = nullcontext()
+
+# The columns of a record
+FIELDS = [
+    "rank",
+    "file",
+    "stage",
+    "name",
+    "calls",
+    "seconds",
+    "bytes_stored",
+    "bytes_decompressed",
+]
+
+
+def active():
+    """The active Profiler, or None."""
+    return _active
+
+
+@contextmanager
+def activate(profiler):
+    """Make profiler the one sections record to, for the duration of the with block."""
+    global _active
+    previous = _active
+    _active = profiler
+    try:
+        yield profiler
+    finally:
+        _active = previous
+
+
+def section(stage, name=None, file=None, nbytes=None):
+    """
+    A context manager timing its block under stage and name in the active profiler.
+
+    :param file: the file the block works on, the one set by on_file by default
+    :param nbytes: (bytes on disk, bytes decompressed) for a read
+    """
+    if _active is None:
+        return _NULL
+    return _active.section(stage, name, file, nbytes)
+
+
+def on_file(path):
+    """A context manager attributing the sections in its block to file path."""
+    if _active is None:
+        return _NULL
+    return _active.onFile(path)
+
+
+def profiled(stage):
+    """Decorate a function so that every call is a section of stage, named after it."""
+
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with _active.section(stage, func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def peak_rss():
+    """The peak resident set size of this process, in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class _Section:
+    def __init__(self, profiler, key, nbytes):
+        self._profiler = profiler
+        self._key = key
+        self._nbytes = nbytes
+
+    def __enter__(self):
+        # [start, time spent in nested sections]
+        self._frame = [time.perf_counter(), 0.0]
+        self._profiler._stack().append(self._frame)
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._frame[0]
+        stack = self._profiler._stack()
+        stack.pop()
+        if stack:
+            stack[-1][1] += elapsed
+        self._profiler._record(self._key, elapsed - self._frame[1], self._nbytes)
+        return False
+
+
+def _stats(values):
+    # The spread of one number over the ranks
+    mean = sum(values) / len(values) if values else 0.0
+    return {
+        "min": min(values, default=0.0),
+        "mean": mean,
+        "max": max(values, default=0.0),
+        # How much longer the slowest rank took than the average one
+        "imbalance": max(values) / mean - 1 if mean else 0.0,
+    }
+
+
+class Profiler:
+    """Wall time, calls and bytes read by stage, name and file, for one process.
+
+    Activate it with profiling.activate(profiler), as Loader.Go does
+    when constructed with profile=True.
+    """
+
+    def __init__(self):
+        # (file, stage, name) -> [calls, seconds, bytes on disk, bytes decompressed]
+        self._records = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.wall = 0.0
+        self.peak_rss = 0
+
+    def _stack(self):
+        # The open sections of this thread
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _files(self):
+        files = getattr(self._local, "files", None)
+        if files is None:
+            files = self._local.files = []
+        return files
+
+    def section(self, stage, name=None, file=None, nbytes=None):
+        if file is None:
+            files = self._files()
+            file = files[-1] if files else None
+        return _Section(self, (file, stage, name), nbytes)
+
+    @contextmanager
+    def onFile(self, path):
+        files = self._files()
+        files.append(path)
+        try:
+            yield
+        finally:
+            files.pop()
+
+    @contextmanager
+    def run(self):
+        """Time a whole run, and note the peak RSS once it is done."""
+        start = time.perf_counter()
+        try:
+            # Time not spent in any other section
+            with activate(self), self.section("other"):
+                yield self
+        finally:
+            self.wall += time.perf_counter() - start
+            self.peak_rss = peak_rss()
+
+    def _record(self, key, seconds, nbytes, calls=1):
+        with self._lock:
+            record = self._records.setdefault(key, [0, 0.0, 0, 0])
+            record[0] += calls
+            record[1] += seconds
+            if nbytes is not None:
+                record[2] += nbytes[0]
+                record[3] += nbytes[1]
+
+    def clear(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._records = {}
+
+    def merge(self, records):
+        """Add records, as from the records() of another Profiler, to those of this one."""
+        for r in records:
+            self._record(
+                (r["file"], r["stage"], r["name"]),
+                r["seconds"],
+                (r["bytes_stored"], r["bytes_decompressed"]),
+                r["calls"],
+            )
+
+    def records(self, rank=0):
+        """The records of this process as a list of dicts with the keys of FIELDS."""
+        return [
+            dict(zip(FIELDS, (rank, file, stage, name) + tuple(values)))
+            for (file, stage, name), values in sorted(
+                self._records.items(), key=lambda kv: tuple(str(k) for k in kv[0])
+            )
+        ]
+
+    def stages(self):
+        """The seconds spent in each stage by this process."""
+        totals = {}
+        for (_, stage, _), values in self._records.items():
+            totals[stage] = totals.get(stage, 0.0) + values[1]
+        return totals
+
+    def report(self, comm=None, root=0):
+        """
+        Merge the records of every rank of comm on rank root.
+
+        :param comm: An MPI communicator, or None for this process alone
+        :return: A dict with the "records" of all ranks, and the spread over
+                 the ranks of the "wall" time, the "peak_rss" and the seconds
+                 of each of the "stages". None on ranks other than root.
+        """
+        rank = 0 if comm is None else comm.rank
+        mine = {
+            "rank": rank,
+            "wall": self.wall,
+            "peak_rss": self.peak_rss,
+            "stages": self.stages(),
+            "records": self.records(rank),
+        }
+        ranks = [mine] if comm is None else comm.gather(mine, root=root)
+        if ranks is None:
+            return None
+
+        stages = sorted({stage for r in ranks for stage in r["stages"]})
+        return {
+            "ranks": len(ranks),
+            "wall": _stats([r["wall"] for r in ranks]),
+            "peak_rss": _stats([r["peak_rss"] for r in ranks]),
+            "stages": {
+                stage: _stats([r["stages"].get(stage, 0.0) for r in ranks]) for stage in stages
+            },
+            "per_rank": [
+                {k: r[k] for k in ("rank", "wall", "peak_rss", "stages")} for r in ranks
+            ],
+            "records": [record for r in ranks for record in r["records"]],
+        }
+
+    def write(self, path, comm=None, root=0):
+        """
+        Write the merged report to path on rank root: as JSON if path ends
+        with .json, otherwise the records as CSV. This is collective over comm.
+
+        :return: The report on root, None elsewhere
+        """
+        report = self.report(comm, root)
+        if report is None:
+            return None
+        with open(path, "w", newline="") as f:
+            if path.endswith(".json"):
+                json.dump(report, f, indent=2)
+            else:
+                writer = csv.DictWriter(f, fieldnames=FIELDS)
+                writer.writeheader()
+                writer.writerows(report["records"])
+        return report
@@ -0,0 +1,246 @@
+"""This module writes synthetic NOvA-like h5 files at any scale.
+
+The files have the layout the Loader reads: one group per table, one
+(n, 1) dataset per column, the run/subrun/evt/subevt index columns and
+the evt.seq id column in every group, and gzip compressed chunks.
+Multiplicities are ragged like in real files: zero or more slices per
+spill, a vertex for most slices, and zero or more prongs per vertex, each
+with a row in the prong and cvnpart tables.
+
+Write files from the command line with:
+
+    python -m pandana.utils.synthetic DIRECTORY --files 4 --events 100000
+"""
+import argparse
+import os
+import sys
+
+import h5py
+import numpy as np
+
+
+# The index levels of the synthetic files, and the levels identifying an event
+indices = ["run", "subrun", "evt", "subevt", "rec.vtx.elastic.fuzzyk.png_idx"]
+KL = ["run", "subrun", "evt"]
+
+# Events per subrun, after which evt starts over
+EVENTS_PER_SUBRUN = 10000
+
+# The level each table has one row per, with the dtype of each of its columns
+TABLES = {
+    "spill": ("event", {"spillpot": np.float64, "isgoodspill": np.uint8}),
+    "rec.slc": ("slice", {"calE": np.float32, "nhit": np.int32, "ncontplanes": np.int32}),
+    "rec.sand.nue": ("slice", {"npi0": np.int32}),
+    "rec.mc.nu": ("slice", {"E": np.float32, "woscdumb": np.float32}),
+    "rec.vtx.elastic": (
+        "vertex",
+        {"vtx.x": np.float32, "vtx.y": np.float32, "vtx.z": np.float32},
+    ),
+    "rec.vtx.elastic.fuzzyk": ("vertex", {"npng": np.int32}),
+    "rec.vtx.elastic.fuzzyk.png": (
+        "prong",
+        {
+            "calE": np.float32,
+            "dir.x": np.float32,
+            "dir.y": np.float32,
+            "dir.z": np.float32,
+            "len": np.float32,
+            "maxplanegap": np.int32,
+            "maxplanecont": np.int32,
+        },
+    ),
+    "rec.vtx.elastic.fuzzyk.png.cvnpart": (
+        "prong",
+        {"photonid": np.float32, "muonid": np.float32},
+    ),
+}
+
+
+def _ordinals(counts):
+    # 0, 1, ..., n-1 for each n in counts
+    return (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)).astype(
+        np.uint32
+    )
+
+
+def _block(rng, first_seq, nevents, run, slices_per_event, prongs_per_vertex):
+    # {level: {column: array}} for events first_seq, ..., first_seq + nevents - 1
+    seq = np.arange(first_seq, first_seq + nevents, dtype=np.uint64)
+    event = {
+        "run": np.full(nevents, run, dtype=np.uint32),
+        "subrun": (seq // EVENTS_PER_SUBRUN + 1).astype(np.uint32),
+        "evt": (seq % EVENTS_PER_SUBRUN + 1).astype(np.uint32),
+        "evt.seq": seq,
+        "spillpot": rng.normal(4e13, 2e12, nevents),
+        "isgoodspill": (rng.random(nevents) < 0.98).astype(np.uint8),
+    }
+
+    nslc = rng.poisson(slices_per_event, nevents)
+    slc_evt = np.repeat(np.arange(nevents), nslc)
+    nslices = slc_evt.size
+    slc_index = {k: event[k][slc_evt] for k in ("run", "subrun", "evt", "evt.seq")}
+    slc_index["subevt"] = _ordinals(nslc)
+    nhit = rng.integers(5, 400, nslices).astype(np.int32)
+    slc = dict(
+        slc_index,
+        calE=rng.gamma(2.0, 1.0, nslices).astype(np.float32),
+        nhit=nhit,
+        ncontplanes=np.minimum(nhit // 2, rng.integers(1, 200, nslices)).astype(np.int32),
+        npi0=rng.poisson(0.3, nslices).astype(np.int32),
+        E=rng.gamma(2.5, 1.2, nslices).astype(np.float32),
+        woscdumb=rng.random(nslices).astype(np.float32),
+    )
+
+    # Most slices have a vertex
+    has_vtx = rng.random(nslices) < 0.9
+    vtx = {k: v[has_vtx] for k, v in slc_index.items()}
+    nvertices = int(has_vtx.sum())
+    npng = rng.poisson(prongs_per_vertex, nvertices)
+    vtx.update(
+        {
+            "vtx.x": rng.uniform(-200, 200, nvertices).astype(np.float32),
+            "vtx.y": rng.uniform(-200, 200, nvertices).astype(np.float32),
+            "vtx.z": rng.uniform(0, 1300, nvertices).astype(np.float32),
+            "npng": npng.astype(np.int32),
+        }
+    )
+
+    png_vtx = np.repeat(np.arange(nvertices), npng)
+    nprongs = png_vtx.size
+    png = {k: vtx[k][png_vtx] for k in slc_index}
+    png["rec.vtx.elastic.fuzzyk.png_idx"] = _ordinals(npng)
+    direction = rng.normal(size=(3, nprongs)).astype(np.float32)
+    direction /= np.linalg.norm(direction, axis=0)
+    png.update(
+        {
+            "calE": rng.gamma(1.5, 0.3, nprongs).astype(np.float32),
+            "dir.x": direction[0],
+            "dir.y": direction[1],
+            "dir.z": direction[2],
+            "len": rng.exponential(150, nprongs).astype(np.float32),
+            "maxplanegap": rng.integers(0, 6, nprongs).astype(np.int32),
+            "maxplanecont": rng.integers(1, 40, nprongs).astype(np.int32),
+            "photonid": rng.random(nprongs).astype(np.float32),
+            "muonid": rng.random(nprongs).astype(np.float32),
+        }
+    )
+    return {"event": event, "slice": slc, "vertex": vtx, "prong": png}
+
+
+def _index_columns(level):
+    # The index and id columns of the tables with one row per level
+    columns = {"run": np.uint32, "subrun": np.uint32, "evt": np.uint32}
+    if level != "event":
+        columns["subevt"] = np.uint32
+    if level == "prong":
+        columns["rec.vtx.elastic.fuzzyk.png_idx"] = np.uint32
+    columns["evt.seq"] = np.uint64
+    return columns
+
+
+def write_synthetic_file(
+    path,
+    nevents,
+    seed=0,
+    run=1000,
+    slices_per_event=2.0,
+    prongs_per_vertex=2.0,
+    chunk_rows=4096,
+    compression="gzip",
+    block_events=20000,
+):
+    """
+    Write a NOvA-like file of nevents spills, see the module docstring.
+    Events are generated and appended block_events at a time, so files of
+    any size can be written in bounded memory.
+
+    :param slices_per_event: the mean number of slices of a spill
+    :param prongs_per_vertex: the mean number of prongs of a vertex
+    :param chunk_rows: the number of rows of each HDF5 chunk
+    :return: A dict of {group name: number of rows}
+    """
+    rng = np.random.default_rng(seed)
+    with h5py.File(path, "w") as f:
+        f.attrs["nevents"] = nevents
+        f.attrs["seed"] = seed
+        datasets = {}
+        for name, (level, columns) in TABLES.items():
+            group = f.create_group(name)
+            for column, dtype in dict(_index_columns(level), **columns).items():
+                datasets[name, column] = group.create_dataset(
+                    column,
+                    shape=(0, 1),
+                    maxshape=(None, 1),
+                    dtype=dtype,
+                    chunks=(chunk_rows, 1),
+                    compression=compression,
+                )
+
+        for first in range(0, nevents, block_events):
+            levels = _block(
+                rng,
+                first,
+                min(block_events, nevents - first),
+                run,
+                slices_per_event,
+                prongs_per_vertex,
+            )
+            for (name, column), ds in datasets.items():
+                data = levels[TABLES[name][0]][column]
+                begin = ds.shape[0]
+                ds.resize(begin + data.size, axis=0)
+                ds[begin:] = data.reshape(-1, 1)
+
+        return {name: f[name]["evt.seq"].shape[0] for name in TABLES}
+
+
+def write_synthetic_files(directory, nfiles, nevents, seed=0, **kwargs):
+    """
+    Write nfiles files of nevents spills each into directory, one run per file.
+    Files already there are kept.
+
+    :param kwargs: passed on to write_synthetic_file
+    :return: The list of file paths
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(nfiles):
+        path = os.path.join(directory, "synthetic_%d_%d.h5" % (nevents, seed + i))
+        if not os.path.exists(path):
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            write_synthetic_file(tmp, nevents, seed=seed + i, run=1000 + seed + i, **kwargs)
+            os.replace(tmp, path)
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pandana.utils.synthetic",
+        description="Write synthetic NOvA-like h5 files.",
+    )
+    parser.add_argument("directory")
+    parser.add_argument("--files", type=int, default=1)
+    parser.add_argument("--events", type=int, default=10000, help="spills per file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--slices-per-event", type=float, default=2.0)
+    parser.add_argument("--prongs-per-vertex", type=float, default=2.0)
+    parser.add_argument("--chunk-rows", type=int, default=4096)
+    args = parser.parse_args(argv)
+
+    paths = write_synthetic_files(
+        args.directory,
+        args.files,
+        args.events,
+        seed=args.seed,
+        slices_per_event=args.slices_per_event,
+        prongs_per_vertex=args.prongs_per_vertex,
+        chunk_rows=args.chunk_rows,
+    )
+    for path in paths:
+        print("%12d  %s" % (os.path.getsize(path), path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
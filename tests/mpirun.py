@@ -0,0 +1,41 @@
+"""Run test code on several MPI ranks with mpirun."""
+from .context import pandana
+import os
+import shutil
+import subprocess
+import sys
+
+
+def mpi_available():
+    """Whether mpirun and mpi4py are installed."""
+    try:
+        import mpi4py
+    except ImportError:
+        return False
+    return shutil.which("mpirun") is not None
+
+
+def run_mpi(code, nranks, *args):
+    """
+    Run python code on nranks MPI ranks with mpirun.
+
+    :return: The standard output of all ranks
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(pandana.__file__)), env.get("PYTHONPATH", "")]
+    )
+    # Open MPI refuses to run as root or on more ranks than cores otherwise
+    env.setdefault("OMPI_ALLOW_RUN_AS_ROOT", "1")
+    env.setdefault("OMPI_ALLOW_RUN_AS_ROOT_CONFIRM", "1")
+    env.setdefault("OMPI_MCA_rmaps_base_oversubscribe", "1")
+    out = subprocess.run(
+        ["mpirun", "-n", str(nranks), sys.executable, "-c", code] + list(args),
+        capture_output=True,
+        text=True,
+        env=env,
+        timeout=120,
+    )
+    if out.returncode != 0:
+        raise AssertionError(out.stdout + out.stderr)
+    return out.stdout
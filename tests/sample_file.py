@@ -0,0 +1,94 @@
+"""Write a small NOvA-like h5 file for the Loader tests."""
+import h5py as h5
+import numpy as np
+
+
+indices = ["run", "subrun", "evt", "subevt", "rec.png_idx"]
+KL = ["run", "subrun", "evt"]
+
+
+def _write_group(f, name, columns, chunk_rows):
+    group = f.create_group(name)
+    for colname, data in columns.items():
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data.reshape(-1, 1)
+        group.create_dataset(
+            colname,
+            data=data,
+            chunks=(min(chunk_rows, data.shape[0]), data.shape[1]) if data.shape[0] else None,
+            compression="gzip" if data.shape[0] else None,
+        )
+    return group
+
+
+def _ordinals(counts):
+    # 0, 1, ..., n-1 for each n in counts
+    return (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)).astype(
+        np.uint32
+    )
+
+
+def write_sample_file(path, nevents=20, seed=1, run=12, chunk_rows=8):
+    """
+    Write a file with a spill table (one row per event), a slice table
+    (zero or more slices per event) and a prong table (zero or more prongs per slice).
+
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    evtseq = np.arange(nevents, dtype=np.uint64)
+    evt = np.arange(1, nevents + 1, dtype=np.uint32) * 2
+
+    with h5.File(path, "w") as f:
+        _write_group(
+            f,
+            "spill",
+            {
+                "run": np.full(nevents, run, dtype=np.uint32),
+                "subrun": np.ones(nevents, dtype=np.uint32),
+                "evt": evt,
+                "evt.seq": evtseq,
+                "spillpot": rng.random(nevents),
+            },
+            chunk_rows,
+        )
+
+        nslc = rng.integers(0, 4, nevents)
+        slc_evt = np.repeat(np.arange(nevents), nslc)
+        nslices = slc_evt.size
+        subevt = _ordinals(nslc)
+        _write_group(
+            f,
+            "rec.slc",
+            {
+                "run": np.full(nslices, run, dtype=np.uint32),
+                "subrun": np.ones(nslices, dtype=np.uint32),
+                "evt": evt[slc_evt],
+                "subevt": subevt,
+                "evt.seq": evtseq[slc_evt],
+                "calE": (5 * rng.random(nslices)).astype(np.float32),
+                "nhit": rng.integers(10, 100, nslices).astype(np.int32),
+            },
+            chunk_rows,
+        )
+
+        npng = rng.integers(0, 4, nslices)
+        png_slc = np.repeat(np.arange(nslices), npng)
+        nprongs = png_slc.size
+        _write_group(
+            f,
+            "rec.png",
+            {
+                "run": np.full(nprongs, run, dtype=np.uint32),
+                "subrun": np.ones(nprongs, dtype=np.uint32),
+                "evt": evt[slc_evt][png_slc],
+                "subevt": subevt[png_slc],
+                "rec.png_idx": _ordinals(npng),
+                "evt.seq": evtseq[slc_evt][png_slc],
+                "calE": rng.random(nprongs).astype(np.float32),
+                "maxplanegap": rng.integers(0, 4, nprongs).astype(np.int32),
+                "dir": rng.normal(size=(nprongs, 3)).astype(np.float32),
+            },
+            chunk_rows,
+        )
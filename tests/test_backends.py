@@ -0,0 +1,184 @@
+from .context import pandana
+from .sample_file import write_sample_file, indices
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+import boost_histogram as bh
+
+from pandana.core import Loader, MultiverseSpectrum, Spectrum, Var
+from pandana.core.backends import Backend, ProcessBackend, SerialBackend, get_backend
+from pandana.utils.mpiutils import (
+    SerialComm,
+    allreduce_sum,
+    bcast_array,
+    exscan_counts,
+    gatherv_array,
+    reduce_sum,
+)
+
+
+class TestGetBackend(unittest.TestCase):
+    def test_serial(self):
+        backend = get_backend("serial")
+        self.assertIsInstance(backend, SerialBackend)
+        self.assertEqual((backend.rank, backend.size), (0, 1))
+        self.assertIs(get_backend(backend), backend)
+
+    def test_communicator(self):
+        comm = SerialComm()
+        backend = get_backend(comm)
+        self.assertEqual(backend.name, "mpi")
+        self.assertIs(backend.comm, comm)
+
+    def test_processes(self):
+        self.assertIsInstance(get_backend("processes"), ProcessBackend)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            get_backend("threads")
+
+    def test_no_mpi_on_import(self):
+        code = (
+            "import sys, pandana, pandana.core\n"
+            "from pandana.core import Loader\n"
+            "Loader([], 'evt.seq', 'spill', [], backend='serial')\n"
+            "print('mpi4py' in sys.modules)\n"
+        )
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(pandana.__file__)), env.get("PYTHONPATH", "")]
+        )
+        out = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, env=env, check=True
+        )
+        self.assertEqual(out.stdout.strip(), "False")
+
+
+class TestSerialComm(unittest.TestCase):
+    def test_collectives(self):
+        comm = SerialComm()
+        a = np.arange(6.0).reshape(2, 3)
+        np.testing.assert_array_equal(allreduce_sum(comm, a), a)
+        total = reduce_sum(comm, a)
+        np.testing.assert_array_equal(total, a)
+        self.assertIsNot(total, a)
+        np.testing.assert_array_equal(gatherv_array(comm, a), a)
+        self.assertIs(bcast_array(comm, a), a)
+        first, offsets = exscan_counts(comm, 7)
+        self.assertEqual(first, 0)
+        np.testing.assert_array_equal(offsets, [0, 7])
+        self.assertEqual(comm.gather({"x": 1}), [{"x": 1}])
+        self.assertEqual(comm.bcast(3), 3)
+
+
+class TestLoaderBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = []
+        for seed in range(2):
+            path = os.path.join(self.tmpdir.name, "sample%d.h5" % seed)
+            write_sample_file(path, nevents=30, seed=seed)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fill(self, backend, **kwargs):
+        loader = Loader(self.files, "evt.seq", "spill", indices, backend=backend, **kwargs)
+        kE = Var(lambda tables: tables["rec.slc"]["calE"])
+        spectrum = Spectrum(loader, kE > 1, kE)
+        loader.Go()
+        return loader, spectrum
+
+    def test_serial_matches_default(self):
+        _, default = self.fill(None)
+        loader, serial = self.fill("serial", distributed=True, gather_events=True)
+        self.assertIsInstance(loader.backend(), SerialBackend)
+        np.testing.assert_array_equal(
+            serial.histogram(10, (0, 5))[0], default.histogram(10, (0, 5))[0]
+        )
+        self.assertEqual(serial.integral(), default.integral())
+        self.assertEqual(len(serial.df()), len(default.df()))
+
+    def test_custom_backend(self):
+        class Counting(Backend):
+            calls = 0
+
+            def go(self, loader):
+                Counting.calls += 1
+                super().go(loader)
+
+        _, default = self.fill("serial")
+        _, counted = self.fill(Counting(SerialComm()))
+        self.assertEqual(Counting.calls, 1)
+        self.assertEqual(counted.integral(), default.integral())
+
+
+class TestProcessBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = []
+        for seed in range(3):
+            path = os.path.join(self.tmpdir.name, "sample%d.h5" % seed)
+            write_sample_file(path, nevents=40, seed=seed)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fill(self, backend, **kwargs):
+        loader = Loader(self.files, "evt.seq", "spill", indices, backend=backend, **kwargs)
+        kE = Var(lambda tables: tables["rec.slc"]["calE"])
+        kPOT = Var(lambda tables: tables["spill"]["spillpot"])
+        kShifts = Var(lambda tables: tables["rec.slc"]["calE"] * 0.1)
+        spectra = [
+            Spectrum(loader, kE > 1, kE, kPOT, exposure=kPOT),
+            Spectrum(loader, kE > 0.5, kE, axes=bh.axis.Regular(10, 0, 5)),
+            MultiverseSpectrum(
+                loader, kE > 0.5, kE, [kPOT, kShifts], axes=bh.axis.Regular(10, 0, 5)
+            ),
+        ]
+        loader.Go()
+        return loader, spectra
+
+    def test_matches_serial(self):
+        for kwargs in ({}, {"chunk_events": 7}):
+            _, serial = self.fill("serial", **kwargs)
+            loader, pooled = self.fill(ProcessBackend(4), profile=True, **kwargs)
+
+            # The events come back in the order of a serial run
+            self.assertTrue(pooled[0].df().equals(serial[0].df()))
+            self.assertTrue(pooled[0].weight().equals(serial[0].weight()))
+            for s, p in zip(serial, pooled):
+                self.assertEqual(p.entries(), s.entries())
+                np.testing.assert_allclose(p.integral(), s.integral())
+                np.testing.assert_allclose(p.exposure(), s.exposure())
+            for s, p in zip(serial[1:], pooled[1:]):
+                np.testing.assert_allclose(p.hist().values(), s.hist().values())
+                np.testing.assert_allclose(p.hist().variances(), s.hist().variances())
+
+            # What the workers read and did is accounted in the parent
+            self.assertGreater(loader.readAmplification()["used"], 0)
+            report = loader.profileReport()
+            self.assertIn("fill", report["stages"])
+            self.assertEqual(
+                {r["file"] for r in report["records"] if r["stage"] == "read"},
+                set(self.files),
+            )
+
+    def test_more_workers_than_events(self):
+        path = os.path.join(self.tmpdir.name, "tiny.h5")
+        write_sample_file(path, nevents=3, seed=5)
+        self.files = [path]
+        _, serial = self.fill("serial")
+        _, pooled = self.fill(ProcessBackend(8))
+        self.assertEqual(pooled[0].entries(), serial[0].entries())
+        self.assertTrue(pooled[0].df().equals(serial[0].df()))
+
+if __name__ == "__main__":
+    unittest.main()
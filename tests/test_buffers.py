@@ -0,0 +1,68 @@
+from .context import pandana
+from .sample_file import write_sample_file
+import os
+import tempfile
+import unittest
+
+import h5py as h5
+import numpy as np
+
+from pandana.utils.buffers import BufferPool, read_direct
+
+
+class TestBufferPool(unittest.TestCase):
+    def test_reuse_after_recycle(self):
+        pool = BufferPool()
+        a = pool.take(np.float32, (10,))
+        b = pool.take(np.float32, (4, 3))
+        self.assertEqual(pool.allocations, 2)
+        self.assertTrue(pool.holds(a) and pool.holds(b))
+        self.assertEqual(b.shape, (4, 3))
+        self.assertTrue(b.flags.c_contiguous)
+
+        pool.recycle([a, b, np.zeros(3)])
+        c = pool.take(np.float32, (8,))
+        d = pool.take(np.float32, (12,))
+        self.assertEqual(pool.allocations, 2)
+        self.assertFalse(np.shares_memory(c, d))
+
+    def test_dtypes_are_pooled_separately(self):
+        pool = BufferPool()
+        pool.recycle([pool.take(np.float32, (5,))])
+        x = pool.take(np.int32, (5,))
+        self.assertEqual(x.dtype, np.int32)
+        self.assertEqual(pool.allocations, 2)
+
+    def test_grows_to_largest_request(self):
+        pool = BufferPool()
+        pool.recycle([pool.take(np.float64, (5,))])
+        big = pool.take(np.float64, (50,))
+        pool.recycle([big])
+        self.assertEqual(pool.allocations, 2)
+        pool.recycle([pool.take(np.float64, (30,))])
+        self.assertEqual(pool.allocations, 2)
+
+
+class TestReadDirect(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmpdir.name, "sample.h5")
+        write_sample_file(path)
+        self.file = h5.File(path, "r")
+
+    def tearDown(self):
+        self.file.close()
+        self.tmpdir.cleanup()
+
+    def test_matches_slicing(self):
+        pool = BufferPool()
+        for name in ["calE", "dir", "evt.seq"]:
+            ds = self.file["rec.png"][name]
+            for begin, end in [(None, None), (3, 11), (5, 5)]:
+                out = read_direct(ds, begin, end, pool)
+                expected = ds[begin:end]
+                if expected.shape[1] == 1:
+                    expected = expected.reshape(-1)
+                np.testing.assert_array_equal(out, expected)
+                self.assertEqual(out.dtype, ds.dtype)
+                self.assertTrue(pool.holds(out))
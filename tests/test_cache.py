@@ -0,0 +1,117 @@
+from .context import pandana
+from .sample_file import write_sample_file
+import io
+import os
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+import h5py as h5
+import numpy as np
+
+from pandana.utils.cache import ColumnCache, main
+
+
+class TestColumnCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "sample.h5")
+        write_sample_file(self.path)
+        self.cachedir = os.path.join(self.tmpdir.name, "cache")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_column_is_memory_mapped(self):
+        cache = ColumnCache(self.cachedir)
+        with h5.File(self.path, "r") as f:
+            ds = f["rec.png"]["dir"]
+            first = cache.column(ds)
+            again = cache.column(ds)
+            np.testing.assert_array_equal(first, ds[()])
+            np.testing.assert_array_equal(again, ds[()])
+        self.assertIsInstance(again, np.memmap)
+        self.assertFalse(again.flags.writeable)
+
+        (entry,) = cache.info()
+        self.assertEqual(entry["source"], os.path.abspath(self.path))
+        self.assertEqual(entry["columns"], ["rec.png/dir"])
+        self.assertEqual(entry["bytes"], cache.size())
+
+    def test_rewritten_file_is_not_served_stale(self):
+        cache = ColumnCache(self.cachedir)
+        with h5.File(self.path, "r") as f:
+            old = np.array(cache.column(f["spill"]["spillpot"]))
+
+        time.sleep(0.01)
+        write_sample_file(self.path, seed=7)
+        with h5.File(self.path, "r") as f:
+            new = cache.column(f["spill"]["spillpot"])
+            np.testing.assert_array_equal(new, f["spill"]["spillpot"][()])
+        self.assertFalse(np.array_equal(old, new))
+        self.assertEqual(len(cache.info()), 2)
+
+        self.assertGreater(cache.purge([self.path]), 0)
+        self.assertEqual(cache.info(), [])
+
+    def test_least_recently_used_are_evicted(self):
+        names = ["calE", "maxplanegap", "evt.seq"]
+        with h5.File(self.path, "r") as f:
+            sizes = {}
+            for name in names:
+                unlimited = ColumnCache(self.cachedir)
+                unlimited.column(f["rec.png"][name])
+                sizes[name] = unlimited.size()
+                unlimited.purge()
+
+            cache = ColumnCache(self.cachedir, max_bytes=sizes["calE"] + sizes["evt.seq"])
+            for name in ["calE", "maxplanegap", "calE", "evt.seq"]:
+                # Using calE again makes maxplanegap the least recently used
+                cache.column(f["rec.png"][name])
+                time.sleep(0.01)
+
+        (entry,) = cache.info()
+        self.assertEqual(entry["columns"], ["rec.png/calE", "rec.png/evt.seq"])
+        self.assertLessEqual(cache.size(), cache.max_bytes)
+
+    def test_column_evicted_by_another_process(self):
+        cache = ColumnCache(self.cachedir, max_bytes=10**9)
+        utime, load = os.utime, np.load
+
+        def evicted_before_use(fn):
+            # Another process removes the column between the lookup and its use
+            os.remove(fn)
+            utime(fn)
+
+        def evicted_before_load(fn, mmap_mode=None):
+            raise FileNotFoundError(fn)
+
+        with h5.File(self.path, "r") as f:
+            ds = f["rec.png"]["calE"]
+            cache.column(ds)
+            with mock.patch("pandana.utils.cache.os.utime", evicted_before_use):
+                column = cache.column(ds)
+            np.testing.assert_array_equal(column, ds[()])
+            self.assertIsInstance(column, np.memmap)
+            self.assertEqual(cache.info()[0]["columns"], ["rec.png/calE"])
+
+            with mock.patch("pandana.utils.cache.np.load", evicted_before_load):
+                column = cache.column(ds)
+            np.testing.assert_array_equal(column, ds[()])
+            self.assertFalse(column.flags.writeable)
+
+    def test_command_line(self):
+        cache = ColumnCache(self.cachedir)
+        with h5.File(self.path, "r") as f:
+            cache.column(f["rec.slc"]["calE"])
+
+        out = io.StringIO()
+        with redirect_stdout(out):
+            self.assertEqual(main(["info", self.cachedir]), 0)
+        self.assertIn(os.path.abspath(self.path), out.getvalue())
+
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(main(["purge", self.cachedir]), 0)
+        self.assertEqual(cache.size(), 0)
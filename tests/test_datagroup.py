@@ -0,0 +1,94 @@
+from .context import pandana
+from .sample_file import write_sample_file, indices
+from unittest import TestCase
+import os
+import tempfile
+
+import h5py as h5
+import numpy as np
+import pandas as pd
+
+from pandana.core.datagroup import DataGroup
+
+
+class TestDataGroup(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmpdir.name, "sample.h5")
+        write_sample_file(path)
+        self.file = h5.File(path, "r")
+
+    def tearDown(self):
+        self.file.close()
+        self.tmpdir.cleanup()
+
+    def group(self, name, begin_evt=None, end_evt=None):
+        return DataGroup(self.file, name, begin_evt, end_evt, "evt.seq", indices)
+
+    def test_columns_are_arrays(self):
+        png = self.group("rec.png")
+        calE = png.array("calE")
+        self.assertIsInstance(calE, np.ndarray)
+        self.assertEqual(calE.ndim, 1)
+        self.assertIs(png.array("calE"), calE)
+        np.testing.assert_array_equal(calE, self.file["rec.png"]["calE"][()].flatten())
+
+    def test_vector_column(self):
+        png = self.group("rec.png")
+        direction = png.array("dir")
+        self.assertEqual(direction.shape, self.file["rec.png"]["dir"].shape)
+
+        df = png["dir"]
+        self.assertIsInstance(df, pd.DataFrame)
+        self.assertEqual(list(df.columns), ["dir[0]", "dir[1]", "dir[2]"])
+        self.assertTrue(np.shares_memory(df.to_numpy(), direction))
+
+    def test_series_share_buffer_and_index(self):
+        slc = self.group("rec.slc", 3, 9)
+        calE = slc["calE"]
+        nhit = slc["nhit"]
+        self.assertIs(calE.index, nhit.index)
+        self.assertEqual(calE.index.names, ["run", "subrun", "evt", "subevt"])
+        self.assertTrue(np.shares_memory(calE.to_numpy(), slc.array("calE")))
+
+        seq = slc["evt.seq"].to_numpy()
+        self.assertTrue(np.all((seq >= 3) & (seq <= 9)))
+
+    def test_list_access(self):
+        slc = self.group("rec.slc")
+        df = slc[["calE", "nhit"]]
+        self.assertEqual(list(df.columns), ["calE", "nhit"])
+        self.assertEqual(slc.accessed(), ["calE", "nhit"])
+
+    def test_event_keys(self):
+        png = self.group("rec.png")
+        keys = png.eventKeys()
+        self.assertEqual(keys.dtype, np.uint64)
+        self.assertTrue(np.all(keys[1:] >= keys[:-1]))
+
+        ordinals = png.subobjectOrdinals()
+        for key in np.unique(keys):
+            rows = keys == key
+            np.testing.assert_array_equal(ordinals[rows], np.arange(rows.sum()))
+
+    def test_chunk_read_bytes(self):
+        from pandana.utils.h5utils import chunk_read_bytes
+
+        ds = self.file["rec.png"]["dir"]
+        rows, rowbytes = ds.chunks[0], 3 * 4
+        self.assertEqual(chunk_read_bytes(ds, 0, rows), (rows * rowbytes, rows * rowbytes))
+        self.assertEqual(chunk_read_bytes(ds, 1, rows + 1), (2 * rows * rowbytes, rows * rowbytes))
+        self.assertEqual(chunk_read_bytes(ds, 5, 5), (0, 0))
+        nrows = ds.shape[0]
+        self.assertEqual(chunk_read_bytes(ds, None, None), (nrows * rowbytes, nrows * rowbytes))
+
+    def test_chunk_storage_bytes(self):
+        from pandana.utils.h5utils import chunk_storage_bytes
+
+        ds = self.file["rec.png"]["dir"]
+        rows = ds.chunks[0]
+        first = ds.id.get_chunk_info_by_coord((0, 0)).size
+        self.assertEqual(chunk_storage_bytes(ds, 0, rows), first)
+        self.assertGreater(chunk_storage_bytes(ds, 1, rows + 1), first)
+        self.assertEqual(chunk_storage_bytes(ds, 5, 5), 0)
+        self.assertEqual(chunk_storage_bytes(ds, None, None), ds.id.get_storage_size())
@@ -0,0 +1,296 @@
+from .context import pandana
+from .sample_file import write_sample_file, indices
+from unittest import TestCase, mock, skipIf
+import os
+import tempfile
+
+import h5py
+import numpy as np
+import pandas as pd
+
+import boost_histogram as bh
+
+from pandana.core import expression
+from pandana.core.datagroup import read_dataset, read_rows
+from pandana.core.evaluation import EvalContext
+from pandana.core.loader import Loader
+from pandana.core.tables import Tables
+from pandana.core.spectrum import MultiverseSpectrum, Spectrum
+from pandana.core.var import Var
+from pandana.core.cut import Cut
+
+
+class TestEvaluation(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "sample.h5")
+        write_sample_file(self.path)
+
+        self.calls = {"calE": 0, "nhit": 0}
+
+        def kSlcE(tables):
+            self.calls["calE"] += 1
+            return tables["rec.slc"]["calE"]
+
+        def kNHit(tables):
+            self.calls["nhit"] += 1
+            return tables["rec.slc"]["nhit"]
+
+        self.kSlcE = Var(kSlcE)
+        self.kNHit = Var(kNHit)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_structurally_identical_nodes_evaluate_once(self):
+        cut1 = (self.kSlcE > 1) & (self.kNHit > 30)
+        cut2 = (self.kSlcE > 1) & (self.kNHit > 30)
+        self.assertIsNot(cut1, cut2)
+        self.assertEqual(cut1._key, cut2._key)
+        self.assertNotEqual(cut1._key, ((self.kSlcE > 2) & (self.kNHit > 30))._key)
+
+        loader = Loader([self.path], "evt.seq", "spill", indices)
+        spec1 = Spectrum(loader, cut1, self.kSlcE)
+        spec2 = Spectrum(loader, cut2, self.kSlcE + self.kSlcE)
+        loader.Go()
+
+        # Once for tracing, once for the file
+        self.assertEqual(self.calls, {"calE": 2, "nhit": 2})
+        self.assertEqual(spec1.entries(), spec2.entries())
+
+    def test_plain_functions_as_operands(self):
+        def nhit(tables):
+            return tables["rec.slc"]["nhit"]
+
+        def passes(tables):
+            return tables["rec.slc"]["nhit"] > 30
+
+        cuts = [(self.kSlcE > 1) & passes, (self.kSlcE > 1) | passes]
+        self.assertEqual(cuts[0]._key, ((self.kSlcE > 1) & passes)._key)
+        tables = Tables(self.path, "evt.seq", "spill", indices)
+        calE, hits = tables["rec.slc"]["calE"], tables["rec.slc"]["nhit"]
+        np.testing.assert_array_equal(cuts[0](tables), (calE > 1) & (hits > 30))
+        np.testing.assert_array_equal(cuts[1](tables), (calE > 1) | (hits > 30))
+        pd.testing.assert_series_equal((self.kSlcE + nhit)(tables), calE + hits)
+        tables.closeFile()
+
+    def test_results_are_released(self):
+        cut = (self.kSlcE > 1) & ~(self.kNHit > 30)
+        tables = Tables(self.path, "evt.seq", "spill", indices)
+        tables.plan([cut, self.kSlcE])
+
+        cut(tables)
+        # Only the results still waiting for a consumer are kept
+        self.assertEqual(set(tables._context._results), {cut._key, self.kSlcE._key})
+
+        tables.release(cut)
+        self.assertEqual(set(tables._context._results), {self.kSlcE._key})
+
+        self.kSlcE(tables)
+        self.assertEqual(self.calls["calE"], 1)
+
+        tables.closeFile()
+        self.assertEqual(tables._context._results, {})
+
+
+class TestFusedExpressions(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "sample.h5")
+        write_sample_file(self.path, nevents=60)
+
+        self.kE = Var.column("rec.slc", "calE")
+        self.kNHit = Var.column("rec.slc", "nhit")
+        self.kPngE = Var.column("rec.png", "calE")
+
+        # The same Vars and Cuts, evaluated node by node
+        self.nodes = {
+            "kE": Var(lambda tables: tables["rec.slc"]["calE"]),
+            "kNHit": Var(lambda tables: tables["rec.slc"]["nhit"]),
+        }
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        expression.set_engine("numexpr" if expression.numexpr is not None else "numpy")
+
+    def build(self, kE, kNHit):
+        return [
+            (kE > 1) & (kE < 4) & ~(kNHit < 20),
+            ((kE * kNHit) / 2 > 30) | (kNHit == 50),
+            kE * 1000 - 5,
+            kE + kE,
+            kNHit * 2 + 1,
+            kE / kNHit,
+        ]
+
+    def evaluate(self, nodes):
+        tables = Tables(self.path, "evt.seq", "spill", indices)
+        results = [node(tables) for node in nodes]
+        tables.closeFile()
+        return results
+
+    def check_engine(self, name):
+        expression.set_engine(name)
+        fused = self.build(self.kE, self.kNHit)
+        for node in fused:
+            self.assertIsNotNone(node._expr)
+        expected = self.evaluate(self.build(self.nodes["kE"], self.nodes["kNHit"]))
+        for result, reference in zip(self.evaluate(fused), expected):
+            pd.testing.assert_series_equal(result, reference)
+
+    def test_numpy_matches_node_by_node(self):
+        self.check_engine("numpy")
+
+    @skipIf(expression.numexpr is None, "numexpr is not installed")
+    def test_numexpr_matches_node_by_node(self):
+        with mock.patch.object(expression, "NUMEXPR_MIN_ROWS", 0):
+            self.check_engine("numexpr")
+
+    @skipIf(expression.numexpr is None, "numexpr is not installed")
+    def test_constants_of_each_type_get_their_kernel(self):
+        nhit = np.array([22, 178, 122], dtype=np.int32)
+        expression.set_engine("numexpr")
+        with mock.patch.object(expression, "NUMEXPR_MIN_ROWS", 0):
+            for value in (100000000, 100000000.0, 3, 3.0, True):
+                expr = ("mul", ("column", "rec.slc", "nhit"), ("const", value))
+                result = expression.evaluate(expr, {"nhit": nhit})
+                expected = (pd.Series(nhit) * value).to_numpy()
+                self.assertEqual(result.dtype, expected.dtype)
+                np.testing.assert_array_equal(result, expected)
+
+    def test_var_times_cut(self):
+        masks = [self.kE > 1, Cut(lambda tables: tables["rec.slc"]["nhit"] > 30)]
+        tables = Tables(self.path, "evt.seq", "spill", indices)
+        calE, nhit = tables["rec.slc"]["calE"], tables["rec.slc"]["nhit"]
+        expected = [calE * (calE > 1), calE * (nhit > 30)]
+        for kE in (self.kE, self.nodes["kE"]):
+            for mask, reference in zip(masks, expected):
+                pd.testing.assert_series_equal((kE * mask)(tables), reference)
+        tables.closeFile()
+
+        loader = Loader([self.path], "evt.seq", "spill", indices)
+        weighted = Spectrum(loader, self.kE > 0, self.kE, self.kE * masks[1])
+        loader.Go()
+        self.assertGreater(weighted.integral(), 0)
+
+    def test_operands_are_not_evaluated(self):
+        cut = (self.kE > 1) & (self.kNHit > 30)
+        tables = Tables(self.path, "evt.seq", "spill", indices)
+        tables.plan([cut])
+        cut(tables)
+        self.assertEqual(set(tables._context._results), {cut._key})
+        # Equal to the cut with the same structure made from functions
+        self.assertEqual(cut._key, ((self.kE > 1) & (self.kNHit > 30))._key)
+        tables.closeFile()
+
+    def test_groups_are_not_mixed(self):
+        cut = (self.kE > 1) & (self.kPngE > 0.5).any(["run", "subrun", "evt", "subevt"])
+        self.assertIsNone(cut._expr)
+        self.assertIsNone((self.kE + self.kPngE)._expr)
+        self.assertIsNone((self.kE > [1, 2])._expr)
+
+        loader = Loader([self.path], "evt.seq", "spill", indices)
+        fused = Spectrum(loader, cut & (self.kNHit > 20), self.kE * 2)
+        kE, kNHit = self.nodes["kE"], self.nodes["kNHit"]
+        kPngE = Var(lambda tables: tables["rec.png"]["calE"])
+        cut = (kE > 1) & (kPngE > 0.5).any(["run", "subrun", "evt", "subevt"])
+        plain = Spectrum(loader, cut & (kNHit > 20), kE * 2)
+        loader.Go()
+        self.assertGreater(fused.entries(), 0)
+        pd.testing.assert_series_equal(fused.df(), plain.df())
+
+
+class TestShortCircuit(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "sample.h5")
+        write_sample_file(self.path, nevents=80)
+
+        self.kE = Var(lambda tables: tables["rec.slc"]["calE"])
+        self.kNHit = Var(lambda tables: tables["rec.slc"]["nhit"])
+        self.kPngE = Var(lambda tables: tables["rec.png"]["calE"])
+        self.kPOT = Var(lambda tables: tables["spill"]["spillpot"])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fill(self, **kwargs):
+        loader = Loader([self.path], "evt.seq", "spill", indices, **kwargs)
+        levels = ["run", "subrun", "evt", "subevt"]
+        early = self.kE > 2
+        spectra = [
+            Spectrum(loader, early & (self.kNHit > 30), self.kE, self.kPOT, exposure=self.kPOT),
+            Spectrum(
+                loader,
+                early & (self.kPngE > 0.5).any(levels),
+                self.kPngE,
+                axes=bh.axis.Regular(10, 0, 5),
+            ),
+            MultiverseSpectrum(
+                loader,
+                (self.kNHit > 20) & early,
+                self.kE,
+                [self.kPOT, self.kE * 0.1],
+                axes=bh.axis.Regular(10, 0, 5),
+            ),
+        ]
+        loader.Go()
+        return loader, spectra
+
+    def test_matches_full_evaluation(self):
+        cache = os.path.join(self.tmpdir.name, "cache")
+        for kwargs in ({}, {"chunk_events": 11}, {"cache": cache}):
+            _, full = self.fill(**kwargs)
+            loader, short = self.fill(short_circuit=True, **kwargs)
+            self.assertGreater(short[0].entries(), 0)
+            pd.testing.assert_series_equal(short[0].df(), full[0].df())
+            pd.testing.assert_series_equal(short[0].weight(), full[0].weight())
+            self.assertEqual(short[0].exposure(), full[0].exposure())
+            for s, f in zip(short[1:], full[1:]):
+                self.assertEqual(s.entries(), f.entries())
+                np.testing.assert_allclose(s.hist().values(), f.hist().values())
+            self.assertGreater(loader.readAmplification()["used"], 0)
+
+    def test_terms(self):
+        a, b, c = self.kE > 1, self.kNHit > 30, self.kPOT > 0.5
+        self.assertEqual([t._key for t in ((a & b) & c).terms()], [a._key, b._key, c._key])
+        self.assertEqual([t._key for t in (a | b).terms()], [(a | b)._key])
+
+    def test_views_are_shared(self):
+        tables = Tables(self.path, "evt.seq", "spill", indices, short_circuit=True)
+        early, hits, more = self.kE > 2, self.kNHit > 30, self.kNHit > 40
+        tables.passing(early & hits)
+        tables.passing(early & more)
+        view = tables.passing(early)
+        self.assertIsNot(view, tables)
+        self.assertEqual(list(tables._selections), [early._key])
+        self.assertEqual(list(view._selections), [hits._key, more._key])
+
+        # The view only has the rows of the events with a passing slice
+        slices = view["rec.slc"].pandasIndex()
+        events = set(tables["rec.slc"].pandasIndex()[early(tables).to_numpy()].droplevel("subevt"))
+        self.assertEqual(set(slices.droplevel("subevt")), events)
+        tables.closeFile()
+        self.assertEqual(tables._selections, {})
+
+    def test_without_short_circuit(self):
+        tables = Tables(self.path, "evt.seq", "spill", indices)
+        self.assertIs(tables.passing(self.kE > 2), tables)
+        tables.closeFile()
+
+
+class TestReadRows(TestCase):
+    def test_matches_full_read(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "rows.h5")
+            with h5py.File(path, "w") as f:
+                f.create_dataset("x", data=np.arange(100.0).reshape(-1, 1), chunks=(8, 1))
+            with h5py.File(path, "r") as f:
+                ds = f["x"]
+                for begin, end, rows in [
+                    (None, None, np.array([0, 1, 2, 40, 41, 99])),
+                    (5, 70, np.array([0, 3, 30, 31, 64])),
+                    (5, 70, np.array([], dtype=np.int64)),
+                ]:
+                    expected = read_dataset(ds, begin, end)[rows]
+                    np.testing.assert_array_equal(read_rows(ds, begin, end, rows), expected)
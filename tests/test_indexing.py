@@ -0,0 +1,77 @@
+from .context import pandana
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from pandana.core.indexing import align, packing, pack
+
+
+def make_index(nevents, max_per_event, seed):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, max_per_event + 1, nevents)
+    evt = np.repeat(np.arange(nevents, dtype=np.uint32) * 3 + 1, counts)
+    subevt = np.concatenate([np.arange(n, dtype=np.uint32) for n in counts])
+    run = np.full(evt.size, 1000, dtype=np.uint32)
+    return pd.MultiIndex.from_arrays([run, evt, subevt], names=["run", "evt", "subevt"])
+
+
+class TestAlign(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        self.fine = pd.Series(rng.random(len(make_index(50, 3, 1))), index=make_index(50, 3, 1))
+        events = make_index(50, 1, 2).droplevel("subevt")
+        self.coarse = pd.Series(rng.random(len(events)) > 0.5, index=events)
+
+    def assertAlignedLikePandas(self, left, right, **kwargs):
+        ours = align(left, right, **kwargs)
+        theirs = left.align(right, axis=0, **kwargs)
+        for a, b in zip(ours, theirs):
+            pd.testing.assert_index_equal(a.index, b.index)
+            np.testing.assert_array_equal(a.to_numpy(), b.to_numpy())
+
+    def test_inner_fine_coarse(self):
+        self.assertAlignedLikePandas(self.fine, self.coarse, join="inner")
+        self.assertAlignedLikePandas(self.coarse, self.fine, join="inner")
+
+    def test_inner_same_levels(self):
+        other = self.fine.iloc[::2] * 2
+        self.assertAlignedLikePandas(self.fine, other, join="inner")
+
+    def test_right_fill(self):
+        self.assertAlignedLikePandas(
+            self.coarse.astype(float), self.fine, join="right", fill_value=0
+        )
+        self.assertAlignedLikePandas(self.fine.iloc[::3], self.fine, join="right", fill_value=0)
+
+    def test_dataframe(self):
+        df = pd.DataFrame({"a": self.fine, "b": -self.fine})
+        self.assertAlignedLikePandas(df, self.coarse, join="inner")
+
+    def test_packing_too_wide_falls_back(self):
+        index = pd.MultiIndex.from_arrays(
+            [np.array([0, 2**40], dtype=np.int64), np.array([0, 2**40], dtype=np.int64)],
+            names=["a", "b"],
+        )
+        self.assertIsNone(packing([index], ["a", "b"]))
+        s = pd.Series([1, 2], index=index)
+        self.assertAlignedLikePandas(s, s.iloc[:1], join="inner")
+
+    def test_pack_preserves_order(self):
+        layout = packing([self.fine.index], ["run", "evt", "subevt"])
+        keys = pack(self.fine.index, layout)
+        self.assertTrue(np.all(keys[1:] > keys[:-1]))
+
+    def test_align_all(self):
+        from pandana.core.indexing import align_all
+
+        other = self.fine.iloc[::2] * 2
+        a, b, c = align_all([self.coarse, self.fine, other])
+        index = other.index[np.isin(other.index.droplevel("subevt"), self.coarse.index)]
+        for x in (a, b, c):
+            pd.testing.assert_index_equal(x.index, index)
+        np.testing.assert_array_equal(c.to_numpy(), other.loc[index].to_numpy())
+        np.testing.assert_array_equal(b.to_numpy(), self.fine.loc[index].to_numpy())
+        np.testing.assert_array_equal(
+            a.to_numpy(), self.coarse.loc[index.droplevel("subevt")].to_numpy()
+        )
@@ -0,0 +1,376 @@
+from .context import pandana
+from .sample_file import write_sample_file, indices, KL
+from .mpirun import mpi_available, run_mpi
+from unittest import TestCase, skipIf
+import json
+import os
+import tempfile
+
+import h5py as h5
+import numpy as np
+import pandas as pd
+
+from pandana.core.loader import Loader
+from pandana.core.tables import Tables
+from pandana.core.spectrum import Spectrum
+from pandana.core.var import Var
+from pandana.core.cut import Cut
+
+
+kSlcE = Var(lambda tables: tables["rec.slc"]["calE"])
+kPngE = Var(lambda tables: tables["rec.png"]["calE"].groupby(level=KL).sum())
+kNHitCut = Cut(lambda tables: tables["rec.slc"]["nhit"] > 30)
+kPOT = Var(lambda tables: tables["spill"]["spillpot"])
+
+
+class TestLoaderGo(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = []
+        for seed in range(2):
+            path = os.path.join(self.tmpdir.name, "sample%d.h5" % seed)
+            write_sample_file(path, seed=seed)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def loader(self):
+        return Loader(self.files, idcol="evt.seq", main_table_name="spill", indices=indices)
+
+    def read_group(self, path, group, columns):
+        with h5.File(path, "r") as f:
+            return pd.DataFrame({c: f[group][c][()].flatten() for c in columns})
+
+    def test_trace_columns(self):
+        loader = self.loader()
+        Spectrum(loader, kNHitCut & (kSlcE > 1), kSlcE)
+        Spectrum(loader, kSlcE > 2, kPngE, kPOT)
+        tables = Tables(self.files[0], "evt.seq", "spill", indices)
+        columns = loader.traceColumns(tables)
+        tables.closeFile()
+
+        self.assertEqual(
+            {k: sorted(v) for k, v in columns.items()},
+            {"rec.slc": ["calE", "nhit"], "rec.png": ["calE"], "spill": ["spillpot"]},
+        )
+
+    def test_trace_survives_failing_function(self):
+        def kFirstSlice(tables):
+            df = tables["rec.slc"]["calE"]
+            return df.iloc[[0]] + tables["rec.slc"]["nhit"].iloc[0]
+
+        tables = Tables(self.files[0], "evt.seq", "spill", indices)
+        columns = tables.traceColumns([kFirstSlice])
+        tables.closeFile()
+        self.assertEqual(columns, {"rec.slc": ["calE"]})
+
+    def test_go_matches_direct_read(self):
+        loader = self.loader()
+        spec = Spectrum(loader, kNHitCut & (kSlcE > 1), kSlcE)
+        loader.Go()
+
+        expected = []
+        for path in self.files:
+            df = self.read_group(path, "rec.slc", ["calE", "nhit"])
+            expected.append(df["calE"][(df["nhit"] > 30) & (df["calE"] > 1)].to_numpy())
+        expected = np.concatenate(expected)
+
+        np.testing.assert_array_equal(spec.df().to_numpy(), expected)
+        self.assertEqual(spec.entries(), expected.size)
+        self.assertEqual(spec.integral(), expected.size)
+
+    def test_chunked_matches_unchunked(self):
+        cut = kNHitCut & (kSlcE > 1)
+        loader = self.loader()
+        spec = Spectrum(loader, cut, kSlcE)
+        prongs = Spectrum(loader, kSlcE > 2, kPngE, kPOT)
+        loader.Go()
+
+        for chunk_events in [1, 3, 7, 100]:
+            chunked = Loader(
+                self.files, "evt.seq", "spill", indices, chunk_events=chunk_events
+            )
+            chunked_spec = Spectrum(chunked, cut, kSlcE)
+            chunked_prongs = Spectrum(chunked, kSlcE > 2, kPngE, kPOT)
+            chunked.Go()
+
+            pd.testing.assert_series_equal(chunked_spec.df(), spec.df())
+            pd.testing.assert_series_equal(chunked_prongs.df(), prongs.df())
+            pd.testing.assert_series_equal(chunked_prongs.weight(), prongs.weight())
+
+    def test_chunk_ranges(self):
+        tables = Tables(self.files[0], "evt.seq", "spill", indices)
+        chunks = list(tables.chunks(6))
+        self.assertEqual([(c._begin_evt, c._end_evt) for c in chunks],
+                         [(0, 5), (6, 11), (12, 17), (18, 19)])
+        nslices = sum(len(c["rec.slc"]["calE"]) for c in chunks)
+        self.assertEqual(nslices, len(tables["rec.slc"]["calE"]))
+        tables.closeFile()
+
+    def test_event_costs(self):
+        tables = Tables(self.files[0], "evt.seq", "spill", indices)
+        seqs, costs = tables.eventCosts({"rec.slc": 1, "rec.png": 2, "missing": 5})
+        slc = tables["rec.slc"].eventKeys()
+        png = tables["rec.png"].eventKeys()
+        tables.closeFile()
+
+        expected = [1 + np.sum(slc == s) + 2 * np.sum(png == s) for s in seqs]
+        np.testing.assert_array_equal(costs, expected)
+
+    def test_row_range_table(self):
+        from pandana.core.datagroup import DataGroup
+
+        tables = Tables(self.files[0], "evt.seq", "spill", indices)
+        groups = ["rec.slc", "rec.png"]
+        for weights in [None, {"rec.png": 3}]:
+            table = tables.rowRangeTable(3, groups, weights)
+            self.assertEqual(table.shape, (3, 6))
+            self.assertEqual(table[0, 0], 0)
+            self.assertEqual(table[-1, 1], 19)
+            for begin_evt, end_evt, *rows in table:
+                for i, name in enumerate(groups):
+                    group = DataGroup(
+                        tables._file, name, begin_evt, end_evt, "evt.seq", indices
+                    )
+                    self.assertEqual(
+                        (group._begin_row, group._end_row), (rows[2 * i], rows[2 * i + 1])
+                    )
+        tables.closeFile()
+
+    def test_global_event_space(self):
+        loader = self.loader()
+        spec = Spectrum(loader, kSlcE > 2, kPngE, kPOT)
+        loader.Go()
+
+        for chunk_events in [None, 4]:
+            spread = Loader(
+                self.files,
+                "evt.seq",
+                "spill",
+                indices,
+                chunk_events=chunk_events,
+                event_space="global",
+            )
+            self.assertEqual(
+                spread.globalRowRanges(), [(f, (0, 20)) for f in self.files]
+            )
+            spread_spec = Spectrum(spread, kSlcE > 2, kPngE, kPOT)
+            spread.Go()
+            pd.testing.assert_series_equal(spread_spec.df(), spec.df())
+            pd.testing.assert_series_equal(spread_spec.weight(), spec.weight())
+
+    def test_prefetch_matches_serial_reads(self):
+        loader = self.loader()
+        spec = Spectrum(loader, kNHitCut & (kSlcE > 1), kSlcE)
+        prongs = Spectrum(loader, kSlcE > 2, kPngE, kPOT)
+        loader.Go()
+
+        for prefetch in ["thread", "process"]:
+            for chunk_events in [None, 7]:
+                ahead = Loader(
+                    self.files,
+                    "evt.seq",
+                    "spill",
+                    indices,
+                    chunk_events=chunk_events,
+                    prefetch=prefetch,
+                )
+                ahead_spec = Spectrum(ahead, kNHitCut & (kSlcE > 1), kSlcE)
+                ahead_prongs = Spectrum(ahead, kSlcE > 2, kPngE, kPOT)
+                ahead.Go()
+
+                pd.testing.assert_series_equal(ahead_spec.df(), spec.df())
+                pd.testing.assert_series_equal(ahead_prongs.df(), prongs.df())
+                pd.testing.assert_series_equal(ahead_prongs.weight(), prongs.weight())
+
+        with self.assertRaises(ValueError):
+            Loader(self.files, "evt.seq", "spill", indices, prefetch="always")
+
+    def test_read_plan_seeds_groups(self):
+        from pandana.core.prefetch import read_columns
+
+        tables = Tables(self.files[0], "evt.seq", "spill", indices)
+        plan = tables.readPlan({"rec.slc": ["calE"], "missing": ["x"]})
+        self.assertEqual(list(plan), ["rec.slc"])
+        self.assertEqual(
+            plan["rec.slc"][2], ["run", "subrun", "evt", "subevt", "calE"]
+        )
+
+        arrays = read_columns(tables.filename(), plan)
+        tables.seed(arrays)
+        self.assertIs(tables["rec.slc"].array("calE"), arrays["rec.slc"]["calE"])
+        self.assertEqual(tables.readPlan({"rec.slc": ["calE"]}), {})
+        tables.closeFile()
+
+    def test_align_chunks(self):
+        tables = Tables(self.files[0], "evt.seq", "spill", indices)
+        self.assertEqual(
+            tables.alignChunks({"rec.slc": ["calE"], "rec.png": ["calE", "dir"]}),
+            "rec.png",
+        )
+        png = tables["rec.png"].eventKeys()
+        rows = tables["rec.png"]._group["dir"].chunks[0]
+
+        table = tables.rowRangeTable(3, ["rec.png"])
+        for begin in table[1:, 2]:
+            # The rank starts at the event holding the nearest chunk boundary
+            boundary = int(round(begin / rows)) * rows
+            boundary = boundary if boundary >= begin else boundary + rows
+            self.assertTrue(boundary == begin or png[begin] == png[boundary])
+        self.assertTrue(np.all(np.diff(table[:, 0]) > 0))
+        np.testing.assert_array_equal(table[1:, 0], table[:-1, 1] + 1)
+
+        for chunk_events in [1, 3, 7]:
+            chunks = list(tables.chunks(chunk_events))
+            self.assertEqual(chunks[0]._begin_evt, 0)
+            self.assertEqual(chunks[-1]._end_evt, 19)
+            for a, b in zip(chunks[:-1], chunks[1:]):
+                self.assertEqual(b._begin_evt, a._end_evt + 1)
+        tables.closeFile()
+
+    def test_read_amplification(self):
+        loader = self.loader()
+        spec = Spectrum(loader, kSlcE > 2, kPngE, kPOT)
+        loader.Go()
+        report = loader.readAmplification()
+        self.assertEqual(report["decompressed"], report["used"])
+        self.assertEqual(report["amplification"], 1.0)
+
+        for align_chunks in [False, True]:
+            chunked = Loader(
+                self.files,
+                "evt.seq",
+                "spill",
+                indices,
+                chunk_events=3,
+                align_chunks=align_chunks,
+            )
+            chunked_spec = Spectrum(chunked, kSlcE > 2, kPngE, kPOT)
+            chunked.Go()
+            pd.testing.assert_series_equal(chunked_spec.df(), spec.df())
+            chunked_report = chunked.readAmplification()
+            self.assertEqual(chunked_report["used"], report["used"])
+            self.assertGreaterEqual(chunked_report["amplification"], 1.0)
+
+    def test_reuse_buffers(self):
+        loader = self.loader()
+        spec = Spectrum(loader, kNHitCut & (kSlcE > 1), kSlcE)
+        prongs = Spectrum(loader, kSlcE > 2, kPngE, kPOT)
+        everything = Spectrum(loader, kSlcE > -1, kSlcE)
+        loader.Go()
+
+        for chunk_events in [None, 5]:
+            pooled = Loader(
+                self.files,
+                "evt.seq",
+                "spill",
+                indices,
+                chunk_events=chunk_events,
+                reuse_buffers=True,
+            )
+            pooled_spec = Spectrum(pooled, kNHitCut & (kSlcE > 1), kSlcE)
+            pooled_prongs = Spectrum(pooled, kSlcE > 2, kPngE, kPOT)
+            pooled_everything = Spectrum(pooled, kSlcE > -1, kSlcE)
+            pooled.Go()
+
+            pd.testing.assert_series_equal(pooled_spec.df(), spec.df())
+            pd.testing.assert_series_equal(pooled_prongs.df(), prongs.df())
+            pd.testing.assert_series_equal(pooled_prongs.weight(), prongs.weight())
+            pd.testing.assert_series_equal(pooled_everything.df(), everything.df())
+
+        # The second file reuses the buffers of the first
+        pooled = Loader(self.files[:1], "evt.seq", "spill", indices, reuse_buffers=True)
+        Spectrum(pooled, kSlcE > 2, kPngE, kPOT)
+        pooled.Go()
+        allocations = pooled._pool.allocations
+        pooled._files = [self.files[0]] * 3
+        pooled.Go()
+        self.assertEqual(pooled._pool.allocations, allocations)
+
+    def test_column_cache(self):
+        loader = self.loader()
+        spec = Spectrum(loader, kNHitCut & (kSlcE > 1), kSlcE)
+        prongs = Spectrum(loader, kSlcE > 2, kPngE, kPOT)
+        loader.Go()
+
+        cachedir = os.path.join(self.tmpdir.name, "cache")
+        for prefetch in [None, "thread", None]:
+            cached = Loader(
+                self.files, "evt.seq", "spill", indices, prefetch=prefetch, cache=cachedir
+            )
+            cached_spec = Spectrum(cached, kNHitCut & (kSlcE > 1), kSlcE)
+            cached_prongs = Spectrum(cached, kSlcE > 2, kPngE, kPOT)
+            cached.Go()
+
+            pd.testing.assert_series_equal(cached_spec.df(), spec.df())
+            pd.testing.assert_series_equal(cached_prongs.df(), prongs.df())
+            pd.testing.assert_series_equal(cached_prongs.weight(), prongs.weight())
+            self.assertEqual(len(cached._cache.info()), len(self.files))
+
+
+@skipIf(not mpi_available(), "MPI is not installed")
+class TestLoaderMPI(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = []
+        for seed in range(2):
+            path = os.path.join(self.tmpdir.name, "sample%d.h5" % seed)
+            write_sample_file(path, seed=seed)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_row_ranges_are_only_found_by_root(self):
+        code = (
+            "import json, sys\n"
+            "from mpi4py import MPI\n"
+            "from pandana.core import Loader, Spectrum, Var\n"
+            "from pandana.core.tables import Tables\n"
+            "from tests.sample_file import indices\n"
+            "kE = Var(lambda tables: tables['rec.slc']['calE'])\n"
+            "def fill(**kwargs):\n"
+            "    loader = Loader(sys.argv[1:], 'evt.seq', 'spill', indices, **kwargs)\n"
+            "    spectrum = Spectrum(loader, kE > 1, kE)\n"
+            "    loader.Go()\n"
+            "    return spectrum\n"
+            "serial = fill(backend='serial')\n"
+            "def calculateEventRange(*args):\n"
+            "    raise AssertionError('calculateEventRange was called')\n"
+            "Tables.calculateEventRange = calculateEventRange\n"
+            "spectrum = fill(distributed=True, gather_events=True)\n"
+            "if MPI.COMM_WORLD.rank == 0:\n"
+            "    print(json.dumps([spectrum.entries(), serial.entries(),\n"
+            "                      sorted(spectrum.df()), sorted(serial.df())]))\n"
+        )
+        entries, expected, df, serial = json.loads(run_mpi(code, 3, *self.files))
+        self.assertGreater(expected, 0)
+        self.assertEqual(entries, expected)
+        self.assertEqual(df, serial)
+
+    def test_root_failure_is_raised_on_every_rank(self):
+        code = (
+            "import json, sys\n"
+            "from mpi4py import MPI\n"
+            "from pandana.core import Loader, Spectrum, Var\n"
+            "from pandana.core.tables import Tables\n"
+            "from tests.sample_file import indices\n"
+            "def rowRangeTable(*args):\n"
+            "    raise KeyError('missing group')\n"
+            "Tables.rowRangeTable = rowRangeTable\n"
+            "kE = Var(lambda tables: tables['rec.slc']['calE'])\n"
+            "loader = Loader(sys.argv[1:], 'evt.seq', 'spill', indices)\n"
+            "Spectrum(loader, kE > 1, kE)\n"
+            "raised = None\n"
+            "try:\n"
+            "    loader.Go()\n"
+            "except KeyError as e:\n"
+            "    raised = repr(e)\n"
+            "raised = MPI.COMM_WORLD.gather(raised)\n"
+            "if MPI.COMM_WORLD.rank == 0:\n"
+            "    print(json.dumps(raised))\n"
+        )
+        raised = json.loads(run_mpi(code, 3, *self.files))
+        self.assertEqual(raised, ["KeyError('missing group')"] * 3)
+
@@ -1,5 +1,9 @@
 import unittest
-from pandana.utils.mpiutils import calculate_slice_for_rank
+from pandana.utils.mpiutils import (
+    calculate_slice_for_rank,
+    calculate_weighted_slice_for_rank,
+    calculate_global_slices_for_rank,
+)
 
 
 class TestCalculateSliceForRank(unittest.TestCase):
@@ -30,3 +34,57 @@ class TestCalculateSliceForRank(unittest.TestCase):
         for myrank in range(0, 100):
             start, stop = calculate_slice_for_rank(myrank, 100, 100)
             self.assertEqual(stop - start, 1)
+
+
+class TestCalculateWeightedSliceForRank(unittest.TestCase):
+    def slices(self, nranks, costs):
+        return [calculate_weighted_slice_for_rank(r, nranks, costs) for r in range(nranks)]
+
+    def test_slices_cover_everything(self):
+        costs = [5, 1, 1, 1, 8, 2, 2, 1, 1, 30, 1, 1]
+        for nranks in range(1, len(costs) + 1):
+            slices = self.slices(nranks, costs)
+            self.assertEqual(slices[0][0], 0)
+            self.assertEqual(slices[-1][1], len(costs))
+            for (low, high), (nextlow, _) in zip(slices, slices[1:]):
+                self.assertLess(low, high)
+                self.assertEqual(high, nextlow)
+
+    def test_balanced_costs(self):
+        self.assertEqual(
+            self.slices(3, [1, 1, 1, 10, 1, 1, 1, 1, 1, 1]), [(0, 3), (3, 4), (4, 10)]
+        )
+        self.assertEqual(self.slices(2, [1] * 6), [(0, 3), (3, 6)])
+
+    def test_one_expensive_item(self):
+        self.assertEqual(
+            self.slices(4, [100, 1, 1, 1, 1]), [(0, 1), (1, 2), (2, 3), (3, 5)]
+        )
+
+    def test_too_many_ranks(self):
+        with self.assertRaises(ValueError):
+            calculate_weighted_slice_for_rank(0, 3, [1, 1])
+
+
+class TestCalculateGlobalSlicesForRank(unittest.TestCase):
+    def test_spans_arrays(self):
+        sizes = [3, 0, 4, 1, 5]
+        self.assertEqual(calculate_global_slices_for_rank(0, 2, sizes), [(0, 0, 3), (2, 0, 4)])
+        self.assertEqual(calculate_global_slices_for_rank(1, 2, sizes), [(3, 0, 1), (4, 0, 5)])
+
+    def test_more_ranks_than_items_of_one_array(self):
+        sizes = [2, 2, 2]
+        self.assertEqual(
+            [calculate_global_slices_for_rank(r, 6, sizes) for r in range(6)],
+            [[(0, 0, 1)], [(0, 1, 2)], [(1, 0, 1)], [(1, 1, 2)], [(2, 0, 1)], [(2, 1, 2)]],
+        )
+
+    def test_covers_everything(self):
+        sizes = [7, 1, 12, 3]
+        for nranks in range(1, sum(sizes) + 1):
+            covered = [0] * len(sizes)
+            for r in range(nranks):
+                for i, low, high in calculate_global_slices_for_rank(r, nranks, sizes):
+                    self.assertEqual(low, covered[i])
+                    covered[i] = high
+            self.assertEqual(covered, sizes)
@@ -0,0 +1,105 @@
+from .context import pandana
+from .sample_file import write_sample_file, indices, KL
+import csv
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from pandana.core import Cut, Loader, Spectrum, Var
+from pandana.utils import profiling
+from pandana.utils.profiling import Profiler
+
+
+class TestProfiler(unittest.TestCase):
+    def test_sections_count_their_own_time(self):
+        profiler = Profiler()
+        with profiling.activate(profiler), profiling.on_file("a.h5"):
+            with profiling.section("outer", "x"):
+                time.sleep(0.02)
+                with profiling.section("inner", "y", nbytes=(10, 40)):
+                    time.sleep(0.05)
+            with profiling.section("inner", "y", file="b.h5", nbytes=(1, 2)):
+                pass
+        self.assertIsNone(profiling.active())
+
+        records = {(r["file"], r["stage"]): r for r in profiler.records()}
+        self.assertLess(records["a.h5", "outer"]["seconds"], 0.045)
+        self.assertGreaterEqual(records["a.h5", "inner"]["seconds"], 0.05)
+        self.assertEqual(records["a.h5", "inner"]["bytes_stored"], 10)
+        self.assertEqual(records["a.h5", "inner"]["bytes_decompressed"], 40)
+        self.assertEqual(records["b.h5", "inner"]["calls"], 1)
+
+        report = profiler.report()
+        self.assertEqual(report["ranks"], 1)
+        self.assertEqual(report["stages"]["inner"]["imbalance"], 0.0)
+
+    def test_inactive_sections_do_nothing(self):
+        with profiling.section("read", "x"):
+            pass
+        self.assertIsNone(profiling.active())
+
+    def test_names(self):
+        kE = Var(lambda tables: tables["rec.slc"]["calE"], name="kE")
+
+        def kBig(tables):
+            return tables["rec.slc"]["nhit"] > 30
+
+        self.assertEqual(kE.name(), "kE")
+        self.assertEqual(((kE > 1) & Cut(kBig)).name(), "and(gt(kE), kBig)")
+        self.assertEqual(kE.sum(KL).name(), "sum(kE)")
+
+
+class TestLoaderProfile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = []
+        for seed in range(2):
+            path = os.path.join(self.tmpdir.name, "sample%d.h5" % seed)
+            write_sample_file(path, nevents=30, seed=seed)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_go(self):
+        kE = Var(lambda tables: tables["rec.slc"]["calE"], name="kE")
+        loader = Loader(self.files, "evt.seq", "spill", indices, profile=True, chunk_events=8)
+        # Per spill weights are aligned to the slices
+        kPOT = Var(lambda tables: tables["spill"]["spillpot"])
+        Spectrum(loader, kE > 1, kE, kPOT)
+        loader.Go()
+
+        report = loader.profileReport()
+        # Sections only count their own time, so the stages add up to the wall time
+        total = sum(spread["mean"] for spread in report["stages"].values())
+        self.assertAlmostEqual(total, report["wall"]["mean"], delta=0.01 * total)
+        self.assertGreater(report["peak_rss"]["max"], 0)
+        for stage in ("open", "search", "read", "evaluate", "align", "fill", "finish"):
+            self.assertIn(stage, report["stages"])
+
+        records = report["records"]
+        self.assertEqual({r["file"] for r in records if r["stage"] == "read"}, set(self.files))
+        reads = [r for r in records if r["name"] == "rec.slc/calE"]
+        self.assertEqual(len(reads), 2)
+        for r in reads:
+            self.assertGreater(r["bytes_stored"], 0)
+            self.assertGreater(r["bytes_decompressed"], 0)
+        self.assertIn("kE", {r["name"] for r in records if r["stage"] == "evaluate"})
+
+        path = os.path.join(self.tmpdir.name, "profile.csv")
+        loader.profileReport(path)
+        with open(path) as f:
+            self.assertEqual(len(list(csv.DictReader(f))), len(records))
+        path = os.path.join(self.tmpdir.name, "profile.json")
+        loader.profileReport(path)
+        with open(path) as f:
+            self.assertEqual(json.load(f)["ranks"], 1)
+
+    def test_not_profiled(self):
+        loader = Loader(self.files, "evt.seq", "spill", indices)
+        loader.Go()
+        self.assertIsNone(loader.profiler())
+        with self.assertRaises(ValueError):
+            loader.profileReport()
@@ -0,0 +1,83 @@
+from .context import pandana
+from .sample_file import write_sample_file, indices, KL
+from unittest import TestCase
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from pandana.core.segments import segment_reduce, segment_offsets, REDUCTIONS
+from pandana.core.tables import Tables
+from pandana.core.var import Var
+from pandana.core.cut import Cut
+
+
+class TestSegments(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "sample.h5")
+        write_sample_file(self.path, nevents=40)
+        self.tables = Tables(self.path, "evt.seq", "spill", indices)
+
+    def tearDown(self):
+        self.tables.closeFile()
+        self.tmpdir.cleanup()
+
+    def test_offsets(self):
+        offsets = segment_offsets([np.array([1, 1, 2, 2, 2, 5]), np.array([0, 1, 0, 0, 1, 0])])
+        np.testing.assert_array_equal(offsets, [0, 1, 2, 4, 5, 6])
+        np.testing.assert_array_equal(segment_offsets([np.array([])]), [0])
+
+    def test_matches_groupby(self):
+        png = self.tables["rec.png"]
+        calE = png["calE"]
+        gap = png["maxplanegap"] > 1
+        for levels in [KL, KL + ["subevt"]]:
+            for how in REDUCTIONS:
+                df = gap if how in ("any", "all") else calE
+                expected = getattr(df.groupby(level=levels), how)()
+                ours = segment_reduce(df, levels, how, self.tables)
+                pd.testing.assert_index_equal(ours.index, expected.index, exact=False)
+                np.testing.assert_allclose(ours.to_numpy(), expected.to_numpy(), rtol=1e-6)
+
+        # Offsets computed by the group are reused
+        self.assertIs(self.tables.segmentOffsets(calE.index, KL), png.segmentOffsets(KL))
+
+    def test_nan_is_skipped(self):
+        index = pd.MultiIndex.from_arrays(
+            [[1, 1, 1, 2, 2, 3, 3], [0, 1, 2, 0, 1, 0, 1]], names=["evt", "subevt"]
+        )
+        values = np.array([1.0, np.nan, 2.0, 3.0, 4.0, np.nan, np.nan])
+        series = pd.Series(values, index=index, name="calE")
+        frame = pd.DataFrame({"a": values, "b": values[::-1].copy()}, index=index)
+        for df in (series, frame, series.astype(np.float32)):
+            for how in REDUCTIONS:
+                expected = getattr(df.groupby(level=["evt"]), how)()
+                ours = segment_reduce(df, ["evt"], how)
+                pd.testing.assert_index_equal(ours.index, expected.index, exact=False)
+                self.assertEqual(str(ours.dtypes), str(expected.dtypes))
+                np.testing.assert_allclose(
+                    ours.to_numpy().astype(float), expected.to_numpy().astype(float)
+                )
+
+    def test_fallback(self):
+        calE = self.tables["rec.png"]["calE"]
+        shuffled = calE.iloc[::-1]
+        pd.testing.assert_series_equal(
+            segment_reduce(shuffled, KL, "sum"), shuffled.groupby(level=KL).sum()
+        )
+        pd.testing.assert_series_equal(
+            segment_reduce(calE, ["evt"], "max"), calE.groupby(level=["evt"]).max()
+        )
+
+    def test_var_and_cut_api(self):
+        kPngE = Var(lambda tables: tables["rec.png"]["calE"]).sum(KL)
+        kGap = (Var(lambda tables: tables["rec.png"]["maxplanegap"]) > 1).all(KL)
+        self.assertIsInstance(kGap, Cut)
+
+        df = self.tables["rec.png"]
+        expected = df["calE"].groupby(level=KL).sum()
+        np.testing.assert_allclose(kPngE(self.tables).to_numpy(), expected.to_numpy(), rtol=1e-6)
+        expected = (df["maxplanegap"] > 1).groupby(level=KL).agg(np.all)
+        np.testing.assert_array_equal(kGap(self.tables).to_numpy(), expected.to_numpy())
@@ -0,0 +1,427 @@
+from .context import pandana
+from .sample_file import write_sample_file, indices, KL
+from .mpirun import mpi_available, run_mpi
+from unittest import TestCase, skipIf
+import json
+import os
+import tempfile
+
+import boost_histogram as bh
+import h5py as h5
+import numpy as np
+import pandas as pd
+
+from pandana.core.loader import Loader
+from pandana.core.tables import Tables
+from pandana.core.spectrum import Spectrum
+from pandana.core.var import Var
+from pandana.core.cut import Cut
+
+
+kSlcE = Var(lambda tables: tables["rec.slc"]["calE"])
+kPOT = Var(lambda tables: tables["spill"]["spillpot"])
+kNHitCut = Cut(lambda tables: tables["rec.slc"]["nhit"] > 30)
+
+
+class TestSpectrum(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = []
+        for seed in range(3):
+            path = os.path.join(self.tmpdir.name, "sample%d.h5" % seed)
+            write_sample_file(path, seed=seed)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def loader(self, **kwargs):
+        return Loader(self.files, "evt.seq", "spill", indices, **kwargs)
+
+    def test_binned_matches_event_list(self):
+        loader = self.loader(chunk_events=7)
+        events = Spectrum(loader, kNHitCut, kSlcE, kPOT)
+        binned = Spectrum(loader, kNHitCut, kSlcE, kPOT, axes=bh.axis.Regular(10, 0, 4))
+        loader.Go()
+
+        n, bins = events.histogram(10, (0, 4))
+        nb, binsb = binned.histogram()
+        np.testing.assert_allclose(nb, n)
+        np.testing.assert_allclose(binsb, bins)
+        self.assertEqual(binned.entries(), events.entries())
+        self.assertAlmostEqual(binned.integral(), events.integral())
+
+        self.assertEqual(binned._dfvars, [])
+        with self.assertRaises(ValueError):
+            binned.df()
+
+    def test_binned_keep_events(self):
+        loader = self.loader()
+        spec = Spectrum(
+            loader, kNHitCut, kSlcE, axes=bh.axis.Regular(5, 0, 5), keep_events=True
+        )
+        loader.Go()
+
+        self.assertEqual(spec.entries(), spec.df().shape[0])
+        n, _ = spec.histogram(5, (0, 5))
+        np.testing.assert_allclose(spec.histogram()[0], n)
+
+        total = spec + spec
+        self.assertEqual(total.entries(), 2 * spec.entries())
+        np.testing.assert_allclose(total.histogram()[0], 2 * n)
+
+    def test_exposure(self):
+        loader = self.loader(chunk_events=6)
+        spec = Spectrum(loader, kNHitCut, kSlcE, exposure=kPOT)
+        binned = Spectrum(loader, kNHitCut, kSlcE, axes=bh.axis.Regular(5, 0, 5), exposure=kPOT)
+        loader.Go()
+
+        pot = 0.0
+        for path in self.files:
+            with h5.File(path, "r") as f:
+                pot += f["spill"]["spillpot"][()].sum()
+        self.assertAlmostEqual(spec.exposure(), pot)
+        self.assertAlmostEqual(binned.exposure(), pot)
+        self.assertAlmostEqual((spec + spec).exposure(), 2 * pot)
+        self.assertAlmostEqual((binned + binned).exposure(), 2 * pot)
+
+    def test_distributed_finish_on_one_rank(self):
+        loader = self.loader()
+        events = Spectrum(loader, kNHitCut, kSlcE, kPOT, exposure=kPOT)
+        binned = Spectrum(loader, kNHitCut, kSlcE, kPOT, axes=bh.axis.Regular(10, 0, 4))
+        loader.Go()
+
+        distributed = self.loader(distributed=True, gather_events=True)
+        devents = Spectrum(distributed, kNHitCut, kSlcE, kPOT, exposure=kPOT)
+        dbinned = Spectrum(distributed, kNHitCut, kSlcE, kPOT, axes=bh.axis.Regular(10, 0, 4))
+        distributed.Go()
+
+        pd.testing.assert_series_equal(devents.df(), events.df())
+        pd.testing.assert_series_equal(devents.weight(), events.weight())
+        self.assertEqual(devents.entries(), events.entries())
+        self.assertAlmostEqual(devents.integral(), events.integral())
+        self.assertAlmostEqual(devents.exposure(), events.exposure())
+        np.testing.assert_allclose(dbinned.histogram()[0], binned.histogram()[0])
+        np.testing.assert_allclose(
+            dbinned.hist().variances(flow=True), binned.hist().variances(flow=True)
+        )
+        self.assertEqual(dbinned.entries(), binned.entries())
+        np.testing.assert_allclose(
+            dbinned.histogram(mpireduce=True)[0], binned.histogram()[0]
+        )
+
+    def test_parallel_save_load(self):
+        from pandana.core.spectrum import save_spectra, load_spectra
+
+        kDir = Var(lambda tables: tables["rec.png"]["dir"])
+        loader = self.loader()
+        events = Spectrum(loader, kNHitCut, kSlcE, kPOT, exposure=kPOT)
+        vectors = Spectrum(loader, Cut(lambda t: t["rec.png"]["calE"] > 0.5), kDir)
+        loader.Go()
+
+        path = os.path.join(self.tmpdir.name, "spectra.h5")
+        save_spectra(path, [events, vectors], ["events", "vectors"], parallel=True)
+        loaded, loaded_vectors = load_spectra(path, ["events", "vectors"])
+        pd.testing.assert_series_equal(loaded.df(), events.df())
+        pd.testing.assert_series_equal(loaded.weight(), events.weight())
+        pd.testing.assert_frame_equal(loaded_vectors.df(), vectors.df())
+        self.assertAlmostEqual(loaded.exposure(), events.exposure())
+
+        self.assertEqual(load_spectra(path, "events", ranks=[0]).entries(), events.entries())
+        self.assertEqual(load_spectra(path, "events", ranks=[]).entries(), 0)
+
+    def test_save_load_binned(self):
+        from pandana.core.spectrum import save_spectra, load_spectra, LoadedSpectrum
+
+        loader = self.loader()
+        binned = Spectrum(
+            loader, kNHitCut, kSlcE, kPOT, axes=bh.axis.Regular(10, 0, 4), exposure=kPOT
+        )
+        both = Spectrum(
+            loader, kNHitCut, kSlcE, axes=bh.axis.Variable([0, 1, 3, 5]), keep_events=True
+        )
+        loader.Go()
+
+        path = os.path.join(self.tmpdir.name, "spectra.h5")
+        save_spectra(path, [binned, both], ["binned", "both"])
+        lbinned, lboth = load_spectra(path, ["binned", "both"])
+        self.assertIsInstance(lbinned, LoadedSpectrum)
+        self.assertEqual(lbinned._read, {})
+        self.assertEqual(lbinned.entries(), binned.entries())
+        self.assertAlmostEqual(lbinned.integral(), binned.integral())
+        self.assertAlmostEqual(lbinned.exposure(), binned.exposure())
+        self.assertEqual(lbinned._read, {})
+
+        self.assertEqual(lbinned.hist(), binned.hist())
+        np.testing.assert_allclose(
+            lbinned.hist().variances(flow=True), binned.hist().variances(flow=True)
+        )
+        with self.assertRaises(ValueError):
+            lbinned.df()
+
+        self.assertEqual(lboth.hist(), both.hist())
+        pd.testing.assert_series_equal(lboth.df(), both.df())
+        self.assertNotIn("weight", lboth._read)
+        pd.testing.assert_series_equal(lboth.weight(), both.weight())
+
+        save_spectra(path, both, "both", events=False)
+        lboth = load_spectra(path, "both")
+        self.assertEqual(lboth.hist(), both.hist())
+        with self.assertRaises(ValueError):
+            lboth.df()
+
+    def test_save_load_axes(self):
+        from pandana.core.spectrum import FilledSpectrum, save_spectra, load_spectra
+
+        axes = [
+            bh.axis.Regular(4, 1, 10, transform=bh.axis.transform.log, metadata="E"),
+            bh.axis.Integer(0, 3, underflow=False),
+            bh.axis.IntCategory([3, 5], growth=True),
+            bh.axis.StrCategory(["a", "b"]),
+            bh.axis.Boolean(),
+        ]
+        hist = bh.Histogram(*axes, storage=bh.storage.Weight())
+        hist.fill([2, 5], [0, 2], [3, 7], ["a", "b"], [True, False], weight=[1.5, 2])
+        path = os.path.join(self.tmpdir.name, "axes.h5")
+        save_spectra(path, FilledSpectrum(None, None, hist=hist, entries=2), "h")
+
+        loaded = load_spectra(path, "h").hist()
+        self.assertEqual(loaded.axes[0].metadata, "E")
+        self.assertEqual(list(loaded.axes[3]), ["a", "b"])
+        np.testing.assert_allclose(loaded.axes[0].edges, hist.axes[0].edges)
+        np.testing.assert_array_equal(loaded.values(flow=True), hist.values(flow=True))
+        np.testing.assert_array_equal(loaded.variances(flow=True), hist.variances(flow=True))
+
+    def test_load_columns(self):
+        from pandana.core.spectrum import save_spectra, load_spectra
+
+        kDir = Var(lambda tables: tables["rec.png"]["dir"])
+        loader = self.loader()
+        vectors = Spectrum(loader, Cut(lambda t: t["rec.png"]["calE"] > 0.5), kDir)
+        loader.Go()
+
+        path = os.path.join(self.tmpdir.name, "vectors.h5")
+        save_spectra(path, vectors, "vectors", compression="lzf")
+        loaded = load_spectra(path, "vectors")
+        pd.testing.assert_frame_equal(loaded.columns(["dir[1]"]), vectors.df()[["dir[1]"]])
+        self.assertEqual(loaded._read, {})
+        pd.testing.assert_frame_equal(loaded.df(), vectors.df())
+        with h5.File(path, "r") as f:
+            self.assertEqual(f["vectors/values/0"].compression, "lzf")
+
+        old = os.path.join(self.tmpdir.name, "old.h5")
+        save_spectra(old, vectors, "vectors", format="hdfstore")
+        pd.testing.assert_frame_equal(load_spectra(old, "vectors").df(), vectors.df())
+
+    def test_hdfstore_needs_events(self):
+        from pandana.core.spectrum import save_spectra, load_spectra
+
+        loader = self.loader()
+        events = Spectrum(loader, kNHitCut, kSlcE)
+        binned = Spectrum(loader, kNHitCut, kSlcE, axes=bh.axis.Regular(10, 0, 4))
+        loader.Go()
+
+        path = os.path.join(self.tmpdir.name, "old.h5")
+        save_spectra(path, events, "events", format="hdfstore")
+        with self.assertRaises(ValueError):
+            save_spectra(path, [events, binned], ["events", "binned"], format="hdfstore")
+        # The file written before is left as it was
+        pd.testing.assert_series_equal(load_spectra(path, "events").df(), events.df())
+
+    def test_nd_spectrum(self):
+        kNHit = Var(lambda tables: tables["rec.slc"]["nhit"])
+        kPngE = Var(lambda tables: tables["rec.png"]["calE"]).sum(KL)
+        axes = [
+            bh.axis.Variable([0, 0.5, 1, 2, 5]),
+            bh.axis.Regular(9, 9.5, 99.5),
+            bh.axis.Regular(4, 0, 4),
+        ]
+        loader = self.loader(chunk_events=7)
+        binned = Spectrum(loader, kNHitCut, [kSlcE, kNHit, kPngE], kPOT, axes=axes)
+        events = Spectrum(loader, kNHitCut, [kSlcE, kNHit, kPngE], kPOT)
+        loader.Go()
+
+        # The same thing from plain pandas
+        frames = []
+        for path in self.files:
+            tables = Tables(path, "evt.seq", "spill", indices)
+            slc = tables["rec.slc"][["calE", "nhit"]]
+            evts = slc.index.droplevel("subevt")
+            pngE = kPngE(tables).reindex(evts).to_numpy()
+            keep = (slc["nhit"].to_numpy() > 30) & ~np.isnan(pngE)
+            values = np.column_stack([slc["calE"], slc["nhit"], pngE])[keep]
+            weight = kPOT(tables).reindex(evts).to_numpy()[keep]
+            frames.append((values, weight))
+            tables.closeFile()
+        values = np.concatenate([v for v, _ in frames])
+        weights = np.concatenate([w for _, w in frames])
+
+        expected = bh.Histogram(*axes, storage=bh.storage.Weight())
+        expected.fill(*values.T, weight=weights)
+        np.testing.assert_allclose(binned.hist().values(flow=True), expected.values(flow=True))
+        self.assertEqual(binned.entries(), len(values))
+
+        self.assertEqual(list(events.df().columns), ["var0", "var1", "var2"])
+        np.testing.assert_allclose(events.df().to_numpy(), values)
+        n, edges = events.histogram([axis.edges for axis in axes])
+        np.testing.assert_allclose(n, expected.values())
+        self.assertEqual(len(binned.histogram()[1]), 3)
+
+        with self.assertRaises(ValueError):
+            Spectrum(self.loader(), kNHitCut, [kSlcE, kNHit], axes=axes)
+
+    def test_nd_category_axis(self):
+        kNHit = Var(lambda tables: tables["rec.slc"]["nhit"])
+        kBig = Var(lambda tables: (tables["rec.slc"]["nhit"] > 50).astype(int))
+        loader = self.loader()
+        binned = Spectrum(
+            loader,
+            kNHitCut,
+            [kBig, kNHit],
+            axes=[bh.axis.IntCategory([0, 1]), bh.axis.Regular(9, 10, 100)],
+        )
+        loader.Go()
+        values = binned.hist().values()
+        self.assertEqual(values[0].sum() + values[1].sum(), binned.entries())
+        self.assertEqual(values[0, 5:].sum(), 0)
+
+    def test_multiverse_matches_spectra(self):
+        from pandana.core.spectrum import MultiverseSpectrum
+
+        kNHit = Var(lambda tables: tables["rec.slc"]["nhit"])
+        shifts = [0.5, 1.0, 2.0]
+        kWeights = [Var(lambda tables, s=s: tables["rec.slc"]["calE"] * s) for s in shifts]
+        kMatrix = Var(
+            lambda tables: pd.DataFrame(
+                {i: tables["rec.slc"]["calE"] * s for i, s in enumerate(shifts)}
+            )
+        )
+        axis = bh.axis.Regular(10, 0, 4)
+        loader = self.loader(chunk_events=7)
+        singles = [Spectrum(loader, kNHitCut, kSlcE, w, axes=axis) for w in kWeights]
+        universes = MultiverseSpectrum(loader, kNHitCut, kSlcE, kWeights, axes=axis)
+        matrix = MultiverseSpectrum(
+            loader, kNHitCut, kSlcE, kMatrix, axes=axis, nuniverses=3, exposure=kPOT
+        )
+        # Weights per spill, aligned to the slices
+        pots = MultiverseSpectrum(loader, kNHitCut, kSlcE, [kPOT, kPOT], axes=axis)
+        nd = MultiverseSpectrum(
+            loader,
+            kNHitCut,
+            [kSlcE, kNHit],
+            kWeights,
+            axes=[axis, bh.axis.Regular(9, 9.5, 99.5, underflow=False)],
+        )
+        single = Spectrum(loader, kNHitCut, kSlcE, kPOT, axes=axis)
+        loader.Go()
+
+        for spec in (universes, matrix):
+            self.assertEqual(spec.hist().values(flow=True).shape, (3, 12))
+            for i, s in enumerate(singles):
+                np.testing.assert_allclose(
+                    spec.universe(i).values(flow=True), s.hist().values(flow=True)
+                )
+                np.testing.assert_allclose(
+                    spec.universe(i).variances(flow=True), s.hist().variances(flow=True)
+                )
+            np.testing.assert_allclose(spec.integral(), [s.integral() for s in singles])
+            self.assertEqual(spec.entries(), singles[0].entries())
+        n, edges = universes.histogram()
+        self.assertEqual(n.shape, (3, 10))
+        np.testing.assert_allclose(edges, axis.edges)
+        self.assertGreater(matrix.exposure(), 0)
+
+        for i in range(2):
+            np.testing.assert_allclose(
+                pots.universe(i).values(flow=True), single.hist().values(flow=True)
+            )
+
+        self.assertEqual(nd.hist().values(flow=True).shape, (3, 12, 10))
+        np.testing.assert_allclose(
+            nd.universe(1).project(0).values(flow=True),
+            singles[1].hist().values(flow=True),
+        )
+
+        with self.assertRaises(ValueError):
+            MultiverseSpectrum(self.loader(), kNHitCut, kSlcE, kMatrix, axes=axis)
+        bad = self.loader()
+        MultiverseSpectrum(bad, kNHitCut, kSlcE, kMatrix, axes=axis, nuniverses=2)
+        with self.assertRaises(ValueError):
+            bad.Go()
+
+    def test_multiverse_finish_save_load(self):
+        from pandana.core.spectrum import MultiverseSpectrum, save_spectra, load_spectra
+
+        kWeights = [kPOT, Var(lambda tables: tables["rec.slc"]["calE"])]
+        axis = bh.axis.Regular(10, 0, 4)
+        loader = self.loader()
+        spec = MultiverseSpectrum(loader, kNHitCut, kSlcE, kWeights, axes=axis)
+        loader.Go()
+
+        distributed = self.loader(distributed=True)
+        dspec = MultiverseSpectrum(distributed, kNHitCut, kSlcE, kWeights, axes=axis)
+        distributed.Go()
+        np.testing.assert_allclose(
+            dspec.hist().values(flow=True), spec.hist().values(flow=True)
+        )
+        np.testing.assert_allclose(dspec.integral(), spec.integral())
+        self.assertEqual(dspec.entries(), spec.entries())
+
+        path = os.path.join(self.tmpdir.name, "multiverse.h5")
+        save_spectra(path, spec, "multiverse")
+        loaded = load_spectra(path, "multiverse")
+        np.testing.assert_allclose(
+            loaded.hist().values(flow=True), spec.hist().values(flow=True)
+        )
+        np.testing.assert_allclose(loaded.integral(), spec.integral())
+
+
+@skipIf(not mpi_available(), "MPI is not installed")
+class TestSpectrumMPI(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = []
+        for seed in range(3):
+            path = os.path.join(self.tmpdir.name, "sample%d.h5" % seed)
+            write_sample_file(path, seed=seed)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_histogram_is_summed_once(self):
+        code = (
+            "import json, sys\n"
+            "import boost_histogram as bh\n"
+            "from mpi4py import MPI\n"
+            "from pandana.core import Cut, Loader, Spectrum, Var\n"
+            "from tests.sample_file import indices\n"
+            "kE = Var(lambda tables: tables['rec.slc']['calE'])\n"
+            "cut = Cut(lambda tables: tables['rec.slc']['nhit'] > 30)\n"
+            "def fill(**kwargs):\n"
+            "    loader = Loader(sys.argv[1:], 'evt.seq', 'spill', indices, **kwargs)\n"
+            "    spectra = [Spectrum(loader, cut, kE, axes=bh.axis.Regular(10, 0, 4)),\n"
+            "               Spectrum(loader, cut, kE)]\n"
+            "    loader.Go()\n"
+            "    return spectra\n"
+            "serial = fill(backend='serial')\n"
+            "binned, events = fill(distributed=True, gather_events=True)\n"
+            "local, _ = fill()\n"
+            "results = {\n"
+            "    'serial': serial[0].histogram()[0].tolist(),\n"
+            "    'binned': binned.histogram()[0].tolist(),\n"
+            "    'binned_reduced': binned.histogram(mpireduce=True)[0].tolist(),\n"
+            "    'events': events.histogram(10, (0, 4), mpireduce=True)[0],\n"
+            "    'local': local.histogram(mpireduce=True)[0],\n"
+            "}\n"
+            "if MPI.COMM_WORLD.rank == 0:\n"
+            "    results['events'] = results['events'].tolist()\n"
+            "    results['local'] = results['local'].tolist()\n"
+            "    print(json.dumps(results))\n"
+            "else:\n"
+            "    assert results['events'] is None and results['local'] is None\n"
+        )
+        results = json.loads(run_mpi(code, 3, *self.files))
+        self.assertGreater(sum(results["serial"]), 0)
+        for name in ("binned", "binned_reduced", "events", "local"):
+            np.testing.assert_allclose(results[name], results["serial"], err_msg=name)
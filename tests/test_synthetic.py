@@ -0,0 +1,54 @@
+from .context import pandana
+import os
+import tempfile
+import unittest
+
+import h5py as h5
+import numpy as np
+
+from pandana.core import Cut, Loader, Spectrum, Var
+from pandana.utils.synthetic import KL, indices, write_synthetic_file, write_synthetic_files
+
+
+class TestSynthetic(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "synthetic.h5")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_layout(self):
+        rows = write_synthetic_file(self.path, 2500, chunk_rows=256, block_events=1000)
+        self.assertEqual(rows["spill"], 2500)
+        with h5.File(self.path, "r") as f:
+            ds = f["rec.slc"]["calE"]
+            self.assertEqual(ds.compression, "gzip")
+            self.assertEqual(ds.chunks, (256, 1))
+            self.assertEqual(ds.shape, (rows["rec.slc"], 1))
+
+            # Every group is sorted by event, across the blocks it was written in
+            for name in f:
+                self.assertTrue(np.all(np.diff(f[name]["evt.seq"][:, 0].astype(np.int64)) >= 0))
+
+            # Each vertex has as many prongs as it says
+            npng = f["rec.vtx.elastic.fuzzyk"]["npng"][:, 0]
+            png_idx = f["rec.vtx.elastic.fuzzyk.png"]["rec.vtx.elastic.fuzzyk.png_idx"][:, 0]
+            self.assertEqual(npng.sum(), rows["rec.vtx.elastic.fuzzyk.png"])
+            self.assertEqual(np.count_nonzero(png_idx == 0), np.count_nonzero(npng))
+            self.assertEqual(
+                rows["rec.vtx.elastic.fuzzyk.png"], rows["rec.vtx.elastic.fuzzyk.png.cvnpart"]
+            )
+
+    def test_loader(self):
+        paths = write_synthetic_files(self.tmpdir.name, 2, 500, seed=3)
+        self.assertEqual(write_synthetic_files(self.tmpdir.name, 2, 500, seed=3), paths)
+
+        kPngE = Var(lambda tables: tables["rec.vtx.elastic.fuzzyk.png"]["calE"]).sum(KL)
+        kTwoProng = Cut(lambda tables: tables["rec.vtx.elastic.fuzzyk"]["npng"] == 2).first(KL)
+        loader = Loader(paths, "evt.seq", "spill", indices)
+        spec = Spectrum(loader, kTwoProng, kPngE)
+        loader.Go()
+
+        self.assertGreater(spec.entries(), 0)
+        self.assertEqual(spec.df().index.names, KL)